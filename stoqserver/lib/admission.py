@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import threading
+import time
+
+from stoqserver.lib import metrics
+
+_in_flight = metrics.registry.gauge(
+    'stoqserver_lane_requests_in_flight',
+    'Requests being handled in each lane', ['lane'])
+_queued = metrics.registry.gauge(
+    'stoqserver_lane_requests_queued',
+    'Requests waiting to be handled in each lane', ['lane'])
+_rejected = metrics.registry.counter(
+    'stoqserver_lane_requests_rejected_total',
+    'Requests rejected because their lane was full', ['lane', 'reason'])
+_wait_time = metrics.registry.histogram(
+    'stoqserver_lane_wait_seconds',
+    'Time the requests waited to be handled in each lane', ['lane'])
+
+
+class Lane(object):
+    """Limit how many requests of some kind are handled at the same time
+
+    Requests over the :attr:`.concurrency` limit wait in a queue. When the
+    queue already has :attr:`.max_queue` requests, or a request waited for
+    more than :attr:`.timeout` seconds, it is rejected so the threads and
+    the database connections are kept to the other lanes.
+
+    A lane without a *concurrency* never makes requests wait.
+    """
+
+    def __init__(self, name, concurrency=None, max_queue=0, timeout=10):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._running = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a place to handle a request in this lane
+
+        :returns: ``True`` if the request can be handled, ``False`` if it
+            was rejected. :meth:`.release` should be called when the request
+            finishes if it was not rejected.
+        """
+        start = time.monotonic()
+        with self._condition:
+            if self.concurrency is not None and self._running >= self.concurrency:
+                if self._waiting >= self.max_queue:
+                    _rejected.inc(lane=self.name, reason='queue_full')
+                    return False
+
+                self._waiting += 1
+                _queued.set(self._waiting, lane=self.name)
+                try:
+                    while self._running >= self.concurrency:
+                        remaining = self.timeout - (time.monotonic() - start)
+                        if remaining <= 0:
+                            _rejected.inc(lane=self.name, reason='timeout')
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                    _queued.set(self._waiting, lane=self.name)
+
+            self._running += 1
+            _in_flight.set(self._running, lane=self.name)
+
+        _wait_time.observe(time.monotonic() - start, lane=self.name)
+        return True
+
+    def release(self):
+        """Free the place of a request that finished"""
+        with self._condition:
+            self._running -= 1
+            _in_flight.set(self._running, lane=self.name)
+            self._condition.notify()
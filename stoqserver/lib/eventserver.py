@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""An asyncio server for the events of :class:`EventStream`
+
+The /stream route of the flask server keeps one thread blocked for each
+connected client. This server runs alongside it and serves the same events
+using a single thread running an asyncio loop, so it can handle lots of
+idle connections without starving the flask server of threads.
+"""
+
+import asyncio
+import logging
+import urllib.parse
+
+from stoqserver.lib.restful import EventQueue, EventStream
+
+log = logging.getLogger(__name__)
+
+
+class _AsyncEventQueue(EventQueue):
+    """An :class:`EventQueue` that wakes up a coroutine when an event arrives
+
+    :meth:`.put` can be called from any thread, while :meth:`.wait` should be
+    called by a coroutine running in the loop given on the constructor.
+    """
+
+    def __init__(self, loop, **kwargs):
+        super(_AsyncEventQueue, self).__init__(**kwargs)
+        self._loop = loop
+        self._waiter = asyncio.Event()
+
+    def put(self, event):
+        super(_AsyncEventQueue, self).put(event)
+        self._loop.call_soon_threadsafe(self._waiter.set)
+
+    async def wait(self):
+        await self._waiter.wait()
+        self._waiter.clear()
+
+
+class EventServer(object):
+    """The asyncio server
+
+    It responds to ``GET /stream`` just like the /stream route of the flask
+    server, including support for the Last-Event-ID header and the topics
+    and station arguments.
+    """
+
+    MAX_HEADERS = 100
+    #: How many bytes are read at a time from the clients after the request
+    READ_SIZE = 1024
+
+    def __init__(self, port, host='0.0.0.0'):
+        self.port = port
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    #
+    #  Public API
+    #
+
+    def run(self):
+        """Run the server. This will block until :meth:`.stop` is called"""
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle_client, self.host, self.port))
+        log.info("Event server listening on %s",
+                 self.server.sockets[0].getsockname())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.close()
+
+    def stop(self):
+        """Stop the server. Can be called from any thread"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    #
+    #  Private
+    #
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            return None
+
+        headers = {}
+        for i in range(self.MAX_HEADERS):
+            line = await reader.readline()
+            line = line.decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            return None
+
+        url = urllib.parse.urlsplit(target)
+        args = dict(urllib.parse.parse_qsl(url.query))
+        return method, url.path, args, headers
+
+    def _write_head(self, writer, status, headers):
+        lines = ['HTTP/1.1 %s' % (status, )]
+        lines.extend('%s: %s' % (name, value) for name, value in headers)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request = await self._read_request(reader)
+        except (ConnectionError, UnicodeDecodeError):
+            request = None
+
+        if request is None:
+            writer.close()
+            return
+
+        method, path, args, headers = request
+        if method != 'GET' or path != '/stream':
+            self._write_head(writer, '404 Not Found',
+                             [('Content-Length', '0'), ('Connection', 'close')])
+            writer.close()
+            return
+
+        # The same CORS headers the flask server adds to its responses
+        self._write_head(writer, '200 OK', [
+            ('Content-Type', 'text/event-stream'),
+            ('Cache-Control', 'no-cache'),
+            ('Connection', 'close'),
+            ('Access-Control-Allow-Origin',
+             headers.get('origin') or args.get('origin', '*')),
+            ('Access-Control-Allow-Credentials', 'true'),
+        ])
+
+        EventStream.set_write_timeout(writer.get_extra_info('socket'))
+        stream = _AsyncEventQueue(self.loop, **EventStream.get_queue_args(args))
+        EventStream.subscribe(stream, headers.get(
+            'last-event-id', args.get('last_event_id')))
+        try:
+            await self._send_events(reader, writer, stream)
+        except (ConnectionError, TimeoutError):
+            pass
+        finally:
+            EventStream.unsubscribe(stream)
+            writer.close()
+
+    async def _wait_eof(self, reader):
+        # Don't use reader.read(), which would keep all the data in memory
+        try:
+            while await reader.read(self.READ_SIZE):
+                pass
+        except OSError:
+            # e.g. the write timeout closed the connection
+            pass
+
+    async def _send_events(self, reader, writer, stream):
+        heartbeat = EventStream.get_heartbeat_interval()
+
+        # The client is not supposed to send anything else. Whatever it sends
+        # is discarded, and the read returns when it disconnects
+        disconnected = self.loop.create_task(self._wait_eof(reader))
+        try:
+            while not disconnected.done():
+                event = stream.get(block=False)
+                if event is None:
+                    waiter = self.loop.create_task(stream.wait())
+                    done, pending = await asyncio.wait(
+                        [waiter, disconnected], timeout=heartbeat,
+                        return_when=asyncio.FIRST_COMPLETED)
+                    waiter.cancel()
+                    if done:
+                        continue
+
+                    writer.write(EventStream.HEARTBEAT)
+                    await writer.drain()
+                    continue
+
+                for chunk in EventStream.get_chunks(event):
+                    writer.write(chunk)
+                await writer.drain()
+        finally:
+            disconnected.cancel()
+
+
+def run_eventserver(port):
+    EventServer(port).run()
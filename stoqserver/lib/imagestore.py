@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+"""A copy of the product images on the disk
+
+The images are stored as bytea in the database, so serving them from there
+means copying each one from postgres to python and then to the socket.
+:class:`ImageStore` keeps a copy of them in a directory, so they can be
+sent directly from the files.
+
+The files are named by the md5 of the images (the same value used as their
+ETag), so an image is only downloaded once even if it is used by many
+sellables, and a small pointer file for each sellable says which one it
+uses. Since everything is on the disk, all the processes of the server
+can share the same store.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class ImageStore(object):
+    """The images of the sellables, mirrored from the image table
+
+    Only one process should call :meth:`.sync`, while all of them can
+    use :meth:`.get_path` and :meth:`.read`.
+    """
+
+    #: How many images are downloaded by each query
+    FETCH_SIZE = 50
+
+    def __init__(self, directory, on_remove=None):
+        """
+        :param directory: the directory to store the images in
+        :param on_remove: if not ``None``, it will be called with the md5
+            of each image removed from the store
+        """
+        self.directory = directory
+        self.on_remove = on_remove
+        self._blobs_dir = os.path.join(directory, 'blobs')
+        self._pointers_dir = os.path.join(directory, 'sellables')
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._pointers_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # What each pointer points to, as (image id, md5) tuples, and how many
+        # of them use each image. Only known by the process calling sync
+        self._index = None
+        self._refs = collections.Counter()
+
+    #
+    #  Public API
+    #
+
+    def get_path(self, sellable_id, is_main):
+        """Get the file with the image of a sellable
+
+        :returns: a tuple with the md5 of the image and the path of the file,
+            or ``None`` if the sellable has no image
+        """
+        try:
+            with open(self._get_pointer(sellable_id, is_main)) as f:
+                digest = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        return digest, self._get_blob(digest)
+
+    def read(self, sellable_id, is_main):
+        """Read the image of a sellable
+
+        :returns: a tuple with the md5 and the data of the image, or
+            ``None`` if the sellable has no image
+        """
+        found = self.get_path(sellable_id, is_main)
+        if found is None:
+            return None
+
+        digest, path = found
+        try:
+            with open(path, 'rb') as f:
+                return digest, f.read()
+        except FileNotFoundError:
+            # The image changed and the old file got removed while reading
+            return None
+
+    def get_digests(self):
+        """Get the md5 of all the images in the store
+
+        Only known by the process calling :meth:`.sync`.
+        """
+        with self._lock:
+            return set(self._refs)
+
+    def sync(self, store, te_ids=None):
+        """Copy the changes in the image table to the disk
+
+        :param te_ids: the te_id of the rows of the image table that changed,
+            or ``None`` to check the whole table
+        :returns: the ids of the sellables whose images changed, or ``None``
+            if the whole table was checked
+        """
+        with self._lock:
+            # The index is only known after the whole table was checked once
+            if te_ids is None or self._index is None:
+                self._sync_all(store)
+                return None
+
+            sellable_ids, deleted = self._get_sellable_ids(store, te_ids)
+            if deleted:
+                sellable_ids.update(self._get_stale_sellable_ids(store))
+            self._sync_sellables(store, sellable_ids)
+            return sellable_ids
+
+    #
+    #  Private
+    #
+
+    def _get_pointer(self, sellable_id, is_main):
+        # This also makes sure the id is safe to be used in a path
+        sellable_id = str(uuid.UUID(sellable_id))
+        return os.path.join(self._pointers_dir, '%s-%s' % (
+            sellable_id, 'main' if is_main else 'other'))
+
+    def _get_blob(self, digest):
+        return os.path.join(self._blobs_dir, digest[:2], digest)
+
+    def _write(self, filename, data):
+        # Other processes could be reading the file, so replace it atomically
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                            suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+
+    def _remove_blob(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        # Temporary files left by _write are not images
+        if self.on_remove is not None and not path.endswith('.tmp'):
+            self.on_remove(os.path.basename(path))
+
+    def _get_sellable_ids(self, store, te_ids):
+        rows = store.execute(
+            "SELECT id, sellable_id FROM image WHERE te_id IN ({})".format(
+                ', '.join('?' * len(te_ids))), params=list(te_ids)).get_all()
+        sellable_ids = {str(row[1]) for row in rows if row[1] is not None}
+        # The sellables that were using those images before (e.g. the image
+        # was moved to another sellable) need to be updated too
+        image_ids = {row[0] for row in rows}
+        sellable_ids.update(sellable_id for (sellable_id, is_main), (image_id, digest)
+                            in self._index.items() if image_id in image_ids)
+        # If a row is missing, it was deleted and we don't know its sellable
+        return sellable_ids, len(rows) != len(te_ids)
+
+    def _get_first_images(self, store):
+        # Like _get_images, but the images are not read, so this is cheap
+        # even for the whole table
+        first = {}
+        for image_id, sellable_id, is_main in store.execute(
+                "SELECT id, sellable_id, is_main FROM image "
+                "WHERE sellable_id IS NOT NULL AND image IS NOT NULL ORDER BY id"):
+            first.setdefault((str(sellable_id), is_main), image_id)
+        return first
+
+    def _get_stale_sellable_ids(self, store):
+        # The sellables whose first image is not the one we have anymore
+        first = self._get_first_images(store)
+        keys = set(first) | set(self._index)
+        return {sellable_id for sellable_id, is_main in keys
+                if first.get((sellable_id, is_main)) !=
+                self._index.get((sellable_id, is_main), (None, None))[0]}
+
+    def _get_images(self, store, sellable_ids=None):
+        # The first image of each sellable is the one used, like
+        # ImageResource did when getting them from the database
+        query = ("SELECT id, sellable_id, is_main, md5(image) FROM image "
+                 "WHERE sellable_id IS NOT NULL AND image IS NOT NULL")
+        params = []
+        if sellable_ids is not None:
+            query += " AND sellable_id IN ({})".format(', '.join('?' * len(sellable_ids)))
+            params = list(sellable_ids)
+
+        images = {}
+        for image_id, sellable_id, is_main, digest in store.execute(
+                query + " ORDER BY id", params=params):
+            images.setdefault((str(sellable_id), is_main), (image_id, digest))
+        return images
+
+    def _fetch(self, store, images):
+        # Only the images not in the disk need to be downloaded
+        missing = {image_id: digest for image_id, digest in images.values()
+                   if not os.path.exists(self._get_blob(digest))}
+        missing_ids = list(missing)
+        digests = {}
+        for i in range(0, len(missing_ids), self.FETCH_SIZE):
+            chunk = missing_ids[i:i + self.FETCH_SIZE]
+            for image_id, data in store.execute(
+                    "SELECT id, image FROM image WHERE id IN ({})".format(
+                        ', '.join('?' * len(chunk))), params=chunk):
+                # The image could have changed after its md5 was queried
+                data = bytes(data)
+                digest = hashlib.md5(data).hexdigest()
+                os.makedirs(os.path.dirname(self._get_blob(digest)), exist_ok=True)
+                self._write(self._get_blob(digest), data)
+                digests[image_id] = digest
+
+        # Images deleted before being downloaded should be ignored
+        result = {}
+        for key, (image_id, digest) in images.items():
+            digest = digests.get(image_id, digest)
+            if os.path.exists(self._get_blob(digest)):
+                result[key] = (image_id, digest)
+        return result
+
+    def _set_pointers(self, images, keys):
+        unused = set()
+        for sellable_id, is_main in keys:
+            key = (sellable_id, is_main)
+            image = images.get(key)
+            old_image = self._index.pop(key, None)
+            if image is not None:
+                self._index[key] = image
+                self._refs[image[1]] += 1
+            if old_image is not None:
+                self._refs[old_image[1]] -= 1
+                if self._refs[old_image[1]] <= 0:
+                    unused.add(old_image[1])
+
+            pointer = self._get_pointer(sellable_id, is_main)
+            if image is None:
+                if os.path.exists(pointer):
+                    os.unlink(pointer)
+            elif self.get_path(sellable_id, is_main) != (image[1], self._get_blob(image[1])):
+                self._write(pointer, image[1].encode())
+
+        # Remove the images no sellable uses anymore. Someone could still be
+        # reading them, but they will just get the image from the database
+        for digest in unused:
+            if self._refs[digest] > 0:
+                continue
+            del self._refs[digest]
+            self._remove_blob(self._get_blob(digest))
+
+    def _sync_sellables(self, store, sellable_ids):
+        if not sellable_ids:
+            return
+        images = self._fetch(store, self._get_images(store, sellable_ids))
+        self._set_pointers(images, [(sellable_id, is_main)
+                                    for sellable_id in sellable_ids
+                                    for is_main in [True, False]])
+
+    def _sync_all(self, store):
+        images = self._fetch(store, self._get_images(store))
+
+        self._index = {}
+        self._refs = collections.Counter()
+        keys = set(images)
+        for filename in os.listdir(self._pointers_dir):
+            sellable_id, _, kind = filename.rpartition('-')
+            if kind in ['main', 'other']:
+                keys.add((sellable_id, kind == 'main'))
+        self._set_pointers(images, keys)
+
+        # Remove the images that were left behind (e.g. by another process)
+        for dirpath, dirnames, filenames in os.walk(self._blobs_dir):
+            for filename in filenames:
+                if filename not in self._refs:
+                    self._remove_blob(os.path.join(dirpath, filename))
+        log.info("Image store synchronized: %d images", len(self._refs))
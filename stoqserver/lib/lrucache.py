@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """A thread-safe cache limited by the size of its entries
+
+    Each entry has a size (e.g. the number of bytes of an image) and the
+    least recently used entries are discarded when the total size goes
+    over *max_size*.
+
+    Like the data cache of the REST api, :meth:`.get` returns a generation
+    that should be passed to :meth:`.set`, so an entry built with stale
+    data is not cached when an invalidation happens while building it.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # The least recently used entries are at the beginning
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """The total size of the cached entries"""
+        return self._size
+
+    def get(self, key):
+        """Get the value cached for *key*
+
+        :returns: a tuple with the value (or ``None`` if there's none) and the
+            current generation, which should be passed to :meth:`.set`
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, self._generation
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0], self._generation
+
+    def set(self, key, generation, value, size):
+        """Cache *value* for *key*
+
+        The value is discarded if the cache got invalidated after
+        *generation* was obtained, or if it is bigger than the cache.
+        """
+        with self._lock:
+            if generation != self._generation or size > self.max_size:
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+
+            while self._size > self.max_size:
+                key, (value, size) = self._entries.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+
+    def invalidate(self, keys=None):
+        """Discard the entries for *keys*, or all of them if ``None``"""
+        with self._lock:
+            self._generation += 1
+            if keys is None:
+                self._entries.clear()
+                self._size = 0
+                return
+
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._size -= entry[1]
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+"""Metrics exported in the Prometheus text format
+
+Metrics are created in a :class:`Registry` (usually the module level
+:data:`registry`) and exported by :meth:`Registry.render`::
+
+    requests = registry.counter('requests_total', 'Requests handled', ['route'])
+    requests.inc(route='/data')
+"""
+
+import collections
+import contextlib
+import math
+import threading
+import time
+
+# Latencies, in seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# Payload sizes, in bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s expects the labels %r, got %r" % (
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        """Get the samples of this metric
+
+        :returns: a list of (name, labels, value) tuples, where labels
+            is a list of (name, value) tuples
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, list(zip(self.labelnames, key)), value)
+                for key, value in values]
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down"""
+
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """The distribution of some observed values (e.g. latencies)"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf, )
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # The count of each bucket, the sum and the count of values
+                data = self._values[key] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the number of seconds the with block took"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def collect(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count))
+                            for key, (counts, total, count) in self._values.items())
+
+        samples = []
+        for key, (counts, total, count) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket',
+                                labels + [('le', _format_value(float(bound)))],
+                                cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+class Registry(object):
+    """A set of metrics that can be rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+        #: Labels added to all the samples (e.g. to tell processes apart)
+        self.const_labels = []
+
+    #
+    #  Public API
+    #
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """Add a function that collects some values when rendering
+
+        Useful to export stats that are kept somewhere else. The function
+        should return a list of (name, type, documentation, value) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        """Get the samples of all the metrics
+
+        :returns: a list of (name, type, documentation, samples) tuples,
+            with the samples like the ones of :meth:`_Metric.collect`,
+            already including the :attr:`.const_labels`
+        """
+        with self._lock:
+            metrics = self._metrics[:]
+            collectors = self._collectors[:]
+
+        families = [(m.name, m.type, m.documentation, m.collect())
+                    for m in metrics]
+        for collector in collectors:
+            families.extend((name, type_, documentation, [(name, [], value)])
+                            for name, type_, documentation, value in collector())
+        return [(name, type_, documentation,
+                 [(sample_name, self.const_labels + labels, value)
+                  for sample_name, labels, value in samples])
+                for name, type_, documentation, samples in families]
+
+    def render(self):
+        """Render all the metrics in the Prometheus text format"""
+        return render([self.collect()])
+
+    #
+    #  Private
+    #
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+def render(collected):
+    """Render the metrics collected by one or more registries
+
+    The samples of the metrics with the same name are rendered together,
+    so the registries of many processes can be exported at once (they
+    should have different :attr:`Registry.const_labels`).
+
+    :param collected: a list with the results of :meth:`Registry.collect`
+    """
+    families = collections.OrderedDict()
+    for registry_families in collected:
+        for name, type_, documentation, samples in registry_families:
+            if name not in families:
+                families[name] = (type_, documentation, [])
+            families[name][2].extend(samples)
+
+    lines = []
+    for name, (type_, documentation, samples) in families.items():
+        lines.append('# HELP %s %s' % (name, documentation.replace('\n', ' ')))
+        lines.append('# TYPE %s %s' % (name, type_))
+        for sample_name, labels, value in samples:
+            lines.append('%s%s %s' % (sample_name, _format_labels(labels),
+                                      _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+#: The registry exported by the /metrics route of the flask server
+registry = Registry()
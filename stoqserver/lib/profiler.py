@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+"""A sampling profiler for the running processes
+
+The stacks of all the threads are sampled from time to time and returned
+in the collapsed format (one ``thread;frame;frame count`` line for each
+stack), which can be fed to flamegraph.pl or speedscope.
+
+Other processes can be profiled if they called :func:`install_signal_handler`
+by using :func:`profile_process`.
+"""
+
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from stoqlib.lib.osutils import get_application_dir
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.01
+MIN_INTERVAL = 0.001
+MAX_SECONDS = 60
+
+_lock = threading.Lock()
+
+
+class ProfilerError(Exception):
+    """Raised when the profile could not be made"""
+
+
+def _format_frame(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def profile(seconds, interval=DEFAULT_INTERVAL):
+    """Sample the stacks of the threads of this process
+
+    Only one profile can run at a time in a process.
+
+    :param seconds: for how long the stacks should be sampled. No more than
+        :data:`MAX_SECONDS`
+    :param interval: the number of seconds between each sample. No less
+        than :data:`MIN_INTERVAL`
+    :returns: the collapsed stacks, the most frequent first
+    :raises: :exc:`ProfilerError` if there's already a profile running
+    """
+    if not _lock.acquire(blocking=False):
+        raise ProfilerError("There's already a profile running")
+
+    try:
+        seconds = min(seconds, MAX_SECONDS)
+        interval = max(interval, MIN_INTERVAL)
+        own_thread = threading.get_ident()
+        names = {}
+        stacks = collections.Counter()
+
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+
+                frames = []
+                while frame is not None:
+                    frames.append(_format_frame(frame))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                stacks[';'.join(reversed(frames))] += 1
+            time.sleep(interval)
+    finally:
+        _lock.release()
+
+    return ''.join('%s %d\n' % (stack, count)
+                   for stack, count in stacks.most_common())
+
+
+def _get_request_filename(pid):
+    return os.path.join(get_application_dir(), 'profile-%d.json' % (pid, ))
+
+
+def _profile_to_file(seconds, interval, output):
+    try:
+        stacks = profile(seconds, interval)
+    except ProfilerError as e:
+        stacks = ''
+        log.warning("Could not profile the process: %s", e)
+
+    with open(output + '.tmp', 'w') as f:
+        f.write(stacks)
+    os.replace(output + '.tmp', output)
+
+
+def _handle_signal(signum, frame):
+    filename = _get_request_filename(os.getpid())
+    try:
+        with open(filename) as f:
+            request = json.load(f)
+        os.unlink(filename)
+    except (OSError, ValueError):
+        log.warning("Got a profile request without a valid request file")
+        return
+
+    # Don't block the signal handler (and the main thread) while profiling
+    t = threading.Thread(target=_profile_to_file,
+                         args=(request['seconds'], request['interval'],
+                               request['output']))
+    t.daemon = True
+    t.start()
+
+
+def install_signal_handler():
+    """Allow this process to be profiled by :func:`profile_process`
+
+    Must be called from the main thread. Not supported on Windows.
+    """
+    signal.signal(signal.SIGUSR2, _handle_signal)
+
+
+def profile_process(pid, seconds, interval=DEFAULT_INTERVAL):
+    """Profile another process
+
+    The process needs to have called :func:`install_signal_handler`.
+    This will block until the profile finishes.
+
+    :returns: the collapsed stacks, like :func:`profile`
+    :raises: :exc:`ProfilerError` if the process did not answer in time
+    """
+    seconds = min(seconds, MAX_SECONDS)
+    output = os.path.join(get_application_dir(), 'profile-%d.out' % (pid, ))
+    if os.path.exists(output):
+        os.unlink(output)
+
+    with open(_get_request_filename(pid), 'w') as f:
+        json.dump({'seconds': seconds, 'interval': interval, 'output': output}, f)
+    os.kill(pid, signal.SIGUSR2)
+
+    # Give it some time to start and to write the results
+    deadline = time.monotonic() + seconds + 10
+    while not os.path.exists(output):
+        if time.monotonic() > deadline:
+            raise ProfilerError("Process %d did not send the profile" % (pid, ))
+        time.sleep(0.1)
+
+    with open(output) as f:
+        stacks = f.read()
+    os.unlink(output)
+    return stacks
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import threading
+import time
+
+
+class QueryTracer(object):
+    """A storm tracer that collects the queries executed by a thread
+
+    After it is installed with :func:`storm.tracer.install_tracer`, the
+    queries executed by a thread between :meth:`.start` and :meth:`.stop`
+    are collected, no matter which store executed them. Queries made by
+    other threads are ignored.
+    """
+
+    #: Only the first MAX_STATEMENTS statements are kept, but all of
+    #: the queries are counted
+    MAX_STATEMENTS = 500
+
+    def __init__(self):
+        self._local = threading.local()
+
+    #
+    #  Public API
+    #
+
+    def start(self):
+        """Start collecting the queries of the current thread"""
+        self._local.stats = _QueryStats()
+
+    def stop(self):
+        """Stop collecting the queries of the current thread
+
+        :returns: an object with the ``count`` and the total ``duration`` of
+            the queries, and a list of (statement, duration) ``statements``,
+            or ``None`` if :meth:`.start` was not called
+        """
+        stats = getattr(self._local, 'stats', None)
+        self._local.stats = None
+        return stats
+
+    #
+    #  Storm tracer interface
+    #
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            stats.query_start = time.monotonic()
+
+    def connection_raw_execute_success(self, connection, raw_cursor,
+                                       statement, params):
+        stats = getattr(self._local, 'stats', None)
+        if stats is None or stats.query_start is None:
+            return
+
+        duration = time.monotonic() - stats.query_start
+        stats.query_start = None
+        stats.count += 1
+        stats.duration += duration
+        # The params are not kept, since they could contain sensitive data
+        if len(stats.statements) < self.MAX_STATEMENTS:
+            stats.statements.append((statement, duration))
+
+    def connection_raw_execute_error(self, connection, raw_cursor,
+                                     statement, params, error):
+        self.connection_raw_execute_success(connection, raw_cursor,
+                                            statement, params)
+
+
+class _QueryStats(object):
+    def __init__(self):
+        self.count = 0
+        # In seconds
+        self.duration = 0
+        # (statement, duration) tuples
+        self.statements = []
+        self.query_start = None
@@ -23,7 +23,7 @@
 ##
 
 import base64
-import contextlib
+import collections
 import datetime
 import decimal
 import functools
@@ -33,21 +33,22 @@ import os
 import pickle
 import psycopg2
 from queue import Queue
-from threading import Event
+from threading import Condition, Event, Lock
 import uuid
-import io
 import select
+import socket
 import time
 from hashlib import md5
 
-from kiwi.component import provide_utility
 from kiwi.currency import currency
-from flask import Flask, request, session, abort, send_file, make_response, Response
+from flask import (Flask, request, session, abort, make_response, Response,
+                   g, current_app)
 from flask_restful import Api, Resource
+from werkzeug.wsgi import wrap_file
 
 from stoqlib.api import api
 from stoqlib.database.runtime import get_current_station
-from stoqlib.database.interfaces import ICurrentUser
+from stoqlib.domain.devices import DeviceSettings
 from stoqlib.domain.events import SaleConfirmedRemoteEvent
 from stoqlib.domain.image import Image
 from stoqlib.domain.payment.group import PaymentGroup
@@ -55,7 +56,7 @@ from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.card import CreditCardData, CreditProvider, CardPaymentDevice
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.person import LoginUser, Person, Client, ClientCategory
-from stoqlib.domain.product import Product
+from stoqlib.domain.product import Product, ProductStockItem, Storable
 from stoqlib.domain.sale import Sale
 from stoqlib.domain.sellable import (Sellable, SellableCategory,
                                      ClientCategoryPrice)
@@ -69,7 +70,16 @@ from stoqlib.lib.osutils import get_application_dir
 from stoqlib.lib.translation import dgettext
 from stoqlib.lib.threadutils import threadit
 from stoqlib.lib.pluginmanager import get_plugin_manager
-from storm.expr import Desc, LeftJoin, Join
+from storm.expr import And, Desc, LeftJoin, Join, Ne
+from storm.tracer import install_tracer, get_tracers
+
+from stoqserver.lib import metrics, profiler, thumbnails, usercontext
+from stoqserver.lib.admission import Lane
+from stoqserver.lib.imagestore import ImageStore
+from stoqserver.lib.lrucache import LRUCache
+from stoqserver.lib.querytracer import QueryTracer
+from stoqserver.lib.sessionstore import SessionStore
+from stoqserver.lib.storepool import PoolTimeout, StorePool
 
 _ = lambda s: dgettext('stoqserver', s)
 
@@ -82,52 +92,433 @@ except ImportError:
     has_ntk = False
     ntk = None
 
-_last_gc = None
 _expire_time = datetime.timedelta(days=1)
-_session = None
+_session_store = None
+_session_store_lock = Lock()
+_store_pool = None
+_store_pool_lock = Lock()
+_thumbnail_store = None
+_image_store = None
+# The channel to the other processes when running with multiple workers.
+# See run_flaskworker
+_worker_channel = None
+# The sessions created by this worker waiting to be journaled by the
+# leader, mapped to an Event set when that happens. See LoginResource
+_pending_sessions = {}
+# How many seconds a login waits for the leader to journal its session
+SESSION_REPLICATION_TIMEOUT = 5
+# The last metrics sent by each of the other workers, so any of them can
+# export the metrics of all the processes. They are sent every
+# METRICS_INTERVAL seconds, see _send_metrics
+_worker_metrics = {}
+METRICS_INTERVAL = 5
 log = logging.getLogger(__name__)
 
+_request_latency = metrics.registry.histogram(
+    'stoqserver_http_request_duration_seconds',
+    'Time spent handling the requests', ['route', 'method'])
+_requests = metrics.registry.counter(
+    'stoqserver_http_requests_total',
+    'Requests handled', ['route', 'method', 'status'])
+_requests_in_flight = metrics.registry.gauge(
+    'stoqserver_http_requests_in_flight',
+    'Requests being handled', ['route'])
+_request_size = metrics.registry.histogram(
+    'stoqserver_http_request_size_bytes',
+    'Size of the request bodies', ['route'], buckets=metrics.SIZE_BUCKETS)
+_response_size = metrics.registry.histogram(
+    'stoqserver_http_response_size_bytes',
+    'Size of the response bodies', ['route'], buckets=metrics.SIZE_BUCKETS)
+_workers_running = metrics.registry.gauge(
+    'stoqserver_workers_running',
+    'Background workers running', ['worker'])
+_worker_errors = metrics.registry.counter(
+    'stoqserver_worker_errors_total',
+    'Background workers that stopped because of an error', ['worker'])
+_worker_iterations = metrics.registry.histogram(
+    'stoqserver_worker_iteration_duration_seconds',
+    'Time spent in each iteration of the background workers', ['worker'])
+_request_queries = metrics.registry.histogram(
+    'stoqserver_http_request_queries',
+    'Database queries executed by the requests', ['route'],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 1000))
+_request_db_time = metrics.registry.histogram(
+    'stoqserver_http_request_db_duration_seconds',
+    'Time the requests spent waiting for the database', ['route'])
+
+_query_tracer = QueryTracer()
+# Requests taking more than this number of seconds are logged with the
+# statements they executed. Can be configured by 'slowrequestthreshold'
+# in the config. A threshold of 0 disables the log.
+SLOW_REQUEST_THRESHOLD = 2
+
+# The (concurrency, max queue) of each lane of requests, see Lane. The
+# high priority lane is not limited, and the other ones together should not
+# take all the stores of the pool, so there's always one left for a sale.
+# A concurrency of 0 in the config means the lane is not limited either
+LANES = {
+    'high': (None, 0),
+    'normal': (4, 16),
+    'low': (4, 16),
+}
+LANE_TIMEOUT = 10
+# Seconds the clients should wait before retrying a rejected request
+LANE_RETRY_AFTER = 5
+
 TRANSPARENT_PIXEL = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII='  # nopep8
 
 WORKERS = []
 
 
+class _DataCache(object):
+    """A cache for the data served by :class:`DataResource`
+
+    This caches both the serialized documents and each one of the sections
+    they are built from. Those are invalidated by
+    :meth:`DataResource._postgres_listen` every time one of the
+    :attr:`DataResource.watch_tables` changes, but only the sections that
+    depend on the changed tables are discarded. While nobody is listening
+    for those changes the cache stays disabled, since there would be no way
+    to know when an entry got stale.
+
+    Each invalidation also generates a new :attr:`.version` of the data,
+    and what changed on it is kept for the last :attr:`.MAX_CHANGES`
+    versions so that clients can be sent only what changed since the
+    version they have.
+    """
+
+    MAX_CHANGES = 500
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self._sections = {}
+        self._changes = collections.deque(maxlen=self.MAX_CHANGES)
+        # Versions generated by another process should never be considered valid
+        self._token = uuid.uuid4().hex[:8]
+        self._generation = 0
+        self.enabled = False
+
+    @property
+    def version(self):
+        """The current version of the data"""
+        with self._lock:
+            return self._get_version()
+
+    def get(self, key):
+        """Get the entry cached for key
+
+        :returns: a tuple with the entry (or ``None`` if there's none) and the
+            current generation, which should be passed to :meth:`.set`
+        """
+        with self._lock:
+            entry = self._entries.get(key) if self.enabled else None
+            return entry, self._generation
+
+    def set(self, key, generation, entry):
+        """Cache entry for key
+
+        The entry will be discarded if the cache got invalidated after
+        *generation* was obtained, since it could have been built with
+        stale data.
+        """
+        with self._lock:
+            if self.enabled and generation == self._generation:
+                self._entries[key] = entry
+
+    def get_sections(self):
+        """Get the cached sections
+
+        :returns: a tuple with a dict mapping the name of the sections to their
+            data and the current generation, which should be passed
+            to :meth:`.set_sections`
+        """
+        with self._lock:
+            sections = dict(self._sections) if self.enabled else {}
+            return sections, self._generation
+
+    def set_sections(self, generation, sections):
+        """Cache the data of the given sections
+
+        Like :meth:`.set`, the sections will be discarded if the cache got
+        invalidated after *generation* was obtained.
+        """
+        with self._lock:
+            if self.enabled and generation == self._generation:
+                self._sections.update(sections)
+
+    def invalidate(self, sections=None, sellable_ids=None, category_ids=None,
+                   availability=None):
+        """Invalidate the cache, generating a new version of the data
+
+        :param sections: the names of the sections that changed. ``None``
+            means that all of them changed and a full snapshot is needed
+        :param sellable_ids: the ids of the sellables that changed
+        :param category_ids: the ids of the categories that changed. If both
+            this and *sellable_ids* are ``None`` while the categories section
+            changed, the change cannot be described by a delta
+        :param availability: if only the stock of the sellables changed,
+            a dict mapping their ids to their new availability. The cached
+            categories will be updated with it instead of being discarded
+        """
+        with self._lock:
+            self._invalidate(sections, sellable_ids, category_ids, availability)
+
+    def sync(self, version, enabled, **changes):
+        """Replicate an invalidation done by the cache of another process
+
+        :param version: the version of the other cache after the invalidation
+        :param enabled: if the other cache is enabled
+        :param changes: the arguments given to :meth:`.invalidate`
+        """
+        token, generation = version.rsplit('-', 1)
+        generation = int(generation)
+        with self._lock:
+            if token == self._token and generation == self._generation + 1:
+                self._invalidate(**changes)
+            elif token != self._token or generation != self._generation:
+                # Some invalidations were missed (e.g. this process just
+                # started), so there's no way to tell what changed
+                self._token = token
+                self._generation = generation - 1
+                self._changes.clear()
+                self._invalidate()
+            self.enabled = enabled
+
+    def get_changes(self, since):
+        """Get what changed since the given version
+
+        :returns: a tuple with the current version, the ids of the sellables
+            and the categories that changed and the names of the other
+            sections that changed, or ``None`` if there's no way to tell what
+            changed and a full snapshot is needed
+        """
+        with self._lock:
+            if not self.enabled:
+                return None
+
+            try:
+                token, generation = since.rsplit('-', 1)
+                generation = int(generation)
+            except ValueError:
+                return None
+            if token != self._token or generation > self._generation:
+                return None
+
+            sellable_ids = set()
+            category_ids = set()
+            sections = set()
+            if generation < self._generation:
+                # The log needs to contain all versions after the given one
+                if not self._changes or self._changes[0][0] > generation + 1:
+                    return None
+                for change_generation, changes in self._changes:
+                    if change_generation <= generation:
+                        continue
+                    if changes is None:
+                        return None
+                    sellable_ids.update(changes[0])
+                    category_ids.update(changes[1])
+                    sections.update(changes[2])
+
+            return self._get_version(), sellable_ids, category_ids, sections
+
+    def _get_version(self):
+        return '%s-%d' % (self._token, self._generation)
+
+    def _invalidate(self, sections=None, sellable_ids=None, category_ids=None,
+                    availability=None):
+        self._generation += 1
+        self._entries.clear()
+
+        if sections is None:
+            self._sections.clear()
+            self._changes.append((self._generation, None))
+            return
+
+        for name in sections:
+            if name == 'categories' and availability is not None:
+                self._update_availability(sellable_ids, availability)
+            else:
+                self._sections.pop(name, None)
+
+        if ('categories' in sections and
+                sellable_ids is None and category_ids is None):
+            changes = None
+        else:
+            changes = (set(sellable_ids or []), set(category_ids or []),
+                       set(sections) - {'categories'})
+        self._changes.append((self._generation, changes))
+
+    def _update_availability(self, sellable_ids, availability):
+        categories = self._sections.get('categories')
+        if categories is None:
+            return
+
+        sellable_ids = set(sellable_ids)
+        pending = list(categories)
+        while pending:
+            category = pending.pop()
+            pending.extend(category['children'])
+            for product in category['products']:
+                if product['id'] in sellable_ids:
+                    # Replacing the value will not disturb someone serializing
+                    # the categories in another thread
+                    product['availability'] = availability.get(product['id'], {})
+
+
+_data_cache = _DataCache()
+
+# The etag, data and mimetype of the images, by their sellable id and
+# is_main. Its size can be configured by 'imagecachesize' (in bytes)
+IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+_image_cache = LRUCache(IMAGE_CACHE_SIZE)
+
+
+def _broadcast_cache_changes(**changes):
+    # Make the caches of the other workers follow the changes in this one
+    if _worker_channel is not None:
+        _worker_channel.broadcast(
+            ('data_cache', _data_cache.version, _data_cache.enabled, changes))
+
+
+def _invalidate_image_cache(sellable_ids=None, broadcast=True):
+    """Invalidate the images of the given sellables, or all of them"""
+    keys = None
+    if sellable_ids is not None:
+        keys = [(sellable_id, is_main) for sellable_id in sellable_ids
+                for is_main in [True, False]]
+    _image_cache.invalidate(keys)
+
+    if broadcast and _worker_channel is not None:
+        _worker_channel.broadcast(('image_cache', sellable_ids))
+
+
+@functools.lru_cache()
 def _get_user_hash():
+    # USER_HASH never changes for a database, no need to read it all the time
     return md5(
         api.sysparam.get_string('USER_HASH').encode('UTF-8')).hexdigest()
 
 
-@contextlib.contextmanager
-def _get_session():
-    global _session
-    global _last_gc
+@functools.lru_cache()
+def _get_station_id():
+    # The station this server is running on never changes either
+    with _get_store_pool().store() as store:
+        station = get_current_station(store)
+        return station.id if station else None
+
+
+def _get_session_store():
+    global _session_store
+
+    with _session_store_lock:
+        if _session_store is not None:
+            return _session_store
+
+        # Indexing some session data by the USER_HASH will help to avoid
+        # maintaining sessions between two different databases. This could lead to
+        # some errors in the POS in which the user making the sale does not exist.
+        session_file = os.path.join(
+            get_application_dir(), 'session-{}'.format(_get_user_hash()))
+
+        # When running with multiple workers, only the leader writes the
+        # journal and the sessions are replicated through it
+        if _worker_channel is None:
+            store = SessionStore(session_file + '.journal',
+                                 _expire_time.total_seconds())
+        elif _worker_channel.is_leader:
+            store = SessionStore(
+                session_file + '.journal', _expire_time.total_seconds(),
+                callback=lambda entry: _worker_channel.broadcast(('session', entry)))
+        else:
+            store = SessionStore(
+                session_file + '.journal', _expire_time.total_seconds(),
+                readonly=True,
+                callback=lambda entry: _worker_channel.send(('session', entry)))
 
-    # Indexing some session data by the USER_HASH will help to avoid
-    # maintaining sessions between two different databases. This could lead to
-    # some errors in the POS in which the user making the sale does not exist.
-    session_file = os.path.join(
-        get_application_dir(), 'session-{}.db'.format(_get_user_hash()))
-    if os.path.exists(session_file):
-        with open(session_file, 'rb') as f:
+        # Migrate the sessions from the old pickled session file
+        if not store.readonly and os.path.exists(session_file + '.db'):
             try:
-                _session = pickle.load(f)
+                with open(session_file + '.db', 'rb') as f:
+                    old_sessions = pickle.load(f)
             except Exception:
-                _session = {}
-    else:
-        _session = {}
+                old_sessions = {}
 
-    # From time to time remove old entries from the session dict
-    now = localnow()
-    if now - (_last_gc or datetime.datetime.min) > _expire_time:
-        for k, v in list(_session.items()):
-            if now - v['date'] > _expire_time:
-                del _session[k]
-        _last_gc = localnow()
+            # The sessions keep their dates, so the expired ones are dropped
+            for session_id, data in old_sessions.items():
+                store.add(session_id, data['user_id'],
+                          date=data['date'].timestamp())
+            os.unlink(session_file + '.db')
 
-    yield _session
+        _session_store = store
+        return _session_store
 
-    with open(session_file, 'wb') as f:
-        pickle.dump(_session, f)
+
+def _get_store_pool():
+    global _store_pool
+
+    with _store_pool_lock:
+        if _store_pool is not None:
+            return _store_pool
+
+        config = get_config()
+
+        def get_option(name, default):
+            return float((config and config.get('General', name)) or default)
+
+        # Use a lambda so the store is created by whatever api.new_store is
+        # at the time (e.g. mocked by the tests)
+        _store_pool = StorePool(
+            lambda: api.new_store(),
+            max_size=int(get_option('storepoolsize', 10)),
+            max_lifetime=get_option('storepoolmaxlifetime', 30 * 60),
+            check_interval=get_option('storepoolcheckinterval', 30),
+            timeout=get_option('storepooltimeout', 30))
+        return _store_pool
+
+
+def _get_thumbnail_store():
+    global _thumbnail_store
+
+    # Creating it twice is harmless, no need for a lock
+    if _thumbnail_store is None:
+        _thumbnail_store = thumbnails.ThumbnailStore(
+            os.path.join(get_application_dir(), 'thumbnails'))
+    return _thumbnail_store
+
+
+def _get_image_store():
+    global _image_store
+
+    # Creating it twice is harmless, no need for a lock
+    if _image_store is None:
+        # The thumbnails of the removed images will never be used again
+        _image_store = ImageStore(os.path.join(get_application_dir(), 'images'),
+                                  on_remove=_get_thumbnail_store().remove)
+    return _image_store
+
+
+def _get_request_store():
+    """Get the store for the current request
+
+    The store is taken from the pool on the first call and shared by the
+    decorators and the resource handling the request, so only one connection
+    is used per request. It will be released to the pool (and anything not
+    committed by :func:`_store_provider` rolled back) when the request finishes.
+    """
+    if 'store' not in g:
+        try:
+            g.store = _get_store_pool().acquire()
+        except PoolTimeout as e:
+            abort(503, str(e))
+    return g.store
+
+
+def _close_request_store(exception=None):
+    store = g.pop('store', None)
+    if store is not None:
+        _get_store_pool().release(store)
 
 
 def _login_required(f):
@@ -137,22 +528,33 @@ def _login_required(f):
         if session_id is None:
             abort(401, 'No session id provided in header')
 
-        with _get_session() as s:
-            session_data = s.get(session_id, None)
-            if session_data is None:
-                abort(401, 'Session does not exist')
-
-            if localnow() - session_data['date'] > _expire_time:
-                abort(401, 'Session expired')
-
-            # Refresh last date to avoid it expiring while being used
-            session_data['date'] = localnow()
-            session['user_id'] = session_data['user_id']
-            with api.new_store() as store:
-                user = store.get(LoginUser, session['user_id'])
-                provide_utility(ICurrentUser, user, replace=True)
-
-        return f(*args, **kwargs)
+        session_store = _get_session_store()
+        session_data = session_store.get(session_id)
+        if session_data is None and session_store.readonly:
+            # The session could have just been created by another worker,
+            # with its replication still on the way
+            session_store.refresh()
+            session_data = session_store.get(session_id)
+        if session_data is None:
+            abort(401, 'Session does not exist')
+
+        if time.time() - session_data['date'] > session_store.expire_time:
+            abort(401, 'Session expired')
+
+        # Refresh last date to avoid it expiring while being used
+        session_store.touch(session_id)
+        session['user_id'] = session_data['user_id']
+
+        # StoqTransactionHistory will use the current user to set the
+        # responsible for the stock change. The objects are also stamped with
+        # it when committed, so this must be the outermost decorator (the last
+        # one in method_decorators) when used with _store_provider. The user
+        # is only loaded if needed, so requests answered from the caches
+        # don't need a store
+        user_id = session_data['user_id']
+        with usercontext.lazy_current_user(
+                lambda: _get_request_store().get(LoginUser, user_id)):
+            return f(*args, **kwargs)
 
     return wrapper
 
@@ -160,12 +562,18 @@ def _login_required(f):
 def _store_provider(f):
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        with api.new_store() as store:
-            try:
-                return f(store, *args, **kwargs)
-            except Exception as e:
-                store.retval = False
-                abort(500, str(e))
+        # This store is shared with _login_required. It will be committed here
+        # and rolled back in case of errors when released on teardown
+        store = _get_request_store()
+        try:
+            retval = f(store, *args, **kwargs)
+        except Exception as e:
+            store.retval = False
+            abort(500, str(e))
+
+        if store.retval:
+            store.commit(close=False)
+        return retval
 
     return wrapper
 
@@ -176,13 +584,126 @@ def worker(f):
     Usefull for regular checks that should be made on the server that will require warning the
     client
     """
-    WORKERS.append(f)
-    return f
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        _workers_running.inc(worker=f.__name__)
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            _worker_errors.inc(worker=f.__name__)
+            raise
+        finally:
+            _workers_running.dec(worker=f.__name__)
+
+    WORKERS.append(wrapper)
+    return wrapper
+
+
+def _get_route():
+    # Use the rule instead of the path, so that /image/<id> is a single route
+    return request.url_rule.rule if request.url_rule is not None else 'unknown'
+
+
+def _start_request_metrics():
+    g.request_start = time.monotonic()
+    _requests_in_flight.inc(route=_get_route())
+
+
+def _finish_request_metrics(response):
+    route = _get_route()
+    if 'request_start' in g:
+        _request_latency.observe(time.monotonic() - g.request_start,
+                                 route=route, method=request.method)
+    _requests.inc(route=route, method=request.method, status=response.status_code)
+    if request.content_length is not None:
+        _request_size.observe(request.content_length, route=route)
+    # Streamed responses don't have a length
+    length = response.calculate_content_length()
+    if length is not None:
+        _response_size.observe(length, route=route)
+    return response
+
+
+def _end_request_metrics(exception=None):
+    if 'request_start' in g:
+        _requests_in_flight.dec(route=_get_route())
+
+
+def _get_lanes():
+    config = get_config()
+    lanes = {}
+    for name, (concurrency, max_queue) in LANES.items():
+        if config:
+            concurrency = config.get('General', name + 'laneconcurrency') or concurrency
+            max_queue = config.get('General', name + 'lanequeue') or max_queue
+        if concurrency is not None and int(concurrency) <= 0:
+            concurrency = None
+        lanes[name] = Lane(
+            name, concurrency=concurrency and int(concurrency),
+            max_queue=int(max_queue), timeout=LANE_TIMEOUT)
+    return lanes
+
+
+def _admit_request():
+    # CORS preflights are answered by flask itself without touching the
+    # database, they should not take the place of the actual request
+    if request.method == 'OPTIONS':
+        return
+
+    view = (current_app.view_functions.get(request.url_rule.endpoint)
+            if request.url_rule is not None else None)
+    name = getattr(getattr(view, 'view_class', None), 'lane', None)
+    if name is None:
+        return
+
+    lane = current_app.config['LANES'][name]
+    if not lane.acquire():
+        response = make_response(_('The server is busy, try again later'), 503)
+        response.headers['Retry-After'] = str(LANE_RETRY_AFTER)
+        return response
+    g.lane = lane
+
+
+def _release_request(exception=None):
+    lane = g.pop('lane', None)
+    if lane is not None:
+        lane.release()
+
+
+def _start_query_tracing():
+    _query_tracer.start()
+
+
+def _finish_query_tracing(response):
+    stats = _query_tracer.stop()
+    if stats is None:
+        return response
+
+    route = _get_route()
+    _request_queries.observe(stats.count, route=route)
+    _request_db_time.observe(stats.duration, route=route)
+
+    if current_app.debug:
+        response.headers['X-Stoq-Queries'] = str(stats.count)
+        response.headers['X-Stoq-Query-Time'] = '%.6f' % (stats.duration, )
+
+    threshold = current_app.config['SLOW_REQUEST_THRESHOLD']
+    duration = time.monotonic() - g.request_start if 'request_start' in g else 0
+    if threshold and duration > threshold:
+        statements = '\n'.join('  [%.6fs] %s' % (statement_duration, statement)
+                               for statement, statement_duration in stats.statements)
+        log.warning('Slow request: %s %s took %.3fs, %d queries took %.3fs:\n%s',
+                    request.method, request.path, duration, stats.count,
+                    stats.duration, statements)
+    return response
 
 
 class _BaseResource(Resource):
 
     routes = []
+    #: The lane of the requests, see LANES. ``None`` if they should not be
+    #: limited at all
+    lane = 'normal'
 
     def get_arg(self, attr, default=None):
         """Get the attr from querystring, form data or json"""
@@ -226,40 +747,274 @@ class DataResource(_BaseResource):
     """All the data the POS needs RESTful resource."""
 
     routes = ['/data']
-    method_decorators = [_login_required, _store_provider]
+    lane = 'low'
+    # The store is only created when the data needs to be rebuilt
+    method_decorators = [_login_required]
+
+    # The sections of the data returned by get_data, mapped to the method
+    # that builds them and the tables they depend on (directly or indirectly)
+    sections = collections.OrderedDict([
+        ('branch', ('_get_branch', ['branch'])),
+        ('branch_station', ('_get_branch_station', ['branch_station'])),
+        ('user', ('_get_user', ['login_user'])),
+        ('categories', ('_get_categories', ['sellable', 'product', 'storable',
+                                            'product_stock_item', 'sellable_category',
+                                            'client_category_price'])),
+        ('payment_methods', ('_get_payment_methods', ['payment_method'])),
+        ('providers', ('_get_card_providers', ['credit_provider'])),
+        ('staff_id', ('_get_staff_id', ['client_category'])),
+    ])
+
+    # The sections that depend on the user making the request. Those are not
+    # cached, nor pushed to the clients when they change
+    user_sections = {'user'}
 
     # All the tables get_data uses (directly or indirectly)
-    watch_tables = ['sellable', 'product', 'storable', 'product_stock_item', 'branch_station',
-                    'branch', 'login_user', 'sellable_category', 'client_category_price',
-                    'payment_method', 'credit_provider']
+    watch_tables = set().union(*[tables for getter, tables in sections.values()])
+
+    # The tables that can have their changes sent as deltas, mapped to the
+    # kind of object they affect and the column pointing to it
+    delta_tables = {
+        'sellable': ('sellable', 'id'),
+        'product': ('sellable', 'id'),
+        'storable': ('sellable', 'id'),
+        'product_stock_item': ('sellable', 'storable_id'),
+        'client_category_price': ('sellable', 'sellable_id'),
+        'sellable_category': ('category', 'id'),
+    }
+
+    # Changes are coalesced until no notifications arrive for QUIET_PERIOD
+    # seconds, but never delayed for more than MAX_DELAY seconds. Those can
+    # be configured by 'dataquietperiod' and 'datamaxdelay' in the config
+    QUIET_PERIOD = 0.5
+    MAX_DELAY = 5
+
+    # How many notifications the listener received and how many updates
+    # they generated
+    listener_stats = {'notifications': 0, 'updates': 0}
 
     @worker
     def _postgres_listen():
+        config = get_config()
+        quiet_period = float((config and config.get('General', 'dataquietperiod')) or
+                             DataResource.QUIET_PERIOD)
+        max_delay = float((config and config.get('General', 'datamaxdelay')) or
+                          DataResource.MAX_DELAY)
+        stats = DataResource.listener_stats
+
         store = api.new_store()
         conn = store._connection._raw_connection
         conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         cursor = store._connection.build_raw_cursor()
         cursor.execute("LISTEN update_te;")
 
-        message = False
-        while True:
-            if select.select([conn], [], [], 5) != ([], [], []):
-                conn.poll()
-                while conn.notifies:
-                    notify = conn.notifies.pop(0)
-                    te_id, table = notify.payload.split(',')
-                    # Update the data the client has when one of those changes
-                    message = message or table in DataResource.watch_tables
-
-            if message:
-                EventStream.put({
-                    'type': 'SERVER_UPDATE_DATA',
-                    'data': DataResource.get_data(store)
-                })
-                message = False
+        # Copy the images to the disk, so they can be served from there while
+        # the caches are enabled. Any change from now on will be notified
+        _get_image_store().sync(store)
+        _get_thumbnail_store().prune(_get_image_store().get_digests())
+
+        # Now that we will be notified of any changes, it is safe to cache the
+        # data
+        _data_cache.invalidate()
+        _data_cache.enabled = True
+        _broadcast_cache_changes()
+        _invalidate_image_cache()
+
+        changes = {}
+        first_change = last_change = None
+        try:
+            while True:
+                if changes:
+                    deadline = min(last_change + quiet_period, first_change + max_delay)
+                    timeout = max(0, deadline - time.monotonic())
+                else:
+                    timeout = 5
+
+                if select.select([conn], [], [], timeout) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        stats['notifications'] += 1
+                        te_id, table = notify.payload.split(',')
+                        # Update the data the client has when one of those changes
+                        if (table not in DataResource.watch_tables and
+                                table != 'image'):
+                            continue
+
+                        changes.setdefault(table, set()).add(int(te_id))
+                        last_change = time.monotonic()
+                        if first_change is None:
+                            first_change = last_change
+
+                if not changes:
+                    continue
+
+                # A burst of changes (e.g. a price import) will generate lots of
+                # notifications. Wait for it to finish before updating the clients
+                now = time.monotonic()
+                if (now < last_change + quiet_period and
+                        now < first_change + max_delay):
+                    continue
+
+                with _worker_iterations.time(worker='_postgres_listen'):
+                    DataResource._notify_changes(store, changes)
+                stats['updates'] += 1
+                log.debug('Data updated after %d notifications (%d updates so far)',
+                          stats['notifications'], stats['updates'])
+                changes = {}
+                first_change = last_change = None
+        finally:
+            _data_cache.enabled = False
+            _broadcast_cache_changes()
+
+    @classmethod
+    def _get_changed_ids(cls, store, changes):
+        """Get the ids of the sellables and categories affected by changes
+
+        :param changes: a dict mapping the tables that changed to the te_id
+            of their changed rows
+        :returns: a tuple with the ids of the sellables and the categories,
+            or ``(None, None)`` if the changes cannot be sent as a delta
+        """
+        ids = {'sellable': set(), 'category': set()}
+        for table, te_ids in changes.items():
+            if table not in cls.delta_tables:
+                return None, None
+
+            kind, column = cls.delta_tables[table]
+            # table and column are not user input, they came from delta_tables
+            query = "SELECT {} FROM {} WHERE te_id IN ({})".format(
+                column, table, ', '.join('?' * len(te_ids)))
+            rows = store.execute(query, params=list(te_ids)).get_all()
+            # If a row is missing, it was deleted and we don't know what it was
+            if len(rows) != len(te_ids):
+                return None, None
+            ids[kind].update(row[0] for row in rows)
+
+        return ids['sellable'], ids['category']
+
+    @classmethod
+    def _notify_changes(cls, store, changes):
+        changes = dict(changes)
+        image_te_ids = changes.pop('image', None)
+        if image_te_ids is not None:
+            ImageResource.invalidate(store, image_te_ids)
+            if not changes:
+                return
+
+        since = _data_cache.version
+        sections = [name for name, (getter, tables) in cls.sections.items()
+                    if not set(tables).isdisjoint(changes)]
+        catalog_changes = {table: te_ids for table, te_ids in changes.items()
+                           if table in cls.delta_tables}
+        sellable_ids, category_ids = cls._get_changed_ids(store, catalog_changes)
+
+        # When only the stock changed, there's no need to rebuild the
+        # categories. Just update the availability of the affected products
+        availability = None
+        if sellable_ids is not None and set(catalog_changes) == {'product_stock_item'}:
+            # The storable id is the same as its sellable id
+            availability = cls._get_stock_items(store, list(sellable_ids))
+
+        _data_cache.invalidate(sections, sellable_ids, category_ids, availability)
+        _broadcast_cache_changes(sections=sections, sellable_ids=sellable_ids,
+                                 category_ids=category_ids, availability=availability)
+
+        # There's no current user here, and the clients don't all have the
+        # same one, so they will get the user sections on their next request
+        delta = cls.get_delta(store, since, user_sections=False)
+        if delta is not None:
+            EventStream.put({
+                'type': 'SERVER_UPDATE_DATA_DELTA',
+                'data': delta,
+            })
+        else:
+            EventStream.put({
+                'type': 'SERVER_UPDATE_DATA',
+                'data': cls.get_data(store, user_sections=False),
+            })
+
+    @classmethod
+    def _get_category_prices(cls, store, sellable_ids=None):
+        # ClientCategoryPrice data, indexed by the sellable id
+        query = []
+        if sellable_ids is not None:
+            query.append(ClientCategoryPrice.sellable_id.is_in(sellable_ids))
+
+        prices = {}
+        for sellable_id, category_id, price in store.find(
+                (ClientCategoryPrice.sellable_id, ClientCategoryPrice.category_id,
+                 ClientCategoryPrice.price), *query):
+            prices.setdefault(sellable_id, {})[category_id] = str(price)
+        return prices
+
+    @classmethod
+    def _get_stock_items(cls, store, storable_ids=None):
+        # ProductStockItem data, indexed by the storable id
+        query = []
+        if storable_ids is not None:
+            query.append(ProductStockItem.storable_id.is_in(storable_ids))
+
+        stock = {}
+        for storable_id, branch_id, quantity in store.find(
+                (ProductStockItem.storable_id, ProductStockItem.branch_id,
+                 ProductStockItem.quantity), *query):
+            stock.setdefault(storable_id, {})[branch_id] = str(quantity)
+        return stock
+
+    @classmethod
+    def _get_products(cls, store, sellable_ids=None):
+        """Get the data of the available sellables
+
+        Everything is fetched using a fixed number of queries, no matter how
+        many sellables there are, instead of walking the references of each
+        sellable.
+
+        :param sellable_ids: if not ``None``, restrict the results to those ids
+        :returns: a list of ``(category_id, product_data)`` tuples, ordered
+            the way they should be presented inside their categories
+        """
+        tables = [Sellable,
+                  LeftJoin(Product, Product.id == Sellable.id),
+                  LeftJoin(Storable, Storable.id == Product.id)]
+        query = And(Sellable.status == Sellable.STATUS_AVAILABLE,
+                    Ne(Sellable.category_id, None))
+        if sellable_ids is not None:
+            query = And(query, Sellable.id.is_in(sellable_ids))
+
+        results = list(store.using(*tables).find(
+            (Sellable, Product, Storable), query).order_by(
+                Product.height, Sellable.description))
+        if sellable_ids is None:
+            category_prices = cls._get_category_prices(store)
+            stock_items = cls._get_stock_items(store)
+        else:
+            category_prices = cls._get_category_prices(
+                store, [s.id for s, p, st in results])
+            stock_items = cls._get_stock_items(
+                store, [st.id for s, p, st in results if st is not None])
+
+        products = []
+        for s, product, storable in results:
+            products.append((s.category_id, {
+                'id': s.id,
+                'description': s.description,
+                'price': str(s.price),
+                'order': str(product.height),
+                'category_prices': category_prices.get(s.id, {}),
+                'color': product.part_number,
+                'availability': (
+                    product and storable and stock_items.get(storable.id, {})
+                )
+            }))
+        return products
 
     @classmethod
     def _get_categories(cls, store):
+        products = {}
+        for category_id, product in cls._get_products(store):
+            products.setdefault(category_id, []).append(product)
+
         categories_root = []
         aux = {}
         # SellableCategory and Sellable/Product data
@@ -280,31 +1035,7 @@ class DataResource(_BaseResource):
             })
             c_dict.setdefault('children', [])
             products_list = c_dict.setdefault('products', [])
-
-            tables = [Sellable, LeftJoin(Product, Product.id == Sellable.id)]
-            sellables = store.using(*tables).find(
-                Sellable, category=c, status='available').order_by('height', 'description')
-            for s in sellables:
-                ccp = store.find(ClientCategoryPrice, sellable_id=s.id)
-                ccp_dict = {}
-                for item in ccp:
-                    ccp_dict[item.category_id] = str(item.price)
-
-                products_list.append({
-                    'id': s.id,
-                    'description': s.description,
-                    'price': str(s.price),
-                    'order': str(s.product.height),
-                    'category_prices': ccp_dict,
-                    'color': s.product.part_number,
-                    'availability': (
-                        s.product and s.product.storable and
-                        {
-                            si.branch.id: str(si.quantity)
-                            for si in s.product.storable.get_stock_items()
-                        }
-                    )
-                })
+            products_list.extend(products.get(c.id, []))
 
             aux[c.id] = c_dict
         return categories_root
@@ -337,7 +1068,48 @@ class DataResource(_BaseResource):
         return providers
 
     @classmethod
-    def get_data(cls, store):
+    def _get_branch(cls, store):
+        return api.get_current_branch(store).id
+
+    @classmethod
+    def _get_branch_station(cls, store):
+        return get_current_station(store).name
+
+    @classmethod
+    def _get_user(cls, store):
+        user = api.get_current_user(store)
+        return user and user.username
+
+    @classmethod
+    def _get_staff_id(cls, store):
+        staff_category = store.find(ClientCategory, ClientCategory.name == 'Staff').one()
+        return staff_category.id if staff_category else None
+
+    @classmethod
+    def _get_sections(cls, store, names):
+        """Get the data of the given sections
+
+        Only the sections that are not cached will be built.
+        """
+        cached, generation = _data_cache.get_sections()
+        retval = collections.OrderedDict()
+        built = {}
+        for name in names:
+            if name in cached:
+                retval[name] = cached[name]
+                continue
+
+            getter, tables = cls.sections[name]
+            retval[name] = getattr(cls, getter)(store)
+            # The user is different for each request, so it cannot be shared
+            if name not in cls.user_sections:
+                built[name] = retval[name]
+
+        _data_cache.set_sections(generation, built)
+        return retval
+
+    @classmethod
+    def get_data(cls, store, user_sections=True):
         """Returns all data the POS needs to run
 
         This includes:
@@ -347,26 +1119,98 @@ class DataResource(_BaseResource):
         - What categories it has
             - What sellables those categories have
                 - The stock amount for each sellable (if it controls stock)
+        - The version of the data, to be used with :meth:`.get_delta`
+
+        :param user_sections: if the sections that depend on the current
+            user should be included
         """
-        station = get_current_station(store)
-        user = api.get_current_user(store)
-        staff_category = store.find(ClientCategory, ClientCategory.name == 'Staff').one()
+        # Get the version before the data, so that if something changes while
+        # we build it, the client will be updated later
+        retval = dict(version=_data_cache.version)
+        retval.update(cls._get_sections(store, [
+            name for name in cls.sections
+            if user_sections or name not in cls.user_sections]))
+        return retval
 
-        # Current branch data
-        retval = dict(
-            branch=api.get_current_branch(store).id,
-            branch_station=station.name,
-            user=user and user.username,
-            categories=cls._get_categories(store),
-            payment_methods=cls._get_payment_methods(store),
-            providers=cls._get_card_providers(store),
-            staff_id=staff_category.id if staff_category else None,
-        )
+    @classmethod
+    def get_delta(cls, store, since, user_sections=True):
+        """Returns what changed in the POS data since the given version
 
-        return retval
+        The delta contains:
 
-    def get(self, store):
-        return self.get_data(store)
+        - The new version of the data and the one it was generated from
+        - The changed products (with the id of the category they are in)
+        - The ids of the products that should be removed
+        - The changed categories (with the id of their parent)
+        - The other sections of the data that changed (e.g. payment_methods)
+
+        :param since: the version the client has, as returned by :meth:`.get_data`
+        :param user_sections: like in :meth:`.get_data`
+        :returns: the delta or ``None`` if the client is too far behind and
+            needs the full snapshot
+        """
+        changes = _data_cache.get_changes(since)
+        if changes is None:
+            return None
+
+        version, sellable_ids, category_ids, sections = changes
+        products = []
+        if sellable_ids:
+            for category_id, product in cls._get_products(store, list(sellable_ids)):
+                product['category_id'] = category_id
+                products.append(product)
+
+        categories = []
+        if category_ids:
+            for c in store.find(SellableCategory,
+                                SellableCategory.id.is_in(list(category_ids))):
+                categories.append({
+                    'id': c.id,
+                    'description': c.description,
+                    'parent_id': c.category_id,
+                })
+
+        # Products that are not available anymore (or were moved out of any
+        # category) will not be returned by _get_products
+        removed = sellable_ids - set(p['id'] for p in products)
+        return dict(
+            version=version,
+            since=since,
+            products=products,
+            removed_products=sorted(removed),
+            categories=categories,
+            sections=cls._get_sections(
+                store, [name for name in cls.sections if name in sections and
+                        (user_sections or name not in cls.user_sections)]),
+        )
+
+    def get(self):
+        since = request.args.get('since')
+        if since is not None:
+            delta = self.get_delta(_get_request_store(), since)
+            # If there is no delta to send, fallback to the full snapshot
+            if delta is not None:
+                return delta
+
+        # get_data depends on the current user. Everything else is the same
+        # for all requests made to this server
+        key = session['user_id']
+        entry, generation = _data_cache.get(key)
+        if entry is None:
+            payload = json.dumps(self.get_data(_get_request_store())).encode()
+            entry = (md5(payload).hexdigest(), payload)
+            _data_cache.set(key, generation, entry)
+
+        etag, payload = entry
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = make_response(payload)
+            response.headers.set('Content-Type', 'application/json')
+        response.set_etag(etag)
+        # Make sure the browser always revalidates the data with us
+        response.headers.set('Cache-Control', 'no-cache')
+        return response
 
 
 class PrinterException(Exception):
@@ -377,6 +1221,7 @@ class DrawerResource(_BaseResource):
     """Drawer RESTful resource."""
 
     routes = ['/drawer']
+    lane = 'high'
     method_decorators = [_login_required]
 
     @classmethod
@@ -402,16 +1247,17 @@ class DrawerResource(_BaseResource):
         # Check every second if it is opened.
         # Alert only if changes.
         while True:
-            if not is_open and DrawerResource._is_open():
-                is_open = True
-                EventStream.put({
-                    'type': 'DRAWER_ALERT_OPEN',
-                })
-            elif is_open and not DrawerResource._is_open():
-                is_open = False
-                EventStream.put({
-                    'type': 'DRAWER_ALERT_CLOSE',
-                })
+            with _worker_iterations.time(worker='check_drawer_loop'):
+                if not is_open and DrawerResource._is_open():
+                    is_open = True
+                    EventStream.put({
+                        'type': 'DRAWER_ALERT_OPEN',
+                    }, station_id=_get_station_id())
+                elif is_open and not DrawerResource._is_open():
+                    is_open = False
+                    EventStream.put({
+                        'type': 'DRAWER_ALERT_CLOSE',
+                    }, station_id=_get_station_id())
             time.sleep(1)
 
     def get(self):
@@ -431,11 +1277,60 @@ class PingResource(_BaseResource):
     """Ping RESTful resource."""
 
     routes = ['/ping']
+    lane = None
 
     def get(self):
         return 'pong from stoqserver'
 
 
+class MetricsResource(_BaseResource):
+    """Metrics of the server, in the Prometheus text format"""
+
+    routes = ['/metrics']
+    lane = None
+
+    def get(self):
+        # When running with multiple workers, export the metrics of all of them
+        collected = [metrics.registry.collect()]
+        collected.extend(families for worker_id, families
+                         in sorted(_worker_metrics.items()))
+        return Response(metrics.render(collected),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ProfileResource(_BaseResource):
+    """Profile the server for some seconds
+
+    The stacks of all the threads of this process are sampled and returned
+    in the collapsed format, ready to be turned into a flamegraph. Only
+    admins can do this.
+    """
+
+    routes = ['/profile']
+    lane = None
+    method_decorators = [_login_required]
+
+    def get(self):
+        user = _get_request_store().get(LoginUser, session['user_id'])
+        if not user.profile.check_app_permission('admin'):
+            return make_response(_('User does not have permission'), 403)
+
+        try:
+            seconds = float(request.args.get('seconds', 10))
+            interval = float(request.args.get('interval', profiler.DEFAULT_INTERVAL))
+        except ValueError:
+            abort(400, 'Invalid seconds or interval')
+
+        # Don't keep a connection from the pool while sampling
+        _close_request_store()
+        try:
+            stacks = profiler.profile(seconds, interval)
+        except profiler.ProfilerError as e:
+            return make_response(str(e), 409)
+
+        return Response(stacks, content_type='text/plain; charset=utf-8')
+
+
 def format_cpf(document):
     return '%s.%s.%s-%s' % (document[0:3], document[3:6], document[6:9],
                             document[9:11])
@@ -456,7 +1351,8 @@ def format_document(document):
 class TillResource(_BaseResource):
     """Till RESTful resource."""
     routes = ['/till']
-    method_decorators = [_login_required]
+    lane = 'high'
+    method_decorators = [_store_provider, _login_required]
 
     def _open_till(self, store, initial_cash_amount=0):
         station = get_current_station(store)
@@ -526,37 +1422,35 @@ class TillResource(_BaseResource):
 
         return payment_data
 
-    def post(self):
+    def post(self, store):
         data = request.get_json()
-        with api.new_store() as store:
-            # Provide responsible
-            if data['operation'] == 'open_till':
-                self._open_till(store, data['initial_cash_amount'])
-            elif data['operation'] == 'close_till':
-                self._close_till(store, data['till_summaries'])
-            elif data['operation'] in ['debit_entry', 'credit_entry']:
-                self._add_credit_or_debit_entry(store, data)
+        # Provide responsible
+        if data['operation'] == 'open_till':
+            self._open_till(store, data['initial_cash_amount'])
+        elif data['operation'] == 'close_till':
+            self._close_till(store, data['till_summaries'])
+        elif data['operation'] in ['debit_entry', 'credit_entry']:
+            self._add_credit_or_debit_entry(store, data)
 
         return 200
 
-    def get(self):
+    def get(self, store):
         # Retrieve Till data
-        with api.new_store() as store:
-            till = Till.get_last(store)
-
-            if not till:
-                return None
+        till = Till.get_last(store)
 
-            till_data = {
-                'status': till.status,
-                'opening_date': till.opening_date.strftime('%Y-%m-%d'),
-                'closing_date': (till.closing_date.strftime('%Y-%m-%d') if
-                                 till.closing_date else None),
-                'initial_cash_amount': str(till.initial_cash_amount),
-                'final_cash_amount': str(till.final_cash_amount),
-                # Get payments data that will be used on 'close_till' action.
-                'entry_types': till.status == 'open' and self._get_till_summary(store, till) or [],
-            }
+        if not till:
+            return None
+
+        till_data = {
+            'status': till.status,
+            'opening_date': till.opening_date.strftime('%Y-%m-%d'),
+            'closing_date': (till.closing_date.strftime('%Y-%m-%d') if
+                             till.closing_date else None),
+            'initial_cash_amount': str(till.initial_cash_amount),
+            'final_cash_amount': str(till.final_cash_amount),
+            # Get payments data that will be used on 'close_till' action.
+            'entry_types': till.status == 'open' and self._get_till_summary(store, till) or [],
+        }
 
         return till_data
 
@@ -564,6 +1458,7 @@ class TillResource(_BaseResource):
 class ClientResource(_BaseResource):
     """Client RESTful resource."""
     routes = ['/client']
+    lane = 'low'
 
     def _dump_client(self, client):
         person = client.person
@@ -618,11 +1513,11 @@ class ClientResource(_BaseResource):
     def post(self):
         data = request.get_json()
 
-        with api.new_store() as store:
-            if data.get('doc'):
-                return self._get_by_doc(store, data, data['doc'])
-            elif data.get('category_name'):
-                return self._get_by_category(store, data['category_name'])
+        store = _get_request_store()
+        if data.get('doc'):
+            return self._get_by_doc(store, data, data['doc'])
+        elif data.get('category_name'):
+            return self._get_by_category(store, data['category_name'])
         return data
 
 
@@ -635,22 +1530,29 @@ class LoginResource(_BaseResource):
         username = self.get_arg('user')
         pw_hash = self.get_arg('pw_hash')
 
-        with api.new_store() as store:
-            try:
-                # FIXME: Respect the branch the user is in.
-                user = LoginUser.authenticate(store, username, pw_hash, current_branch=None)
-                # StoqTransactionHistory will use the current user to set the
-                # responsible for the stock change
-                provide_utility(ICurrentUser, user, replace=True)
-            except LoginError as e:
-                abort(403, str(e))
-
-        with _get_session() as s:
-            session_id = str(uuid.uuid1()).replace('-', '')
-            s[session_id] = {
-                'date': localnow(),
-                'user_id': user.id
-            }
+        store = _get_request_store()
+        try:
+            # FIXME: Respect the branch the user is in.
+            user = LoginUser.authenticate(store, username, pw_hash, current_branch=None)
+        except LoginError as e:
+            abort(403, str(e))
+
+        session_id = str(uuid.uuid1()).replace('-', '')
+        if _worker_channel is None or _worker_channel.is_leader:
+            _get_session_store().add(session_id, user.id)
+            return session_id
+
+        # The next requests can go to any worker, so wait for the leader to
+        # journal the session. The others will find it there even if they
+        # didn't receive it yet
+        journaled = _pending_sessions[session_id] = Event()
+        try:
+            _get_session_store().add(session_id, user.id)
+            if not journaled.wait(SESSION_REPLICATION_TIMEOUT):
+                log.warning("Session %s was not replicated in %d seconds",
+                            session_id, SESSION_REPLICATION_TIMEOUT)
+        finally:
+            _pending_sessions.pop(session_id, None)
 
         return session_id
 
@@ -662,7 +1564,7 @@ class AuthResource(_BaseResource):
     """
 
     routes = ['/auth']
-    method_decorators = [_login_required, _store_provider]
+    method_decorators = [_store_provider, _login_required]
 
     def post(self, store):
         username = self.get_arg('user')
@@ -680,42 +1582,364 @@ class AuthResource(_BaseResource):
         return make_response(_('User does not have permission'), 403)
 
 
+# An event already encoded as a SSE frame, shared by all the queues.
+# The id is encoded separately to avoid copying the frame
+_Event = collections.namedtuple(
+    '_Event', ['id', 'type', 'topic', 'station_id', 'frame'])
+
+
+class EventQueue(object):
+    """A bounded queue of events for one of the :class:`EventStream` clients
+
+    Queues are registered with :meth:`EventStream.subscribe` and receive the
+    events already encoded as SSE frames. A queue can be restricted to some
+    topics (see :attr:`EventStream.TOPICS`) and to the events of a station.
+
+    When the queue is full, the oldest event is dropped to give space to the
+    new one. Also, some events supersede the ones queued before them (e.g. a
+    SERVER_UPDATE_DATA contains everything the queued data updates had), and
+    those are removed from the queue when the new event arrives.
+    """
+
+    MAX_SIZE = 100
+
+    # Event types mapped to the types of the events they supersede
+    SUPERSEDES = {
+        'SERVER_UPDATE_DATA': {'SERVER_UPDATE_DATA', 'SERVER_UPDATE_DATA_DELTA'},
+    }
+
+    def __init__(self, maxsize=MAX_SIZE, topics=None, station_id=None):
+        """
+        :param maxsize: the maximum number of events in the queue
+        :param topics: if not ``None``, only events of those topics will
+            be accepted
+        :param station_id: if not ``None``, events of other stations
+            will not be accepted
+        """
+        self.maxsize = maxsize
+        self.topics = topics
+        self.station_id = station_id
+        self.dropped = 0
+        # The id of the last event dropped to give space to the new ones
+        self._dropped_id = None
+        self._events = collections.deque()
+        self._cond = Condition()
+
+    def __len__(self):
+        return len(self._events)
+
+    def accepts(self, event):
+        """Check if the event should be put in this queue
+
+        Events without a topic or a station are accepted by all queues
+        """
+        if (self.topics is not None and event.topic is not None and
+                event.topic not in self.topics):
+            return False
+        if (self.station_id is not None and event.station_id is not None and
+                event.station_id != self.station_id):
+            return False
+        return True
+
+    def put(self, event):
+        with self._cond:
+            superseded = self.SUPERSEDES.get(event.type)
+            if superseded:
+                events = [e for e in self._events if e.type not in superseded]
+                self.dropped += len(self._events) - len(events)
+                self._events = collections.deque(events)
+
+            if len(self._events) >= self.maxsize:
+                dropped = self._events.popleft()
+                self.dropped += 1
+                if dropped.id is not None:
+                    self._dropped_id = dropped.id
+
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None):
+        """Get the next event
+
+        :param block: if ``False``, return ``None`` instead of waiting for an
+            event when the queue is empty
+        :param timeout: if not ``None``, the maximum number of seconds to
+            wait for an event before returning ``None``
+        """
+        with self._cond:
+            if block and not self._events:
+                self._cond.wait_for(lambda: self._events, timeout)
+            return self._events.popleft() if self._events else None
+
+    def get_events_after(self, event_id):
+        """Get the queued events with an id greater than event_id
+
+        :returns: a tuple with the events and a flag telling if some of the
+            events after event_id were dropped from the queue
+        """
+        with self._cond:
+            lost = self._dropped_id is not None and self._dropped_id > event_id
+            return [e for e in self._events
+                    if e.id is not None and e.id > event_id], lost
+
+
 class EventStream(_BaseResource):
     """A stream of events from this server to the application.
 
     Callsites can use EventStream.put(event) to send a message from the server to the client
     asynchronously.
 
-    Note that there should be only one client connected at a time. If more than one are connected,
-    all of them will receive all events
+    Each event has an id and the last :attr:`.REPLAY_SIZE` events are kept, so that
+    a client reconnecting with a Last-Event-ID header (or a last_event_id argument)
+    will receive the events it lost while it was disconnected. If some of them are
+    not kept anymore, a SERVER_EVENTS_LOST event is sent before the others, and the
+    client should fetch its data again.
+
+    Clients can subscribe to some topics only (e.g. /stream?topics=tef,drawer) and to the events
+    of one station (/stream?station=<id>). Events are routed to the clients here, so a client
+    will not receive events it is not interested in.
     """
     _streams = []
+    _lock = Lock()
+    # Held while sending the events to the other workers, see _add_event
+    _broadcast_lock = Lock()
+
+    REPLAY_SIZE = 100
+    _replay = EventQueue(maxsize=REPLAY_SIZE)
+
+    # A SSE comment is sent to the clients when no events are sent for
+    # HEARTBEAT_INTERVAL seconds, so proxies don't drop idle connections and
+    # we find out that a client went away when writing to it fails, which
+    # reclaims its stream. It can be configured by 'streamheartbeat' in
+    # the config.
+    HEARTBEAT = b': keepalive\n\n'
+    HEARTBEAT_INTERVAL = 15
+    # A half-open connection is only noticed when the kernel gives up
+    # retransmitting the heartbeats, which can take a long time. If
+    # 'streamwritetimeout' is set in the config, connections with data not
+    # acknowledged by the client for that many seconds are closed (the
+    # browser will reconnect and replay the events after its last one).
+    # Quiet clients are still acknowledging the heartbeats, so they are
+    # not affected. Disabled by default
+    WRITE_TIMEOUT = 0
+    _last_id = 0
+    # The id of the first event this process received. The ones before it
+    # can't be replayed (e.g. by a restarted worker)
+    _first_id = None
+    # Ids generated by another process should not be replayed
+    _token = uuid.uuid4().hex[:8]
+
+    # The topic of each event type
+    TOPICS = {
+        'SERVER_UPDATE_DATA': 'data',
+        'SERVER_UPDATE_DATA_DELTA': 'data',
+        'DRAWER_ALERT_OPEN': 'drawer',
+        'DRAWER_ALERT_CLOSE': 'drawer',
+        'TEF_DISPLAY_MESSAGE': 'tef',
+        'TEF_ASK_QUESTION': 'tef',
+        'TEF_OPERATION_FINISHED': 'tef',
+    }
 
     routes = ['/stream']
+    lane = None
+
+    @classmethod
+    def _encode(cls, data, event_id=None, station_id=None):
+        event_type = data.get('type') if isinstance(data, dict) else None
+        frame = ("data: " + json.dumps(data) + "\n\n").encode()
+        return _Event(event_id, event_type, cls.TOPICS.get(event_type),
+                      station_id, frame)
+
+    @classmethod
+    def _parse_event_id(cls, value):
+        try:
+            token, event_id = value.rsplit('-', 1)
+            event_id = int(event_id)
+        except (AttributeError, ValueError):
+            return None
+        return event_id if token == cls._token else None
+
+    @classmethod
+    def put(cls, data, station_id=None):
+        """Send an event to the clients
+
+        :param data: the event data. Its ``type`` defines its topic
+        :param station_id: the id of the station the event refers to, if the
+            clients of other stations should not receive it
+        """
+        # Encode the event only once, no matter how many streams there are
+        event = cls._encode(data, station_id=station_id)
+        if _worker_channel is not None and not _worker_channel.is_leader:
+            # The leader numbers the events and sends them to all the workers
+            _worker_channel.send(('event', event))
+        else:
+            cls._add_event(event)
+
+    @classmethod
+    def _add_event(cls, event):
+        if event.id is None and _worker_channel is not None:
+            # Writing to the pipes can block when they are full, so this is not
+            # done with the lock of the streams held. The events are still
+            # numbered, sent and queued in the order of their ids
+            with cls._broadcast_lock:
+                # The sequence survives the leader being restarted
+                event = event._replace(id=_worker_channel.next_id())
+                _worker_channel.broadcast(('event', event))
+                cls._queue_event(event)
+        else:
+            cls._queue_event(event)
+
+    @classmethod
+    def _queue_event(cls, event):
+        with cls._lock:
+            if event.id is None:
+                event = event._replace(id=cls._last_id + 1)
+            cls._last_id = event.id
+            if cls._first_id is None:
+                cls._first_id = event.id
+            cls._replay.put(event)
+
+            # Put event in the streams. This is done inside the lock to make
+            # sure they will receive the events in the order of their ids
+            for stream in cls._streams:
+                if stream.accepts(event):
+                    stream.put(event)
+
+    @classmethod
+    def get_stats(cls):
+        """Get the number of connected clients and the state of their queues"""
+        with cls._lock:
+            streams = cls._streams[:]
+
+        return {
+            'subscribers': len(streams),
+            'queued_events': sum(len(stream) for stream in streams),
+            'max_queue_depth': max([len(stream) for stream in streams] or [0]),
+            'dropped_events': sum(stream.dropped for stream in streams),
+            'last_event_id': cls._last_id,
+        }
+
+    @classmethod
+    def get_heartbeat_interval(cls):
+        """Get the interval between the heartbeats, in seconds"""
+        config = get_config()
+        # Tests don't have a config set
+        if not config:
+            return cls.HEARTBEAT_INTERVAL
+
+        return float(config.get('General', 'streamheartbeat') or
+                     cls.HEARTBEAT_INTERVAL)
+
+    @classmethod
+    def get_write_timeout(cls):
+        """Get the write timeout in seconds, or 0 if it is disabled"""
+        config = get_config()
+        # Tests don't have a config set
+        if not config:
+            return cls.WRITE_TIMEOUT
+
+        return float(config.get('General', 'streamwritetimeout') or
+                     cls.WRITE_TIMEOUT)
+
+    @classmethod
+    def set_write_timeout(cls, sock):
+        """Apply the write timeout to a socket
+
+        The kernel will close the connection when the data written to it is
+        not acknowledged in time. When set on a listening socket, all the
+        connections accepted by it get the timeout too.
+        """
+        timeout = cls.get_write_timeout()
+        if not timeout:
+            return
+        if not hasattr(socket, 'TCP_USER_TIMEOUT'):
+            log.warning("The stream write timeout is not supported in this platform")
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                        int(timeout * 1000))
+
+    @classmethod
+    def get_queue_args(cls, args):
+        """Get the :class:`EventQueue` arguments from the request arguments
+
+        :param args: a dict with the request arguments
+        :returns: a dict with the ``topics`` and ``station_id`` arguments
+        """
+        topics = args.get('topics')
+        if topics is not None:
+            topics = set(t.strip() for t in topics.split(',') if t.strip())
+        return {'topics': topics, 'station_id': args.get('station') or None}
+
+    @classmethod
+    def subscribe(cls, stream, last_event_id=None):
+        """Subscribe a stream to receive the events
+
+        :param stream: an :class:`EventQueue`
+        :param last_event_id: the id of the last event the client received,
+            as sent in the Last-Event-ID header. The events after it will be
+            replayed to the stream
+        """
+        # If we dont put one event, the event stream does not seem to get stabilished in the browser
+        stream.put(cls._encode(json.dumps({})))
+
+        last_id = cls._parse_event_id(last_event_id)
+        with cls._lock:
+            if last_event_id:
+                if last_id is None:
+                    # The id came from a process that is gone, we don't know
+                    # what happened after it
+                    events, lost = [], True
+                else:
+                    events, lost = cls._replay.get_events_after(last_id)
+                    # Or this process didn't see some of the events after it
+                    lost = lost or cls._first_id is None or last_id < cls._first_id - 1
+                if lost:
+                    # The client was away for too long. Tell it to get
+                    # everything again, and send what we still have
+                    stream.put(cls._encode({'type': 'SERVER_EVENTS_LOST'}))
+                for event in events:
+                    if stream.accepts(event):
+                        stream.put(event)
+            cls._streams.append(stream)
 
     @classmethod
-    def put(cls, data):
-        # Put event in all streams
-        for stream in cls._streams:
-            stream.put(data)
+    def unsubscribe(cls, stream):
+        with cls._lock:
+            cls._streams.remove(stream)
+
+    @classmethod
+    def get_chunks(cls, event):
+        """Get the chunks of bytes that should be sent to the client for event"""
+        if event.id is None:
+            return [event.frame]
+        return [('id: %s-%d\n' % (cls._token, event.id)).encode(), event.frame]
 
     def _loop(self, stream):
+        heartbeat = self.get_heartbeat_interval()
         while True:
-            data = stream.get()
-            yield "data: " + json.dumps(data) + "\n\n"
+            event = stream.get(timeout=heartbeat)
+            if event is not None:
+                yield from self.get_chunks(event)
+            else:
+                # If the client went away, writing this will fail and the
+                # response will be closed, unsubscribing the stream
+                yield self.HEARTBEAT
 
     def get(self):
-        stream = Queue()
-        self._streams.append(stream)
+        stream = EventQueue(**self.get_queue_args(request.args))
+        self.subscribe(stream, request.headers.get(
+            'Last-Event-ID', request.args.get('last_event_id')))
 
-        # If we dont put one event, the event stream does not seem to get stabilished in the browser
-        stream.put(json.dumps({}))
-        return Response(self._loop(stream), mimetype="text/event-stream")
+        response = Response(self._loop(stream), mimetype="text/event-stream")
+        # The server closes the response when the client disconnects
+        response.call_on_close(lambda: self.unsubscribe(stream))
+        return response
 
 
 if has_ntk:
     class TefResource(_BaseResource):
         routes = ['/tef']
+        lane = 'high'
         method_decorators = [_login_required]
 
         waiting_reply = Event()
@@ -749,7 +1973,7 @@ if has_ntk:
             EventStream.put({
                 'type': 'TEF_DISPLAY_MESSAGE',
                 'message': message
-            })
+            }, station_id=_get_station_id())
 
         def _question_callback(self, questions):
             # Right now we support asking only one question at a time. This could be imporved
@@ -757,7 +1981,7 @@ if has_ntk:
             EventStream.put({
                 'type': 'TEF_ASK_QUESTION',
                 'data': info.get_dict()
-            })
+            }, station_id=_get_station_id())
             if info.data_type not in [PwDat.MENU, PwDat.TYPED]:
                 # This is just an information for the user. No need to wait for a reply.
                 return True
@@ -785,7 +2009,7 @@ if has_ntk:
                     'type': 'TEF_OPERATION_FINISHED',
                     'success': False,
                     'message': 'Erro comunicando com a impressora',
-                })
+                }, station_id=_get_station_id())
                 return
 
             data = request.get_json()
@@ -820,35 +2044,282 @@ if has_ntk:
                 'type': 'TEF_OPERATION_FINISHED',
                 'success': retval,
                 'message': message,
-            })
+            }, station_id=_get_station_id())
 
 
 class ImageResource(_BaseResource):
     """Image RESTful resource."""
 
     routes = ['/image/<id>']
+    lane = 'low'
+
+    @classmethod
+    def invalidate(cls, store, te_ids):
+        """Update the images that changed in the disk and in the cache
+
+        :param te_ids: the te_id of the changed rows of the image table
+        """
+        # The cache must be invalidated after the disk is updated, or the old
+        # images could end up in the cache again
+        sellable_ids = _get_image_store().sync(store, list(te_ids))
+        _invalidate_image_cache(sellable_ids)
+
+        # Have the thumbnails ready before the clients ask for them
+        if thumbnails.has_pil and sellable_ids:
+            threadit(cls._make_thumbnails, sellable_ids)
+
+    @classmethod
+    def _make_thumbnails(cls, sellable_ids):
+        image_store = _get_image_store()
+        thumbnail_store = _get_thumbnail_store()
+        for sellable_id in sellable_ids:
+            for is_main in [True, False]:
+                image = image_store.read(sellable_id, is_main)
+                if image is not None:
+                    thumbnail_store.make_all(*image)
+
+    @classmethod
+    def get_images(cls, store, sellable_ids, is_main):
+        """Get the images of some sellables
+
+        The images not in the cache are fetched using a single query.
+
+        :returns: a dict mapping the sellable ids to a tuple with the etag,
+            the data and the mimetype of their image. A transparent pixel is
+            used for the sellables without images
+        """
+        # The cache is only valid while we are being notified of changes
+        # in the images (see DataResource._notify_changes)
+        entries = {}
+        generations = {}
+        for sellable_id in sellable_ids:
+            entry, generation = (_image_cache.get((sellable_id, is_main))
+                                 if _data_cache.enabled else (None, None))
+            if entry is not None:
+                entries[sellable_id] = entry
+            else:
+                generations[sellable_id] = generation
+
+        if not generations:
+            return entries
 
-    def get(self, id):
-        is_main = bool(request.args.get('is_main', None))
         # FIXME: The images should store tags so they could be requested by that tag and
         # product_id. At the moment, we simply check if the image is main or not and
         # return the first one.
-        with api.new_store() as store:
-            image = store.find(Image, sellable_id=id, is_main=is_main).any()
-
-            if image:
-                return send_file(io.BytesIO(image.image), mimetype='image/png')
+        images = {}
+        if _data_cache.enabled:
+            # The disk is kept up to date while the cache is enabled
+            image_store = _get_image_store()
+            for sellable_id in generations:
+                image = image_store.read(sellable_id, is_main)
+                if image is not None:
+                    images[sellable_id] = image[1]
+        else:
+            # Pick the same image ImageStore does, so the cache being enabled
+            # or not doesn't change what is served
+            query = And(Image.sellable_id.is_in(list(generations)),
+                        Image.is_main == is_main,
+                        Ne(Image.image, None))
+            for image in store.find(Image, query).order_by(Image.id):
+                images.setdefault(image.sellable_id, image.image)
+
+        for sellable_id, generation in generations.items():
+            data = images.get(sellable_id)
+            if data:
+                data, mimetype = data, 'image/png'
             else:
-                response = make_response(base64.b64decode(TRANSPARENT_PIXEL))
-                response.headers.set('Content-Type', 'image/jpeg')
+                data, mimetype = base64.b64decode(TRANSPARENT_PIXEL), 'image/jpeg'
+
+            entry = entries[sellable_id] = (md5(data).hexdigest(), data, mimetype)
+            if generation is not None:
+                _image_cache.set((sellable_id, is_main), generation, entry, len(data))
+        return entries
+
+    @classmethod
+    def get_thumbnail(cls, etag, data, width):
+        """Get a thumbnail of an image returned by :meth:`.get_images`
+
+        :returns: a tuple like the ones of :meth:`.get_images`, or ``None``
+            if the original image should be used
+        """
+        if not thumbnails.has_pil:
+            return None
+
+        size = thumbnails.get_size(width)
+        if size is None:
+            return None
+
+        # The thumbnails are identified by the hash of their original image,
+        # so they never need to be invalidated. An empty entry means the
+        # original image should be used
+        key = (etag, size)
+        entry, generation = _image_cache.get(key)
+        if entry is not None:
+            return entry or None
+
+        thumbnail = _get_thumbnail_store().get(etag, data, size)
+        if thumbnail is None:
+            _image_cache.set(key, generation, (), 1)
+            return None
+
+        entry = ('%s-%d' % (etag, size), ) + thumbnail
+        _image_cache.set(key, generation, entry, len(thumbnail[0]))
+        return entry
+
+    def _send_file(self, etag, path):
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.headers.set('Cache-Control', 'no-cache')
+            return response
+
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            # The image changed while we were about to send it
+            return None
+
+        size = os.fstat(f.fileno()).st_size
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if (request.range is not None and len(request.range.ranges) == 1 and
+                (not if_range or if_range.strip('"') == etag)):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                f.close()
+                response = make_response('', 416)
+                response.headers.set('Content-Range', 'bytes */%d' % (size, ))
                 return response
 
+        if byte_range is not None:
+            start, stop = byte_range
+            f.seek(start)
+            data = f.read(stop - start)
+            f.close()
+            response = make_response(data, 206)
+            response.headers.set('Content-Range',
+                                 'bytes %d-%d/%d' % (start, stop - 1, size))
+        else:
+            # The server will use sendfile to send it if it can
+            response = Response(wrap_file(request.environ, f), direct_passthrough=True)
+            response.headers.set('Content-Length', str(size))
+
+        response.headers.set('Content-Type', 'image/png')
+        response.headers.set('Accept-Ranges', 'bytes')
+        response.set_etag(etag)
+        response.headers.set('Cache-Control', 'no-cache')
+        return response
+
+    def get(self, id):
+        is_main = bool(request.args.get('is_main', None))
+        try:
+            id = str(uuid.UUID(id))
+        except ValueError:
+            abort(400, 'Invalid id')
+
+        # Smaller versions of the image can be requested with ?w=<width>
+        width = request.args.get('w', type=int)
+
+        # Send the file directly from the disk if we can
+        found = _get_image_store().get_path(id, is_main) if _data_cache.enabled else None
+        if found is not None and not width:
+            response = self._send_file(*found)
+            if response is not None:
+                return response
+
+        etag, data, mimetype = self.get_images(_get_request_store(), [id], is_main)[id]
+        # Making the thumbnail can take a while, release the connection before
+        _close_request_store()
+
+        if width:
+            thumbnail = self.get_thumbnail(etag, data, width)
+            if thumbnail is not None:
+                etag, data, mimetype = thumbnail
+
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = make_response(data)
+            response.headers.set('Content-Type', mimetype)
+        response.set_etag(etag)
+        # Make sure the browser always revalidates the image with us
+        response.headers.set('Cache-Control', 'no-cache')
+        return response
+
+
+class ImageBatchResource(_BaseResource):
+    """Get the images of many sellables at once
+
+    The sellables are given by a comma separated list of ``ids`` or by
+    a ``category`` id, and ``is_main`` and ``w`` work like in
+    :class:`ImageResource`. The images are sent in a multipart/mixed
+    response, one part for each sellable with its id in the Content-ID
+    header (enclosed in angle brackets, as RFC 2392 requires) and the same
+    ETag :class:`ImageResource` would send.
+    """
+
+    routes = ['/images']
+    lane = 'low'
+
+    MAX_IMAGES = 500
+
+    def _get_parts(self, images, boundary):
+        for sellable_id, (etag, data, mimetype) in images.items():
+            headers = [
+                ('Content-Type', mimetype),
+                ('Content-ID', '<%s>' % (sellable_id, )),
+                ('ETag', '"%s"' % (etag, )),
+                ('Content-Length', str(len(data))),
+            ]
+            yield ('--%s\r\n' % (boundary, )).encode()
+            yield ''.join('%s: %s\r\n' % header for header in headers).encode()
+            yield b'\r\n' + data + b'\r\n'
+        yield ('--%s--\r\n' % (boundary, )).encode()
+
+    def get(self):
+        is_main = bool(request.args.get('is_main', None))
+        width = request.args.get('w', type=int)
+        category_id = request.args.get('category')
+
+        try:
+            # Avoid sending garbage to the database
+            sellable_ids = [str(uuid.UUID(i)) for i in
+                            request.args.get('ids', '').split(',') if i]
+            if category_id:
+                category_id = str(uuid.UUID(category_id))
+        except ValueError:
+            abort(400, 'Invalid id')
+
+        store = _get_request_store()
+        if category_id:
+            sellable_ids = list(store.find(Sellable.id, category_id=category_id))
+        if len(sellable_ids) > self.MAX_IMAGES:
+            abort(400, 'No more than %d images can be requested at once' % (
+                self.MAX_IMAGES, ))
+        images = ImageResource.get_images(store, sellable_ids, is_main)
+
+        # Keep the order of the request
+        images = collections.OrderedDict(
+            (sellable_id, images[sellable_id]) for sellable_id in sellable_ids)
+        if width:
+            # Make the thumbnails here, while the request is still in its
+            # lane, instead of while the response is being streamed
+            for sellable_id, (etag, data, mimetype) in images.items():
+                thumbnail = ImageResource.get_thumbnail(etag, data, width)
+                if thumbnail is not None:
+                    images[sellable_id] = thumbnail
+
+        boundary = uuid.uuid4().hex
+        return Response(self._get_parts(images, boundary),
+                        mimetype='multipart/mixed; boundary=' + boundary)
+
 
 class SaleResource(_BaseResource):
     """Sellable category RESTful resource."""
 
     routes = ['/sale']
-    method_decorators = [_login_required, _store_provider]
+    lane = 'high'
+    method_decorators = [_store_provider, _login_required]
 
     PROVIDER_MAP = {
         'ELO CREDITO': 'ELO',
@@ -873,7 +2344,57 @@ class SaleResource(_BaseResource):
             provider = CreditProvider(store=store, short_name=name, provider_id=name)
         return provider
 
+    #: The longest Idempotency-Key accepted
+    IDEMPOTENCY_KEY_MAX_LENGTH = 255
+    #: For how long a sale can be retried with the same Idempotency-Key.
+    #: This also keeps the search for the key restricted to the recent sales
+    IDEMPOTENCY_KEY_MAX_AGE = datetime.timedelta(days=1)
+
+    def _get_idempotent_sale(self, store, key):
+        # Only one request with the same key can go on at a time. The lock is
+        # released when the transaction ends, so a retry made after that will
+        # already see the sale committed by the previous request
+        locked = store.execute("SELECT pg_try_advisory_xact_lock(hashtext(?))",
+                               params=[key]).get_one()[0]
+        if not locked:
+            return None, True
+
+        row = store.execute(
+            "SELECT sale.id, te.metadata->>'idempotency_hash' FROM sale "
+            "JOIN transaction_entry te ON te.id = sale.te_id "
+            "WHERE sale.open_date >= ? AND te.metadata->>'idempotency_key' = ?",
+            params=[localnow() - self.IDEMPOTENCY_KEY_MAX_AGE, key]).get_one()
+        return row, False
+
+    def _get_payload_hash(self, data):
+        # The same sale could be encoded with the keys in another order
+        return md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
     def post(self, store):
+        # The clients can safely retry a sale by sending the same key again.
+        # The key is saved with the sale, so it is only there if the sale was
+        # committed, in which case it is not done again
+        key = request.headers.get('Idempotency-Key')
+        if key is not None:
+            if not key or len(key) > self.IDEMPOTENCY_KEY_MAX_LENGTH:
+                return make_response(_('Invalid idempotency key'), 400)
+
+            payload_hash = self._get_payload_hash(request.get_json())
+            sale, in_progress = self._get_idempotent_sale(store, key)
+            if in_progress:
+                response = make_response(
+                    _('A sale with this idempotency key is being processed'), 409)
+                response.headers['Retry-After'] = str(LANE_RETRY_AFTER)
+                return response
+            if sale is not None:
+                sale_id, sale_hash = sale
+                # Sales made before the hash was saved don't have it
+                if sale_hash is not None and sale_hash != payload_hash:
+                    return make_response(
+                        _('The idempotency key was used by another sale'), 422)
+                log.info('Sale %s already made with idempotency key %s', sale_id, key)
+                return True, 200, {'Idempotent-Replayed': 'true'}
+
         self.test_printer()
 
         data = request.get_json()
@@ -908,6 +2429,10 @@ class SaleResource(_BaseResource):
             open_date=localnow(),
             coupon_id=None,
         )
+        if key is not None:
+            # Saved in the same transaction as the sale
+            sale.te.metadata = dict(sale.te.metadata or {}, idempotency_key=key,
+                                    idempotency_hash=payload_hash)
         # Add products
         for p in products:
             sellable = store.get(Sellable, p['id'])
@@ -990,6 +2515,35 @@ def bootstrap_app():
     for cls in _BaseResource.__subclasses__():
         flask_api.add_resource(cls, *cls.routes)
 
+    # Requests run in parallel, each one with its own current user
+    usercontext.install()
+
+    app.before_request(_start_request_metrics)
+    app.after_request(_finish_request_metrics)
+    app.teardown_request(_end_request_metrics)
+
+    # Don't let the low priority requests take all the threads and stores
+    app.config['LANES'] = _get_lanes()
+    app.before_request(_admit_request)
+    app.teardown_request(_release_request)
+
+    # Teardown functions run in the reverse order, so the store is released
+    # before the request leaves its lane
+    app.teardown_request(_close_request_store)
+
+    # Count the queries of each request
+    if _query_tracer not in get_tracers():
+        install_tracer(_query_tracer)
+    config = get_config()
+    app.config['SLOW_REQUEST_THRESHOLD'] = float(
+        (config and config.get('General', 'slowrequestthreshold')) or
+        SLOW_REQUEST_THRESHOLD)
+    app.before_request(_start_query_tracing)
+    app.after_request(_finish_query_tracing)
+
+    _image_cache.max_size = int(
+        (config and config.get('General', 'imagecachesize')) or IMAGE_CACHE_SIZE)
+
     if has_ntk:
         global ntk
         config = get_config()
@@ -1008,14 +2562,55 @@ def bootstrap_app():
     return app
 
 
-def run_flaskserver(port, debug=False):
+def _collect_stats():
+    stats = EventStream.get_stats()
+    listener_stats = DataResource.listener_stats
+    return [
+        ('stoqserver_events_subscribers', 'gauge',
+         'Clients connected to the event stream', stats['subscribers']),
+        ('stoqserver_events_queued', 'gauge',
+         'Events waiting to be sent to the clients', stats['queued_events']),
+        ('stoqserver_events_max_queue_depth', 'gauge',
+         'Events waiting to be sent to the slowest client', stats['max_queue_depth']),
+        ('stoqserver_events_dropped', 'gauge',
+         'Events dropped from the queues of the connected clients',
+         stats['dropped_events']),
+        ('stoqserver_events_last_id', 'gauge',
+         'The id of the last event', stats['last_event_id']),
+        ('stoqserver_data_notifications_total', 'counter',
+         'Database notifications received by the data listener',
+         listener_stats['notifications']),
+        ('stoqserver_data_updates_total', 'counter',
+         'Data updates sent to the clients', listener_stats['updates']),
+        ('stoqserver_image_cache_hits_total', 'counter',
+         'Images found in the cache', _image_cache.hits),
+        ('stoqserver_image_cache_misses_total', 'counter',
+         'Images not found in the cache', _image_cache.misses),
+        ('stoqserver_image_cache_evictions_total', 'counter',
+         'Images discarded to keep the cache within its size', _image_cache.evictions),
+        ('stoqserver_image_cache_bytes', 'gauge',
+         'Size of the images in the cache', _image_cache.size),
+    ]
+
+
+metrics.registry.add_collector(_collect_stats)
+
+
+def _setup_server(debug, events_port, start_workers=True):
     from stoqlib.lib.environment import configure_locale
     # Force pt_BR for now.
     configure_locale('pt_BR')
 
     # Check drawer in a separated thread
-    for function in WORKERS:
-        threadit(function)
+    if start_workers:
+        for function in WORKERS:
+            threadit(function)
+
+    if events_port is not None:
+        # Serve the events on a separated port too, without needing
+        # a thread for each client
+        from stoqserver.lib.eventserver import run_eventserver
+        threadit(run_eventserver, events_port)
 
     app = bootstrap_app()
     app.debug = debug
@@ -1029,7 +2624,12 @@ def run_flaskserver(port, debug=False):
             origin = request.args.get('origin', request.form.get('origin', '*'))
         response.headers['Access-Control-Allow-Origin'] = origin
         response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'stoq-session, Content-Type'
+        response.headers['Access-Control-Allow-Headers'] = (
+            'stoq-session, Content-Type, Idempotency-Key, If-None-Match, If-Range, '
+            'Last-Event-ID, Range')
+        response.headers['Access-Control-Expose-Headers'] = (
+            'Accept-Ranges, Content-Range, ETag, Idempotent-Replayed, Retry-After, '
+            'X-Stoq-Queries, X-Stoq-Query-Time')
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         return response
 
@@ -1038,4 +2638,117 @@ def run_flaskserver(port, debug=False):
         log.exception('Unhandled Exception: %s', (e))
         return 'bad request!', 500
 
-    app.run('0.0.0.0', port=port, debug=debug, threaded=True)
+    return app
+
+
+def _handle_worker_message(message):
+    kind = message[0]
+    if kind == 'event':
+        # The leader will number the event and send it back to the workers
+        EventStream._add_event(message[1])
+    elif kind == 'session':
+        _get_session_store().apply(message[1])
+        if _worker_channel.is_leader:
+            _worker_channel.broadcast(message)
+        else:
+            # The leader sends it back after journaling it
+            journaled = _pending_sessions.get(message[1]['id'])
+            if journaled is not None:
+                journaled.set()
+    elif kind == 'data_cache':
+        version, enabled, changes = message[1:]
+        _data_cache.sync(version, enabled, **changes)
+    elif kind == 'image_cache':
+        _invalidate_image_cache(message[1], broadcast=False)
+    elif kind == 'metrics':
+        worker_id, families = message[1:]
+        if worker_id != _worker_channel.worker_id:
+            _worker_metrics[worker_id] = families
+        if _worker_channel.is_leader:
+            _worker_channel.broadcast(message)
+    else:
+        raise AssertionError("Unknown message %r" % (message, ))
+
+
+def _send_metrics():
+    # The workers send their metrics to the leader, which sends them (and
+    # its own ones) to all the workers
+    while True:
+        message = ('metrics', _worker_channel.worker_id, metrics.registry.collect())
+        if _worker_channel.is_leader:
+            _worker_channel.broadcast(message)
+        else:
+            _worker_channel.send(message)
+        time.sleep(METRICS_INTERVAL)
+
+
+def get_exclusive_devices():
+    """Get the devices used by this server that only one process can use
+
+    The TEF and the devices of the station (e.g. the printer, which is also
+    used by the drawer) keep their state in the process using them, so they
+    can't be shared by the workers of a prefork server.
+
+    :returns: a list with the names of those devices
+    """
+    devices = []
+    if has_ntk:
+        devices.append('TEF')
+
+    store = api.new_store()
+    try:
+        if not store.find(DeviceSettings, station=get_current_station(store),
+                          is_active=True).is_empty():
+            devices.append('station devices')
+    finally:
+        store.close()
+    return devices
+
+
+def run_flaskserver(port, debug=False, events_port=None):
+    from werkzeug.serving import make_server
+
+    app = _setup_server(debug, events_port)
+    if debug:
+        # Keep the reloader of the development server
+        app.run('0.0.0.0', port=port, debug=debug, threaded=True)
+        return
+
+    server = make_server('0.0.0.0', port, app, threaded=True)
+    EventStream.set_write_timeout(server.socket)
+    server.serve_forever()
+
+
+def run_flaskworker(worker_id, channel, fd, port, debug=False, events_port=None):
+    """Run one of the processes of the flask server
+
+    All the workers accept connections from the same listening socket. Only
+    the leader of the channel runs the :func:`worker` functions and the
+    events server, while the events and the changes to the sessions and
+    to the caches are sent through the channel to the other workers.
+
+    :param worker_id: the id of this worker in the channel
+    :param channel: a :class:`stoqserver.lib.workerchannel.WorkerChannel`
+    :param fd: the file descriptor of the listening socket
+    :param port: the port the socket is bound to
+    """
+    from werkzeug.serving import make_server
+    global _worker_channel, _data_cache
+
+    _worker_channel = channel
+    is_leader = worker_id == channel.LEADER
+    # Each worker has its own metrics
+    metrics.registry.const_labels = [('process', 'worker-%d' % (worker_id, ))]
+    if is_leader:
+        # This may be a restarted leader. Versions of the data generated by
+        # the previous one should not be considered valid by the workers
+        _data_cache = _DataCache()
+    channel.start(worker_id, _handle_worker_message)
+    threadit(_send_metrics)
+
+    app = _setup_server(debug, events_port if is_leader else None,
+                        start_workers=is_leader)
+    server = make_server('0.0.0.0', port, app, threaded=True, fd=fd)
+    EventStream.set_write_timeout(server.socket)
+    log.info("Flask worker %d (pid %d) started", worker_id, os.getpid())
+    server.serve_forever()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SessionStore(object):
+    """Thread-safe storage for the sessions of the REST api
+
+    The sessions are kept in memory, so looking them up is just a dict
+    access. To survive restarts, every change is appended to a journal
+    file, which is replayed when the store is created and compacted from
+    time to time.
+
+    Expired sessions are removed using a heap ordered by their expiration
+    time, so there's no need to scan all the sessions looking for them.
+
+    When more than one process needs the sessions, only one of them should
+    write the journal. The changes can be replicated between them by passing
+    the journal entries given to the *callback* to :meth:`.apply`. Since that
+    is asynchronous, the other ones can also :meth:`.refresh` the sessions
+    from the journal when they don't find one.
+    """
+
+    #: Refreshing a session will only be journaled if its last refresh
+    #: was more than this number of seconds ago
+    TOUCH_THRESHOLD = 60
+
+    #: The journal will be compacted when it has this many entries more
+    #: than the number of sessions
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self, filename, expire_time, readonly=False, callback=None):
+        """
+        :param filename: the journal filename
+        :param expire_time: the number of seconds a session can be left
+            unused before it expires
+        :param readonly: if ``True``, the journal will be loaded but
+            never written
+        :param callback: if not ``None``, it will be called with the journal
+            entry of each change made to the sessions
+        """
+        self.filename = filename
+        self.expire_time = expire_time
+        self.readonly = readonly
+        self.callback = callback
+
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._expiration = []
+        self._journaled = {}
+        self._journal_entries = 0
+        self._journal = None
+        # Where the journal was read up to, see refresh
+        self._journal_id = None
+        self._journal_offset = 0
+
+        self._load()
+
+    #
+    #  Public API
+    #
+
+    def get(self, session_id):
+        """Get the session data
+
+        :returns: a dict with the ``user_id`` and the ``date`` (a timestamp)
+            the session was last used, or ``None`` if there's no such session
+        """
+        with self._lock:
+            self._remove_expired()
+            data = self._sessions.get(session_id)
+            return dict(data) if data is not None else None
+
+    def add(self, session_id, user_id, date=None):
+        """Add a new session for the given user
+
+        :param date: the timestamp the session was last used, or ``None``
+            for now. A session that already expired is not added
+        """
+        if date is None:
+            date = time.time()
+        with self._lock:
+            self._remove_expired()
+            if date + self.expire_time < time.time():
+                return
+            self._set(session_id, {'user_id': user_id, 'date': date})
+
+    def touch(self, session_id):
+        """Refresh the session, to avoid it expiring while being used"""
+        with self._lock:
+            data = self._sessions.get(session_id)
+            if data is None:
+                return
+
+            data['date'] = time.time()
+            if data['date'] - self._journaled[session_id] > self.TOUCH_THRESHOLD:
+                self._set(session_id, data)
+
+    def remove(self, session_id):
+        """Remove the session"""
+        with self._lock:
+            if self._sessions.pop(session_id, None) is not None:
+                del self._journaled[session_id]
+                self._write({'op': 'remove', 'id': session_id})
+
+    def apply(self, entry):
+        """Apply a journal entry given to the callback of another store"""
+        entry = dict(entry)
+        op = entry.pop('op')
+        session_id = entry.pop('id')
+        with self._lock:
+            if op == 'set':
+                self._set(session_id, entry, replicate=False)
+            elif self._sessions.pop(session_id, None) is not None:
+                del self._journaled[session_id]
+                self._write({'op': 'remove', 'id': session_id}, replicate=False)
+
+    def refresh(self):
+        """Read the entries written to the journal by another process
+
+        Only the entries written after the last time the journal was read are
+        applied, unless it was compacted since then. This is meant for
+        readonly stores, when a session is not found because its replicated
+        entry did not arrive yet.
+        """
+        with self._lock:
+            for op, session_id, entry in self._read_journal():
+                if op == 'set':
+                    if self._sessions.get(session_id, {}).get('date', 0) <= entry['date']:
+                        self._set(session_id, entry, replicate=False)
+                elif self._sessions.pop(session_id, None) is not None:
+                    del self._journaled[session_id]
+                    self._write({'op': 'remove', 'id': session_id}, replicate=False)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    #
+    #  Private
+    #
+
+    def _set(self, session_id, data, replicate=True):
+        self._sessions[session_id] = data
+        self._journaled[session_id] = data['date']
+        heapq.heappush(self._expiration,
+                       (data['date'] + self.expire_time, session_id))
+        self._write(dict(data, op='set', id=session_id), replicate=replicate)
+
+    def _remove_expired(self):
+        now = time.time()
+        while self._expiration and self._expiration[0][0] < now:
+            expiration, session_id = heapq.heappop(self._expiration)
+            data = self._sessions.get(session_id)
+            if data is None:
+                continue
+
+            # The session was refreshed after this entry was added. Its newer
+            # journaled date will have a newer entry in the heap, but a touch
+            # that was not journaled needs to be readded.
+            if data['date'] + self.expire_time >= now:
+                if self._journaled[session_id] + self.expire_time <= expiration:
+                    heapq.heappush(self._expiration,
+                                   (data['date'] + self.expire_time, session_id))
+                continue
+
+            del self._sessions[session_id]
+            del self._journaled[session_id]
+            self._write({'op': 'remove', 'id': session_id})
+
+    def _write(self, entry, replicate=True):
+        if replicate and self.callback is not None:
+            self.callback(entry)
+        if self.readonly:
+            return
+
+        if self._journal is None:
+            self._journal = open(self.filename, 'a')
+
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+        self._journal_entries += 1
+
+        if self._journal_entries > len(self._sessions) + self.COMPACT_THRESHOLD:
+            self._compact()
+
+    def _compact(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            for session_id, data in self._sessions.items():
+                f.write(json.dumps(dict(data, op='set', id=session_id)) + '\n')
+        os.replace(tmp_filename, self.filename)
+        self._journal_entries = len(self._sessions)
+
+    def _read_journal(self):
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            stat = os.fstat(f.fileno())
+            journal_id = (stat.st_dev, stat.st_ino)
+            # A compacted journal is a new file, read it from the start
+            if journal_id != self._journal_id or stat.st_size < self._journal_offset:
+                self._journal_id = journal_id
+                self._journal_offset = 0
+
+            f.seek(self._journal_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # The entry is still being written, read it next time
+                    break
+                self._journal_offset += len(line)
+
+                try:
+                    entry = json.loads(line.decode())
+                    op = entry.pop('op')
+                    session_id = entry.pop('id')
+                except (ValueError, KeyError):
+                    # The last entry may be incomplete if the process died
+                    # while writing it
+                    log.warning("Ignoring corrupted session journal entry: %r", line)
+                    continue
+                yield op, session_id, entry
+
+    def _load(self):
+        for op, session_id, entry in self._read_journal():
+            if op == 'set':
+                self._sessions[session_id] = entry
+            else:
+                self._sessions.pop(session_id, None)
+
+        now = time.time()
+        for session_id, data in list(self._sessions.items()):
+            if now - data['date'] > self.expire_time:
+                del self._sessions[session_id]
+                continue
+            self._journaled[session_id] = data['date']
+            self._expiration.append((data['date'] + self.expire_time, session_id))
+        heapq.heapify(self._expiration)
+
+        # Start with a journal containing only the valid sessions
+        if not self.readonly:
+            self._compact()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from stoqserver.lib import metrics
+
+log = logging.getLogger(__name__)
+
+_wait_time = metrics.registry.histogram(
+    'stoqserver_store_pool_wait_seconds',
+    'Time spent waiting for a store from the pool')
+_connections = metrics.registry.gauge(
+    'stoqserver_store_pool_connections',
+    'Stores (and database connections) in the pool', ['state'])
+_max_connections = metrics.registry.gauge(
+    'stoqserver_store_pool_max_connections',
+    'Maximum number of stores in the pool')
+_closed = metrics.registry.counter(
+    'stoqserver_store_pool_closed_total',
+    'Stores closed by the pool', ['reason'])
+
+
+class PoolTimeout(Exception):
+    """Raised when no store became available in time"""
+
+
+# A store that is not being used, with the time it was created and the
+# last time it was released to the pool
+_IdleStore = collections.namedtuple('_IdleStore', ['store', 'created', 'released'])
+
+
+class StorePool(object):
+    """A bounded pool of stores, so each request does not open a connection
+
+    Stores are rolled back when released and reused by the next
+    :meth:`.acquire`. Stores that were idle for more than
+    :attr:`.check_interval` seconds are checked with a simple query before
+    being reused, and stores older than :attr:`.max_lifetime` are closed
+    instead of going back to the pool, so connections are recycled from
+    time to time.
+    """
+
+    def __init__(self, factory, max_size=10, max_lifetime=30 * 60,
+                 check_interval=30, timeout=30):
+        """
+        :param factory: a callable returning a new store
+        :param max_size: the maximum number of stores, idle or in use
+        :param max_lifetime: the number of seconds after which a store
+            should be closed
+        :param check_interval: a store idle for more than this number of
+            seconds will be checked before being reused
+        :param timeout: the number of seconds to wait for a store in
+            :meth:`.acquire` when all of them are in use
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.timeout = timeout
+
+        # The most recently released stores are at the right
+        self._idle = collections.deque()
+        # The time each store was created, by their ids
+        self._created = {}
+        self._size = 0
+        self._condition = threading.Condition()
+        _max_connections.set(max_size)
+
+    #
+    #  Public API
+    #
+
+    @property
+    def size(self):
+        """The number of stores in the pool, idle or in use"""
+        return self._size
+
+    def acquire(self, timeout=None):
+        """Get a store from the pool, creating one if needed
+
+        :param timeout: override :attr:`.timeout`
+        :raises: :exc:`PoolTimeout` if there's no store available in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        with self._condition:
+            while not self._idle and self._size >= self.max_size:
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    _wait_time.observe(time.monotonic() - start)
+                    raise PoolTimeout(
+                        "No store available after %s seconds" % (timeout, ))
+                self._condition.wait(remaining)
+
+            if self._idle:
+                idle = self._idle.pop()
+            else:
+                # Reserve a place for the store that will be created
+                # outside the lock
+                idle = None
+                self._size += 1
+        _wait_time.observe(time.monotonic() - start)
+
+        if idle is not None:
+            if (time.monotonic() - idle.released <= self.check_interval or
+                    self._check(idle.store)):
+                self._update_metrics()
+                return idle.store
+            # Replace the broken store with a new one, keeping its place
+            self._close(idle.store, 'broken')
+
+        try:
+            store = self.factory()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            self._update_metrics()
+            raise
+
+        self._created[id(store)] = time.monotonic()
+        self._update_metrics()
+        return store
+
+    def release(self, store):
+        """Give *store* back to the pool
+
+        Anything not committed in the store will be rolled back.
+        """
+        created = self._created.get(id(store))
+        assert created is not None, "The store is not from this pool"
+
+        try:
+            self._rollback(store)
+        except Exception:
+            log.warning("Could not rollback the store", exc_info=True)
+            self._discard(store, 'broken')
+            return
+
+        if time.monotonic() - created > self.max_lifetime:
+            self._discard(store, 'lifetime')
+            return
+
+        store.retval = True
+        with self._condition:
+            self._idle.append(_IdleStore(store, created, time.monotonic()))
+            self._condition.notify()
+        self._update_metrics()
+
+    @contextlib.contextmanager
+    def store(self):
+        """Get a store from the pool while inside the block
+
+        Like ``with api.new_store() as store``, the changes will be committed
+        when leaving the block, unless there was an error or ``store.retval``
+        was set to ``False``.
+        """
+        store = self.acquire()
+        try:
+            yield store
+            if store.retval:
+                store.commit(close=False)
+        finally:
+            self.release(store)
+
+    def close(self):
+        """Close all the idle stores
+
+        Stores in use will be closed when they are released.
+        """
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self.max_lifetime = 0
+        for item in idle:
+            self._discard(item.store, 'closed')
+
+    #
+    #  Private
+    #
+
+    def _check(self, store):
+        try:
+            store.execute('SELECT 1')
+            self._rollback(store)
+        except Exception:
+            log.info("Discarding a broken store from the pool", exc_info=True)
+            return False
+        return True
+
+    def _rollback(self, store):
+        store.rollback(close=False)
+
+    def _close(self, store, reason):
+        del self._created[id(store)]
+        _closed.inc(reason=reason)
+        try:
+            store.close()
+        except Exception:
+            log.warning("Could not close the store", exc_info=True)
+
+    def _discard(self, store, reason):
+        self._close(store, reason)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+        self._update_metrics()
+
+    def _update_metrics(self):
+        idle = len(self._idle)
+        _connections.set(idle, state='idle')
+        _connections.set(self._size - idle, state='in_use')
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import threading
+import unittest
+
+from stoqserver.lib.admission import Lane
+
+
+class TestLane(unittest.TestCase):
+
+    def test_unlimited(self):
+        lane = Lane('high')
+        for i in range(100):
+            self.assertTrue(lane.acquire())
+
+    def test_queue(self):
+        lane = Lane('low', concurrency=1, max_queue=1, timeout=5)
+        self.assertTrue(lane.acquire())
+
+        results = []
+        t = threading.Thread(target=lambda: results.append(lane.acquire()))
+        t.start()
+        self.addCleanup(t.join)
+
+        # Wait for the thread to be queued, so the queue is full
+        while lane._waiting == 0:
+            t.join(0.001)
+        self.assertFalse(lane.acquire())
+
+        # Releasing should let the queued request run
+        lane.release()
+        t.join()
+        self.assertEqual(results, [True])
+        lane.release()
+        self.assertTrue(lane.acquire())
+
+    def test_timeout(self):
+        lane = Lane('low', concurrency=1, max_queue=1, timeout=0.01)
+        self.assertTrue(lane.acquire())
+        self.assertFalse(lane.acquire())
+        self.assertEqual(lane._waiting, 0)
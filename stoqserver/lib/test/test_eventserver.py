@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+from stoqserver.lib.eventserver import EventServer
+from stoqserver.lib.restful import EventStream
+
+
+class TestEventServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EventServer(0, host='127.0.0.1')
+        thread = threading.Thread(target=self.server.run)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.server.stop)
+
+        for i in range(50):
+            if self.server.server is not None:
+                break
+            time.sleep(0.1)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def _request(self, path):
+        conn = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(conn.close)
+        conn.sendall(('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % (
+            path, )).encode())
+        return conn
+
+    def _read_until(self, conn, data):
+        received = b''
+        while data not in received:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+        return received
+
+    def _wait_subscribers(self, count):
+        for i in range(50):
+            if EventStream.get_stats()['subscribers'] == count:
+                return
+            time.sleep(0.1)
+        self.fail("Expected %d subscribers" % (count, ))
+
+    def test_not_found(self):
+        conn = self._request('/foo')
+        self.assertTrue(
+            self._read_until(conn, b'\r\n\r\n').startswith(b'HTTP/1.1 404'))
+
+    def test_stream(self):
+        subscribers = EventStream.get_stats()['subscribers']
+        conn = self._request('/stream')
+        received = self._read_until(conn, b'data: "{}"\n\n')
+        self.assertTrue(received.startswith(b'HTTP/1.1 200 OK'))
+        self.assertIn(b'Content-Type: text/event-stream', received)
+        self._wait_subscribers(subscribers + 1)
+
+        # Anything else the client sends is discarded
+        with mock.patch.object(EventServer, 'READ_SIZE', 4):
+            conn.sendall(b'foobar' * 100)
+            EventStream.put({'type': 'FOO'})
+            received = self._read_until(conn, b'data: {"type": "FOO"}\n\n')
+        self.assertIn(b'data: {"type": "FOO"}\n\n', received)
+
+        # The client should be unsubscribed after disconnecting
+        conn.close()
+        self._wait_subscribers(subscribers)
+
+    def test_heartbeat(self):
+        subscribers = EventStream.get_stats()['subscribers']
+        with mock.patch.object(EventStream, 'get_heartbeat_interval',
+                               return_value=0.05):
+            conn = self._request('/stream')
+            received = self._read_until(conn, EventStream.HEARTBEAT)
+            self.assertIn(EventStream.HEARTBEAT, received)
+
+            # A client without events should be kept connected
+            time.sleep(0.3)
+            self._wait_subscribers(subscribers + 1)
+            received = self._read_until(conn, EventStream.HEARTBEAT)
+            self.assertIn(EventStream.HEARTBEAT, received)
+
+            conn.close()
+        self._wait_subscribers(subscribers)
+
+    def test_write_timeout(self):
+        with mock.patch.object(EventStream, 'set_write_timeout') as set_write_timeout:
+            conn = self._request('/stream')
+            self._read_until(conn, b'data: "{}"\n\n')
+        # The timeout is applied to the connection of each client
+        self.assertEqual(set_write_timeout.call_count, 1)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import mock
+from stoqlib.domain.image import Image
+from stoqlib.domain.test.domaintest import DomainTest
+
+from stoqserver.lib.imagestore import ImageStore
+
+
+class TestImageStore(DomainTest):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.image_store = ImageStore(self.tmpdir)
+
+    def _create_image(self, sellable, data, is_main=False):
+        image = self.create_image()
+        image.image = data
+        image.sellable_id = sellable.id
+        image.is_main = is_main
+        self.store.flush()
+        return image
+
+    def _get_blobs(self):
+        return sorted(filename for dirpath, dirnames, filenames
+                      in os.walk(os.path.join(self.tmpdir, 'blobs'))
+                      for filename in filenames)
+
+    def test_sync_all(self):
+        sellable1 = self.create_sellable()
+        sellable2 = self.create_sellable()
+        self._create_image(sellable1, b'foo', is_main=True)
+        self._create_image(sellable1, b'bar')
+        # The same image should be stored only once
+        self._create_image(sellable2, b'foo')
+
+        self.assertIsNone(self.image_store.sync(self.store))
+        self.assertEqual(self.image_store.read(sellable1.id, True),
+                         (hashlib.md5(b'foo').hexdigest(), b'foo'))
+        self.assertEqual(self.image_store.read(sellable1.id, False),
+                         (hashlib.md5(b'bar').hexdigest(), b'bar'))
+        self.assertEqual(self.image_store.read(sellable2.id, False),
+                         (hashlib.md5(b'foo').hexdigest(), b'foo'))
+        self.assertIsNone(self.image_store.read(sellable2.id, True))
+        self.assertEqual(self._get_blobs(), sorted([hashlib.md5(b'foo').hexdigest(),
+                                                    hashlib.md5(b'bar').hexdigest()]))
+
+        # Removed images should have their files removed too
+        self.store.find(Image, sellable_id=sellable1.id).remove()
+        self.image_store.sync(self.store)
+        self.assertIsNone(self.image_store.read(sellable1.id, True))
+        self.assertIsNone(self.image_store.read(sellable1.id, False))
+        self.assertEqual(self.image_store.read(sellable2.id, False)[1], b'foo')
+        self.assertEqual(self._get_blobs(), [hashlib.md5(b'foo').hexdigest()])
+
+    def test_sync_changes(self):
+        sellable1 = self.create_sellable()
+        sellable2 = self.create_sellable()
+        image1 = self._create_image(sellable1, b'foo')
+        image2 = self._create_image(sellable1, b'bar', is_main=True)
+        self.image_store.sync(self.store)
+
+        # The replaced image is not used anymore, so its file is removed
+        self.image_store.on_remove = mock.Mock()
+        image1.image = b'baz'
+        self.store.flush()
+        self.assertEqual(self.image_store.sync(self.store, [image1.te_id]),
+                         {sellable1.id})
+        self.image_store.on_remove.assert_called_once_with(
+            hashlib.md5(b'foo').hexdigest())
+        self.assertEqual(self.image_store.get_digests(),
+                         {hashlib.md5(b'bar').hexdigest(),
+                          hashlib.md5(b'baz').hexdigest()})
+        self.assertEqual(self.image_store.read(sellable1.id, False)[1], b'baz')
+        self.assertEqual(self._get_blobs(), sorted([hashlib.md5(b'bar').hexdigest(),
+                                                    hashlib.md5(b'baz').hexdigest()]))
+
+        # Both sellables changed when the image moves to another one
+        image1.sellable_id = sellable2.id
+        self.store.flush()
+        self.assertEqual(self.image_store.sync(self.store, [image1.te_id]),
+                         {sellable1.id, sellable2.id})
+        self.assertIsNone(self.image_store.read(sellable1.id, False))
+        self.assertEqual(self.image_store.read(sellable2.id, False)[1], b'baz')
+
+        # A deleted row has no sellable anymore, but the sellables using it
+        # are found without reading the images again
+        te_id = image2.te_id
+        self.store.remove(image2)
+        self.store.flush()
+        with mock.patch.object(self.image_store, '_sync_all') as sync_all:
+            self.assertEqual(self.image_store.sync(self.store, [te_id]),
+                             {sellable1.id})
+        self.assertEqual(sync_all.call_count, 0)
+        self.assertIsNone(self.image_store.read(sellable1.id, True))
+        self.assertEqual(self._get_blobs(), [hashlib.md5(b'baz').hexdigest()])
+
+    def test_get_path(self):
+        self.assertIsNone(self.image_store.get_path(
+            '00000000-0000-0000-0000-000000000000', True))
+        # Only uuids should be used to build the paths
+        self.assertIsNone(self.image_store.get_path('../../etc/passwd', True))
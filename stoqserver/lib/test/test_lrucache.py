@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import unittest
+
+from stoqserver.lib.lrucache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get(self):
+        cache = LRUCache(10)
+        value, generation = cache.get('foo')
+        self.assertIsNone(value)
+
+        cache.set('foo', generation, b'foo', 3)
+        self.assertEqual(cache.get('foo')[0], b'foo')
+        self.assertEqual(cache.size, 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Replacing the value should not count its size twice
+        cache.set('foo', generation, b'bar', 3)
+        self.assertEqual(cache.size, 3)
+
+    def test_eviction(self):
+        cache = LRUCache(10)
+        generation = cache.get('a')[1]
+        cache.set('a', generation, 'a', 4)
+        cache.set('b', generation, 'b', 4)
+        # Using a makes b the least recently used
+        cache.get('a')
+        cache.set('c', generation, 'c', 4)
+
+        self.assertIsNone(cache.get('b')[0])
+        self.assertEqual(cache.get('a')[0], 'a')
+        self.assertEqual(cache.get('c')[0], 'c')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
+
+        # Something bigger than the cache is never cached
+        cache.set('d', generation, 'd', 11)
+        self.assertIsNone(cache.get('d')[0])
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        cache = LRUCache(10)
+        generation = cache.get('a')[1]
+        cache.set('a', generation, 'a', 1)
+        cache.set('b', generation, 'b', 1)
+
+        cache.invalidate(['a', 'x'])
+        self.assertIsNone(cache.get('a')[0])
+        self.assertEqual(cache.size, 1)
+
+        # Values built before the invalidation should not be cached
+        cache.set('a', generation, 'a', 1)
+        self.assertIsNone(cache.get('a')[0])
+
+        self.assertEqual(cache.get('b')[0], 'b')
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+        value, generation = cache.get('a')
+        cache.set('a', generation, 'a', 1)
+        self.assertEqual(cache.get('a')[0], 'a')
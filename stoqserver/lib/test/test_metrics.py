@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import unittest
+
+from stoqserver.lib.metrics import Registry, render
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests handled',
+                                    ['route', 'status'])
+        in_flight = registry.gauge('in_flight', 'Requests being handled')
+        latency = registry.histogram('latency_seconds', 'Request latency',
+                                     ['route'], buckets=[0.1, 1])
+        registry.add_collector(lambda: [('subscribers', 'gauge', 'Clients', 3)])
+
+        requests.inc(route='/data', status=200)
+        requests.inc(route='/data', status=200)
+        requests.inc(route='/sale', status=500)
+        in_flight.inc()
+        in_flight.inc()
+        in_flight.dec()
+        latency.observe(0.05, route='/data')
+        latency.observe(0.5, route='/data')
+        latency.observe(5, route='/data')
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests handled',
+            '# TYPE requests_total counter',
+            'requests_total{route="/data",status="200"} 2',
+            'requests_total{route="/sale",status="500"} 1',
+            '# HELP in_flight Requests being handled',
+            '# TYPE in_flight gauge',
+            'in_flight 1',
+            '# HELP latency_seconds Request latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/data",le="0.1"} 1',
+            'latency_seconds_bucket{route="/data",le="1"} 2',
+            'latency_seconds_bucket{route="/data",le="+Inf"} 3',
+            'latency_seconds_sum{route="/data"} 5.55',
+            'latency_seconds_count{route="/data"} 3',
+            '# HELP subscribers Clients',
+            '# TYPE subscribers gauge',
+            'subscribers 3',
+        ]) + '\n')
+
+    def test_labels(self):
+        registry = Registry()
+        registry.const_labels = [('process', 'worker-1')]
+        requests = registry.counter('requests_total', 'Requests handled', ['route'])
+
+        with self.assertRaises(ValueError):
+            requests.inc(path='/data')
+
+        requests.inc(route='/foo"\n')
+        self.assertIn('requests_total{process="worker-1",route="/foo\\"\\n"} 1',
+                      registry.render())
+
+    def test_render_many(self):
+        registries = []
+        for i in range(2):
+            registry = Registry()
+            registry.const_labels = [('process', 'worker-%d' % (i, ))]
+            requests = registry.counter('requests_total', 'Requests handled')
+            requests.inc(i + 1)
+            registries.append(registry)
+        registries[0].add_collector(lambda: [('subscribers', 'gauge', 'Clients', 3)])
+
+        # The samples of each metric should be rendered together
+        self.assertEqual(render([r.collect() for r in registries]), '\n'.join([
+            '# HELP requests_total Requests handled',
+            '# TYPE requests_total counter',
+            'requests_total{process="worker-0"} 1',
+            'requests_total{process="worker-1"} 2',
+            '# HELP subscribers Clients',
+            '# TYPE subscribers gauge',
+            'subscribers{process="worker-0"} 3',
+        ]) + '\n')
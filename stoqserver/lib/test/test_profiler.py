@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from stoqserver.lib import profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+    def _run_busy_thread(self):
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        t = threading.Thread(target=busy_loop, name='busy')
+        t.start()
+        self.addCleanup(t.join)
+        self.addCleanup(stop.set)
+
+    def test_profile(self):
+        self._run_busy_thread()
+        stacks = profiler.profile(0.1, interval=0.001)
+
+        lines = stacks.splitlines()
+        self.assertTrue(lines)
+        counts = [int(line.rsplit(' ', 1)[1]) for line in lines]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+        busy = [line for line in lines if line.startswith('busy;')]
+        self.assertTrue(busy)
+        self.assertIn('busy_loop (test_profiler.py:', busy[0])
+        # The thread doing the sampling should not be in the results
+        self.assertNotIn('MainThread;', stacks)
+
+    def test_profile_busy(self):
+        with profiler._lock:
+            with self.assertRaises(profiler.ProfilerError):
+                profiler.profile(0.1)
+
+    def test_profile_to_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self._run_busy_thread()
+
+        with mock.patch('stoqserver.lib.profiler.get_application_dir',
+                        return_value=tmpdir):
+            filename = profiler._get_request_filename(os.getpid())
+            with open(filename, 'w') as f:
+                f.write('{"seconds": 0.1, "interval": 0.001, "output": "%s"}' % (
+                    os.path.join(tmpdir, 'out'), ))
+
+            with mock.patch('stoqserver.lib.profiler.threading.Thread') as thread:
+                profiler._handle_signal(None, None)
+            self.assertFalse(os.path.exists(filename))
+
+            # Run the thread synchronously
+            kwargs = thread.call_args[1]
+            kwargs['target'](*kwargs['args'])
+            with open(os.path.join(tmpdir, 'out')) as f:
+                self.assertIn('busy;', f.read())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import threading
+import unittest
+
+import mock
+
+from stoqserver.lib.querytracer import QueryTracer
+
+
+class TestQueryTracer(unittest.TestCase):
+
+    def _execute(self, tracer, statement):
+        tracer.connection_raw_execute(None, None, statement, ())
+        tracer.connection_raw_execute_success(None, None, statement, ())
+
+    def test_tracer(self):
+        tracer = QueryTracer()
+        self._execute(tracer, 'SELECT 1')
+        self.assertIsNone(tracer.stop())
+
+        tracer.start()
+        with mock.patch.object(QueryTracer, 'MAX_STATEMENTS', 2):
+            for i in range(3):
+                self._execute(tracer, 'SELECT %d' % (i, ))
+
+            # Queries executed by other threads should be ignored
+            t = threading.Thread(target=self._execute, args=(tracer, 'SELECT 4'))
+            t.start()
+            t.join()
+
+            tracer.connection_raw_execute(None, None, 'SELECT 5', ())
+            tracer.connection_raw_execute_error(None, None, 'SELECT 5', (),
+                                                Exception())
+
+        stats = tracer.stop()
+        self.assertEqual(stats.count, 4)
+        self.assertEqual([statement for statement, duration in stats.statements],
+                         ['SELECT 0', 'SELECT 1'])
+        self.assertGreaterEqual(stats.duration,
+                                sum(duration for statement, duration in stats.statements))
+        self.assertIsNone(tracer.stop())
@@ -24,22 +24,50 @@
 
 import datetime
 import contextlib
+import io
+import itertools
 import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import uuid
 
 import mock
 from kiwi.currency import currency
 from stoqlib.api import api
+from stoqlib.database.runtime import get_current_user
+from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.sale import Sale
 from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.lib.configparser import register_config, StoqConfig
 from storm.expr import Desc
 
+from stoqserver.lib import restful, thumbnails
+from stoqserver.lib.admission import Lane
+from stoqserver.lib.imagestore import ImageStore
+from stoqserver.lib.metrics import Registry
+from stoqserver.lib.profiler import ProfilerError
 from stoqserver.lib.restful import (bootstrap_app,
                                     PingResource,
+                                    MetricsResource,
+                                    ProfileResource,
                                     LoginResource,
                                     DataResource,
                                     SaleResource,
-                                    ImageResource)
+                                    ImageResource,
+                                    ImageBatchResource,
+                                    EventStream,
+                                    EventQueue,
+                                    _DataCache,
+                                    _data_cache,
+                                    _get_lanes,
+                                    _image_cache,
+                                    get_exclusive_devices)
+from stoqserver.lib.sessionstore import SessionStore
+from stoqserver.lib.storepool import StorePool
 
 
 class _TestFlask(DomainTest):
@@ -52,6 +80,15 @@ class _TestFlask(DomainTest):
         from stoqntk.ntkui import NtkUI
         register_config(StoqConfig())
         self.plugin = NtkUI()
+        _data_cache.invalidate()
+        _image_cache.invalidate()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = mock.patch('stoqserver.lib.restful._image_store',
+                             ImageStore(directory))
+        patcher.start()
+        self.addCleanup(patcher.stop)
         app = bootstrap_app()
         app.testing = True
         self.client = app.test_client()
@@ -68,6 +105,11 @@ class _TestFlask(DomainTest):
                 mock.patch('stoqserver.lib.restful.api.new_store'))
             new_store.return_value = self.store
 
+            # The pool would rollback the test data when the store is released
+            pool = StorePool(new_store)
+            es.enter_context(mock.patch.object(pool, '_rollback'))
+            es.enter_context(mock.patch('stoqserver.lib.restful._store_pool', pool))
+
             yield es
 
     def login(self):
@@ -93,6 +135,27 @@ class _TestFlask(DomainTest):
             self.assertEqual(self.client.delete(route).status_code, 405)
 
 
+class TestExclusiveDevices(DomainTest):
+
+    def test_get_exclusive_devices(self):
+        with contextlib.ExitStack() as es:
+            es.enter_context(mock.patch.object(self.store, 'close'))
+            es.enter_context(mock.patch('stoqserver.lib.restful.api.new_store',
+                                        return_value=self.store))
+            find = es.enter_context(mock.patch.object(self.store, 'find'))
+            find.return_value.is_empty.return_value = True
+
+            with mock.patch('stoqserver.lib.restful.has_ntk', False):
+                self.assertEqual(get_exclusive_devices(), [])
+            with mock.patch('stoqserver.lib.restful.has_ntk', True):
+                self.assertEqual(get_exclusive_devices(), ['TEF'])
+
+            # The station has a printer configured
+            find.return_value.is_empty.return_value = False
+            with mock.patch('stoqserver.lib.restful.has_ntk', False):
+                self.assertEqual(get_exclusive_devices(), ['station devices'])
+
+
 class TestPingResource(_TestFlask):
 
     resource_class = PingResource
@@ -102,6 +165,117 @@ class TestPingResource(_TestFlask):
             json.loads(self.client.get('/ping').data.decode()), 'pong from stoqserver')
 
 
+class TestMetricsResource(_TestFlask):
+
+    resource_class = MetricsResource
+
+    def test_get(self):
+        image_id = str(uuid.uuid4())
+        self.client.get('/ping')
+        self.client.get('/image/' + image_id)
+
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+
+        metrics = rv.data.decode()
+        self.assertIn(
+            'stoqserver_http_requests_total{route="/ping",method="GET",status="200"}',
+            metrics)
+        # The rule should be used instead of the path
+        self.assertIn('route="/image/<id>"', metrics)
+        self.assertNotIn(image_id, metrics)
+        self.assertIn(
+            'stoqserver_http_request_duration_seconds_count{route="/ping",method="GET"}',
+            metrics)
+        self.assertIn('stoqserver_http_requests_in_flight{route="/ping"} 0', metrics)
+        self.assertIn('stoqserver_events_subscribers 0', metrics)
+        self.assertIn('stoqserver_store_pool_connections{state="in_use"} 0', metrics)
+
+    def test_get_workers(self):
+        registry = Registry()
+        registry.const_labels = [('process', 'worker-1')]
+        registry.counter('stoqserver_http_requests_total', 'Requests handled',
+                         ['route', 'method', 'status']).inc(
+                             route='/sale', method='POST', status=200)
+
+        # The metrics of the other workers arrive through the channel
+        channel = mock.Mock(worker_id=0, is_leader=True)
+        with contextlib.ExitStack() as es:
+            es.enter_context(mock.patch('stoqserver.lib.restful._worker_channel', channel))
+            es.enter_context(mock.patch.dict(restful._worker_metrics, clear=True))
+            message = ('metrics', 1, registry.collect())
+            restful._handle_worker_message(message)
+            # The leader passes them to the other workers
+            channel.broadcast.assert_called_once_with(message)
+
+            # But a worker doesn't keep its own ones
+            restful._handle_worker_message(('metrics', 0, []))
+            self.assertEqual(list(restful._worker_metrics), [1])
+
+            metrics = self.client.get('/metrics').data.decode()
+
+        self.assertIn('stoqserver_http_requests_total{process="worker-1",'
+                      'route="/sale",method="POST",status="200"} 1', metrics)
+        # All the samples of a metric are rendered together
+        self.assertEqual(metrics.count('# TYPE stoqserver_http_requests_total '), 1)
+
+    def test_query_tracing(self):
+        app = self.client.application
+        app.debug = True
+        with self.fake_store(mock_rollback=True):
+            rv = self.client.post('/login', data={'user': 'foo', 'pw_hash': 'bar'})
+        self.assertGreater(int(rv.headers['X-Stoq-Queries']), 0)
+        self.assertGreaterEqual(float(rv.headers['X-Stoq-Query-Time']), 0)
+
+        # Slow requests should be logged with their statements
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0.000001
+        with self.fake_store(mock_rollback=True) as es:
+            log = es.enter_context(mock.patch('stoqserver.lib.restful.log'))
+            self.client.post('/login', data={'user': 'foo', 'pw_hash': 'bar'})
+
+        args, _ = log.warning.call_args
+        self.assertEqual(args[1:3], ('POST', '/login'))
+        self.assertIn('login_user', args[-1])
+
+
+class TestProfileResource(_TestFlask):
+
+    resource_class = ProfileResource
+
+    def test_get(self):
+        with self.fake_store():
+            s = self.login()
+
+            rv = self.client.get('/profile', headers={'stoq-session': s})
+            self.assertEqual(rv.status_code, 403)
+
+            with mock.patch('stoqlib.domain.profile.UserProfile.check_app_permission',
+                            return_value=True):
+                rv = self.client.get('/profile?seconds=0.05',
+                                     headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 200)
+                self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+
+                with mock.patch('stoqserver.lib.restful.profiler.profile',
+                                side_effect=ProfilerError('busy')):
+                    rv = self.client.get('/profile', headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 409)
+
+                # The connection should be back in the pool while sampling
+                pool = restful._store_pool
+
+                def profile(seconds, interval):
+                    self.assertEqual(len(pool._idle), pool.size)
+                    return 'foo 1\n'
+
+                with mock.patch('stoqserver.lib.restful.profiler.profile',
+                                side_effect=profile):
+                    rv = self.client.get('/profile', headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, b'foo 1\n')
+
+
 class TestLoginResource(_TestFlask):
 
     resource_class = LoginResource
@@ -143,6 +317,44 @@ class TestLoginResource(_TestFlask):
             self.assertEqual(rv.status_code, 200)
             self.assertEqual(json.loads(rv.data.decode()), 'foobarbin')
 
+    def test_post_worker(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'session.journal')
+        leader = SessionStore(filename, 60 * 60)
+        self.addCleanup(leader.close)
+
+        def replicate(entry):
+            # The leader journals the session and sends it back, like it
+            # would do through the channel
+            def handle():
+                leader.apply(entry)
+                restful._handle_worker_message(('session', entry))
+            threading.Thread(target=handle).start()
+
+        worker = SessionStore(filename, 60 * 60, readonly=True, callback=replicate)
+        self.addCleanup(worker.close)
+        other = SessionStore(filename, 60 * 60, readonly=True)
+        self.addCleanup(other.close)
+
+        with self.fake_store(mock_rollback=True) as es:
+            es.enter_context(mock.patch('stoqserver.lib.restful._worker_channel',
+                                        mock.Mock(is_leader=False)))
+            es.enter_context(mock.patch('stoqserver.lib.restful._session_store', worker))
+            s = self.login()
+            # The login should only finish after the leader journaled the session
+            self.assertIsNotNone(leader.get(s))
+            self.assertEqual(restful._pending_sessions, {})
+
+            # Another worker that didn't receive the session yet should find
+            # it in the journal (403 means the session was accepted)
+            es.enter_context(mock.patch('stoqserver.lib.restful._session_store', other))
+            rv = self.client.get('/profile', headers={'stoq-session': s})
+            self.assertEqual(rv.status_code, 403)
+
+            rv = self.client.get('/profile', headers={'stoq-session': 'foobar'})
+            self.assertEqual(rv.status_code, 401)
+
 
 class TestDataResource(_TestFlask):
 
@@ -242,6 +454,350 @@ class TestDataResource(_TestFlask):
                  {'children': [], 'description': 'c4', 'products': []}]
             )
 
+    def test_get_category_prices(self):
+        with self.fake_store():
+            s = self.login()
+
+            c1 = self.create_sellable_category(description='c1')
+            s1 = self.create_sellable(description='s1')
+            s1.category = c1
+            s2 = self.create_sellable(description='s2')
+            s2.category = c1
+            s3 = self.create_sellable(description='s3')
+            s3.category = c1
+            s3.status = s3.STATUS_CLOSED
+
+            cc = self.create_client_category()
+            self.create_client_category_price(category=cc, sellable=s1,
+                                              price=currency('7.5'))
+
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            self.assertEqual(rv.status_code, 200)
+
+            retval = json.loads(rv.data.decode())
+            category = [c for c in retval['categories'] if c['id'] == c1.id][0]
+            products = {p['description']: p for p in category['products']}
+            # s3 is not available and should not be listed
+            self.assertEqual(set(products), {'s1', 's2'})
+            self.assertEqual(
+                {k: currency(v) for k, v in products['s1']['category_prices'].items()},
+                {cc.id: currency('7.5')})
+            self.assertEqual(products['s2']['category_prices'], {})
+
+    def test_get_etag(self):
+        with self.fake_store():
+            s = self.login()
+
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            self.assertEqual(rv.status_code, 200)
+            etag = rv.headers['ETag']
+            self.assertTrue(etag)
+
+            rv = self.client.get('/data', headers={'stoq-session': s,
+                                                   'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.data, b'')
+            self.assertEqual(rv.headers['ETag'], etag)
+
+            # Any change in the data should generate a new etag
+            self.create_sellable_category(description='c1')
+            rv = self.client.get('/data', headers={'stoq-session': s,
+                                                   'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_get_cached(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+            s = self.login()
+
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            self.assertEqual(rv.status_code, 200)
+            etag = rv.headers['ETag']
+
+            with mock.patch.object(DataResource, 'get_data') as get_data:
+                rv = self.client.get('/data', headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.headers['ETag'], etag)
+                self.assertEqual(get_data.call_count, 0)
+
+                # After an invalidation, the data needs to be rebuilt
+                get_data.return_value = {}
+                _data_cache.invalidate()
+                rv = self.client.get('/data', headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data.decode()), {})
+                self.assertEqual(get_data.call_count, 1)
+
+    def test_get_stores(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+            s = self.login()
+
+            pool = restful._store_pool
+            with mock.patch.object(pool, 'acquire', wraps=pool.acquire) as acquire:
+                # The same store is used to load the user and build the data
+                rv = self.client.get('/data', headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(acquire.call_count, 1)
+
+                # The data is cached now, and the user is not needed for it
+                rv = self.client.get('/data', headers={'stoq-session': s})
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(acquire.call_count, 1)
+
+    def test_get_since(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+            s = self.login()
+
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            version = json.loads(rv.data.decode())['version']
+
+            # Nothing changed
+            rv = self.client.get('/data', headers={'stoq-session': s},
+                                 query_string={'since': version})
+            self.assertEqual(
+                json.loads(rv.data.decode()),
+                {'version': version, 'since': version, 'products': [],
+                 'removed_products': [], 'categories': [], 'sections': {}})
+
+            c1 = self.create_sellable_category(description='c1')
+            s1 = self.create_sellable(description='s1')
+            s1.category = c1
+            s2 = self.create_sellable(description='s2')
+            s2.status = s2.STATUS_CLOSED
+            _data_cache.invalidate(sellable_ids=[s1.id, s2.id],
+                                   category_ids=[c1.id])
+
+            rv = self.client.get('/data', headers={'stoq-session': s},
+                                 query_string={'since': version})
+            delta = json.loads(rv.data.decode())
+            self.assertEqual(delta['since'], version)
+            self.assertEqual(delta['version'], _data_cache.version)
+            self.assertEqual(
+                [(p['id'], p['category_id']) for p in delta['products']],
+                [(s1.id, c1.id)])
+            self.assertEqual(delta['removed_products'], [s2.id])
+            self.assertEqual(
+                delta['categories'],
+                [{'id': c1.id, 'description': 'c1', 'parent_id': None}])
+
+            # A change that cannot be described by a delta and an unknown
+            # version should both fallback to the full snapshot
+            _data_cache.invalidate()
+            for since in [delta['version'], 'foobar']:
+                rv = self.client.get('/data', headers={'stoq-session': s},
+                                     query_string={'since': since})
+                retval = json.loads(rv.data.decode())
+                self.assertNotIn('since', retval)
+                self.assertEqual(retval['version'], _data_cache.version)
+
+    def test_cache_sync(self):
+        leader = _DataCache()
+        leader.enabled = True
+        leader.invalidate()
+
+        # The worker missed the previous invalidations and should just
+        # start from the leader's version
+        worker = _DataCache()
+        worker.sync(leader.version, leader.enabled)
+        self.assertEqual(worker.version, leader.version)
+        self.assertTrue(worker.enabled)
+
+        version = leader.version
+        changes = {'sections': ['categories'], 'sellable_ids': {'s1'},
+                   'category_ids': set()}
+        leader.invalidate(**changes)
+        worker.sync(leader.version, leader.enabled, **changes)
+        self.assertEqual(worker.get_changes(version),
+                         (leader.version, {'s1'}, set(), set()))
+
+        # The worker's versions should not be confused with the ones of a
+        # restarted leader
+        leader = _DataCache()
+        leader.enabled = True
+        leader.invalidate()
+        worker.sync(leader.version, leader.enabled)
+        self.assertEqual(worker.version, leader.version)
+        self.assertIsNone(worker.get_changes(version))
+
+    def test_get_sections(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+            s = self.login()
+            b = api.get_current_branch(self.store)
+
+            c1 = self.create_sellable_category(description='c1')
+            s1 = self.create_sellable(description='s1')
+            s1.category = c1
+            storable = self.create_storable(product=s1.product, stock=10, branch=b)
+
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            version = json.loads(rv.data.decode())['version']
+
+            get_categories = es.enter_context(
+                mock.patch.object(DataResource, '_get_categories'))
+            get_payment_methods = es.enter_context(
+                mock.patch.object(DataResource, '_get_payment_methods'))
+            get_payment_methods.return_value = []
+            put = es.enter_context(
+                mock.patch('stoqserver.lib.restful.EventStream.put'))
+
+            # Only the payment methods should be rebuilt
+            method = self.store.find(PaymentMethod, method_name='money').one()
+            method.max_installments = 2
+            DataResource._notify_changes(
+                self.store, {'payment_method': {method.te_id}})
+            self.assertEqual(get_categories.call_count, 0)
+            self.assertEqual(get_payment_methods.call_count, 1)
+
+            (event, ), _ = put.call_args
+            self.assertEqual(event['type'], 'SERVER_UPDATE_DATA_DELTA')
+            self.assertEqual(event['data']['sections'], {'payment_methods': []})
+
+            # A stock change should only update the availability of the product
+            item = storable.get_stock_items().one()
+            item.quantity = 5
+            DataResource._notify_changes(
+                self.store, {'product_stock_item': {item.te_id}})
+            self.assertEqual(get_categories.call_count, 0)
+
+            (event, ), _ = put.call_args
+            self.assertEqual(event['type'], 'SERVER_UPDATE_DATA_DELTA')
+            self.assertEqual(
+                [(p['id'], p['availability']) for p in event['data']['products']],
+                [(s1.id, {b.id: '5.000'})])
+
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            retval = json.loads(rv.data.decode())
+            self.assertNotEqual(retval['version'], version)
+            self.assertEqual(retval['payment_methods'], [])
+            category = [c for c in retval['categories'] if c['id'] == c1.id][0]
+            self.assertEqual(category['products'][0]['availability'], {b.id: '5.000'})
+            self.assertEqual(get_categories.call_count, 0)
+
+    def test_notify_changes_user(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+            put = es.enter_context(
+                mock.patch('stoqserver.lib.restful.EventStream.put'))
+            s = self.login()
+            u = self.create_user()
+            u.username = 'foobar'
+
+            # There's no user when the changes are pushed, and each client
+            # has its own one, so the user section should not be sent
+            DataResource._notify_changes(self.store, {'login_user': {u.te_id}})
+            (event, ), _ = put.call_args
+            self.assertEqual(event['type'], 'SERVER_UPDATE_DATA_DELTA')
+            self.assertEqual(event['data']['sections'], {})
+
+            with mock.patch.object(_data_cache, 'get_changes', return_value=None):
+                DataResource._notify_changes(self.store, {'login_user': {u.te_id}})
+            (event, ), _ = put.call_args
+            self.assertEqual(event['type'], 'SERVER_UPDATE_DATA')
+            self.assertNotIn('user', event['data'])
+            self.assertIn('categories', event['data'])
+
+            # But the clients should still get it when they ask for the data
+            rv = self.client.get('/data', headers={'stoq-session': s})
+            self.assertIn('user', json.loads(rv.data.decode()))
+
+    def _listen(self, steps):
+        """Run the listener over a list of (seconds, payloads) steps
+
+        Each step advances the clock by the given seconds and delivers the
+        notifications with the given payloads. The listener is stopped when
+        the steps are over.
+
+        :returns: a tuple with the changes passed to each _notify_changes
+            call and the timeouts given to select
+        """
+        class Stop(Exception):
+            pass
+
+        conn = mock.Mock()
+        conn.notifies = []
+        store = mock.Mock()
+        store._connection._raw_connection = conn
+        clock = [0]
+        timeouts = []
+
+        def select(rlist, wlist, xlist, timeout):
+            timeouts.append(timeout)
+            if not steps:
+                raise Stop()
+            seconds, payloads = steps.pop(0)
+            clock[0] += seconds
+            conn.notifies.extend(mock.Mock(payload=p) for p in payloads)
+            return ([conn], [], []) if payloads else ([], [], [])
+
+        calls = []
+        with contextlib.ExitStack() as es:
+            es.enter_context(mock.patch('stoqserver.lib.restful.api.new_store',
+                                        return_value=store))
+            es.enter_context(mock.patch('stoqserver.lib.restful.select.select',
+                                        side_effect=select))
+            es.enter_context(mock.patch('stoqserver.lib.restful.time.monotonic',
+                                        side_effect=lambda: clock[0]))
+            es.enter_context(mock.patch.object(restful._image_store, 'sync'))
+            es.enter_context(mock.patch.object(
+                DataResource, '_notify_changes',
+                side_effect=lambda store, changes: calls.append(dict(changes))))
+            es.enter_context(mock.patch.dict(DataResource.listener_stats,
+                                             {'notifications': 0, 'updates': 0}))
+
+            with self.assertRaises(Stop):
+                DataResource._postgres_listen()
+            stats = dict(DataResource.listener_stats)
+
+        # The cache should only be enabled while listening
+        self.assertFalse(_data_cache.enabled)
+        return calls, timeouts, stats
+
+    def test_postgres_listen(self):
+        quiet = DataResource.QUIET_PERIOD
+        calls, timeouts, stats = self._listen([
+            (0.1, ['1,sellable']),
+            (0.1, ['2,sellable', '3,product']),
+            # Changes in tables we don't care about are ignored
+            (0.1, ['4,sale']),
+            (quiet, []),
+            (1, ['5,payment_method']),
+            (quiet, []),
+        ])
+
+        # The burst should generate a single update
+        self.assertEqual(calls, [{'sellable': {1, 2}, 'product': {3}},
+                                 {'payment_method': {5}}])
+        self.assertEqual(stats, {'notifications': 5, 'updates': 2})
+        # select should wait for the end of the quiet period
+        self.assertEqual(timeouts[0], 5)
+        self.assertAlmostEqual(timeouts[1], quiet)
+
+    def test_postgres_listen_max_delay(self):
+        # A notification always arrives before the quiet period ends
+        interval = DataResource.QUIET_PERIOD * 0.8
+        count = int(DataResource.MAX_DELAY / interval) + 4
+        calls, timeouts, stats = self._listen([
+            (interval, ['%d,sellable' % (i, )]) for i in range(count)])
+
+        # The changes should be sent after MAX_DELAY, even with the stream
+        # of notifications still going on
+        self.assertEqual(len(calls), 1)
+        te_ids = calls[0]['sellable']
+        self.assertEqual(te_ids, set(range(len(te_ids))))
+        self.assertGreaterEqual((len(te_ids) - 1) * interval,
+                                DataResource.MAX_DELAY - 1e-9)
+        self.assertLess(len(te_ids), count)
+        self.assertEqual(stats, {'notifications': count, 'updates': 1})
+
 
 class TestSaleResource(_TestFlask):
 
@@ -359,6 +915,300 @@ class TestSaleResource(_TestFlask):
                 self.assertEqual(json.loads(rv.data.decode()),
                                  {'message': 'foobar exception'})
 
+    def test_post_current_user(self):
+        with self.sysparam(DEMO_MODE=True):
+            with self.fake_store() as es:
+                es.enter_context(
+                    mock.patch('stoqserver.lib.restful.SaleConfirmedRemoteEvent.emit'))
+                es.enter_context(mock.patch.object(SaleResource, 'test_printer'))
+                u = self.create_user()
+                rv = self.client.post('/login',
+                                      data={'user': u.username, 'pw_hash': u.pw_hash})
+                s = json.loads(rv.data.decode())
+
+                # The rows get their responsible from the current user when
+                # they are committed
+                committed_by = []
+                self.store.commit.side_effect = (
+                    lambda close=False: committed_by.append(get_current_user(self.store)))
+
+                p = self.create_product(price=10)
+                p.manage_stock = False
+                self.create_till()
+                rv = self.client.post(
+                    '/sale', headers={'stoq-session': s},
+                    content_type='application/json',
+                    data=json.dumps({
+                        'products': [{'id': p.sellable.id,
+                                      'price': '10',
+                                      'quantity': 1}],
+                        'payments': [{'method': 'money',
+                                      'value': '10'}],
+                    }))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(committed_by, [u])
+
+    def test_post_idempotency_key(self):
+        with self.sysparam(DEMO_MODE=True):
+            with self.fake_store() as es:
+                e = es.enter_context(
+                    mock.patch('stoqserver.lib.restful.SaleConfirmedRemoteEvent.emit'))
+                tp = es.enter_context(
+                    mock.patch.object(SaleResource, 'test_printer'))
+                s = self.login()
+
+                p = self.create_product(price=10)
+                p.manage_stock = False
+                self.create_till()
+                data = json.dumps({
+                    'products': [{'id': p.sellable.id,
+                                  'price': '10',
+                                  'quantity': 1}],
+                    'payments': [{'method': 'money',
+                                  'value': '10'}],
+                })
+
+                def post(key):
+                    return self.client.post(
+                        '/sale', content_type='application/json', data=data,
+                        headers={'stoq-session': s, 'Idempotency-Key': key})
+
+                rv = post('foobar-key')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data.decode()), True)
+                self.assertNotIn('Idempotent-Replayed', rv.headers)
+                sale = self.store.find(Sale).order_by(Desc(Sale.open_date)).first()
+                self.assertEqual(sale.te.metadata['idempotency_key'], 'foobar-key')
+                self.assertEqual(sale.te.metadata['idempotency_hash'],
+                                 SaleResource()._get_payload_hash(json.loads(data)))
+
+                # A retry should not touch the printer nor make the sale again
+                rv = post('foobar-key')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data.decode()), True)
+                self.assertEqual(rv.headers['Idempotent-Replayed'], 'true')
+                self.assertEqual(e.call_count, 1)
+                self.assertEqual(tp.call_count, 1)
+
+                # The key can't be reused by a different sale
+                other_data = json.dumps(dict(json.loads(data), client_document='foo'))
+                rv = self.client.post(
+                    '/sale', content_type='application/json', data=other_data,
+                    headers={'stoq-session': s, 'Idempotency-Key': 'foobar-key'})
+                self.assertEqual(rv.status_code, 422)
+                self.assertEqual(e.call_count, 1)
+
+                # But a new key is a new sale
+                rv = post('other-key')
+                self.assertEqual(rv.status_code, 200)
+                self.assertNotIn('Idempotent-Replayed', rv.headers)
+                self.assertEqual(e.call_count, 2)
+
+                rv = post('x' * 256)
+                self.assertEqual(rv.status_code, 400)
+
+                # The first request with the key is still going on
+                with mock.patch.object(SaleResource, '_get_idempotent_sale',
+                                       return_value=(None, True)):
+                    rv = post('foobar-key')
+                self.assertEqual(rv.status_code, 409)
+                self.assertEqual(rv.headers['Retry-After'], '5')
+                self.assertEqual(e.call_count, 2)
+
+
+class TestEventStream(_TestFlask):
+
+    resource_class = EventStream
+
+    def test_get(self):
+        rv = self.client.get('/stream')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(EventStream.get_stats()['subscribers'], 1)
+
+        EventStream.put({'type': 'DRAWER_ALERT_OPEN'})
+        self.assertEqual(EventStream.get_stats()['queued_events'], 2)
+        event_id = '%s-%d' % (EventStream._token, EventStream._last_id)
+
+        chunks = iter(rv.response)
+        self.assertEqual(next(chunks), b'data: "{}"\n\n')
+        self.assertEqual(next(chunks), ('id: %s\n' % event_id).encode())
+        self.assertEqual(next(chunks),
+                         b'data: {"type": "DRAWER_ALERT_OPEN"}\n\n')
+
+        # Closing the response should remove the stream
+        rv.close()
+        self.assertEqual(EventStream.get_stats()['subscribers'], 0)
+
+    def test_get_replay(self):
+        EventStream.put({'type': 'DRAWER_ALERT_OPEN'})
+        last_event_id = '%s-%d' % (EventStream._token, EventStream._last_id)
+        EventStream.put({'type': 'DRAWER_ALERT_CLOSE'})
+        EventStream.put({'type': 'TEF_DISPLAY_MESSAGE', 'message': 'foo'})
+
+        # The events after the last one the client received should be replayed
+        rv = self.client.get('/stream', headers={'Last-Event-ID': last_event_id})
+        chunks = [c for c in itertools.islice(rv.response, 5)
+                  if c.startswith(b'data')]
+        rv.close()
+        self.assertEqual(chunks, [
+            b'data: "{}"\n\n',
+            b'data: {"type": "DRAWER_ALERT_CLOSE"}\n\n',
+            b'data: {"type": "TEF_DISPLAY_MESSAGE", "message": "foo"}\n\n'])
+
+        # Ids from another process can't be replayed, so the client should
+        # know it lost what came after them
+        rv = self.client.get('/stream', headers={'Last-Event-ID': 'foobar-1'})
+        chunks = [c for c in itertools.islice(rv.response, 2)]
+        rv.close()
+        self.assertEqual(chunks, [
+            b'data: "{}"\n\n',
+            b'data: {"type": "SERVER_EVENTS_LOST"}\n\n'])
+
+    def test_get_replay_lost(self):
+        def subscribe(last_event_id):
+            stream = EventQueue()
+            EventStream.subscribe(stream, last_event_id)
+            EventStream.unsubscribe(stream)
+            return [e.frame for e in iter(lambda: stream.get(block=False), None)]
+
+        with mock.patch.object(EventStream, '_replay', EventQueue(maxsize=2)):
+            EventStream.put({'type': 'DRAWER_ALERT_OPEN'})
+            first_id = '%s-%d' % (EventStream._token, EventStream._last_id)
+            EventStream.put({'type': 'DRAWER_ALERT_CLOSE'})
+            second_id = '%s-%d' % (EventStream._token, EventStream._last_id)
+            EventStream.put({'type': 'DRAWER_ALERT_OPEN'})
+            EventStream.put({'type': 'DRAWER_ALERT_CLOSE'})
+
+            # The event after the first one is not kept anymore, so the
+            # client should know it lost it
+            self.assertEqual(subscribe(first_id), [
+                b'data: "{}"\n\n',
+                b'data: {"type": "SERVER_EVENTS_LOST"}\n\n',
+                b'data: {"type": "DRAWER_ALERT_OPEN"}\n\n',
+                b'data: {"type": "DRAWER_ALERT_CLOSE"}\n\n'])
+
+            # But nothing was lost after the second one
+            self.assertEqual(subscribe(second_id), [
+                b'data: "{}"\n\n',
+                b'data: {"type": "DRAWER_ALERT_OPEN"}\n\n',
+                b'data: {"type": "DRAWER_ALERT_CLOSE"}\n\n'])
+
+            # A restarted worker did not see the events before its first one,
+            # nor any event if it didn't get one yet
+            lost = b'data: {"type": "SERVER_EVENTS_LOST"}\n\n'
+            with mock.patch.object(EventStream, '_first_id', EventStream._last_id):
+                self.assertEqual(subscribe(second_id)[1], lost)
+            with mock.patch.object(EventStream, '_first_id', None):
+                self.assertEqual(subscribe(second_id)[1], lost)
+
+    def test_put_leader(self):
+        channel = mock.Mock(is_leader=True)
+        channel.next_id.return_value = EventStream._last_id + 10
+        # Sending to the workers can block, so it shouldn't hold the streams
+        channel.broadcast.side_effect = (
+            lambda message: self.assertFalse(EventStream._lock.locked()))
+
+        with mock.patch('stoqserver.lib.restful._worker_channel', channel):
+            EventStream.put({'type': 'DRAWER_ALERT_OPEN'})
+
+        (message, ), _ = channel.broadcast.call_args
+        self.assertEqual(message[0], 'event')
+        self.assertEqual(message[1].id, channel.next_id.return_value)
+        self.assertEqual(EventStream._last_id, channel.next_id.return_value)
+
+    def test_put(self):
+        streams = [EventQueue() for i in range(3)]
+        with contextlib.ExitStack() as es:
+            es.enter_context(mock.patch.object(EventStream, '_streams', streams))
+            dumps = es.enter_context(mock.patch.object(
+                restful.json, 'dumps', wraps=json.dumps))
+            EventStream.put({'type': 'DRAWER_ALERT_OPEN'})
+
+        dumps.assert_called_once_with({'type': 'DRAWER_ALERT_OPEN'})
+        events = [stream.get() for stream in streams]
+        self.assertEqual(events[0].frame,
+                         b'data: {"type": "DRAWER_ALERT_OPEN"}\n\n')
+        # The event should be encoded only once and shared by all streams
+        for event in events:
+            self.assertIs(event.frame, events[0].frame)
+
+    def test_get_heartbeat(self):
+        with mock.patch.object(EventStream, 'get_heartbeat_interval',
+                               return_value=0.01):
+            rv = self.client.get('/stream')
+            # Quiet clients should only get heartbeats, without being dropped
+            chunks = list(itertools.islice(rv.response, 20))
+            self.assertEqual(EventStream.get_stats()['subscribers'], 1)
+        rv.close()
+
+        self.assertEqual(chunks[0], b'data: "{}"\n\n')
+        self.assertEqual(set(chunks[1:]), {EventStream.HEARTBEAT})
+        self.assertEqual(EventStream.get_stats()['subscribers'], 0)
+
+    @unittest.skipUnless(hasattr(socket, 'TCP_USER_TIMEOUT'),
+                         'TCP_USER_TIMEOUT is not available')
+    def test_set_write_timeout(self):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+
+        # Disabled by default
+        EventStream.set_write_timeout(sock)
+        self.assertEqual(
+            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT), 0)
+
+        with mock.patch.object(EventStream, 'get_write_timeout', return_value=2.5):
+            EventStream.set_write_timeout(sock)
+        self.assertEqual(
+            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT), 2500)
+
+    def test_get_topics(self):
+        rv = self.client.get('/stream?topics=drawer&station=station1')
+        EventStream.put({'type': 'TEF_DISPLAY_MESSAGE', 'message': 'foo'})
+        EventStream.put({'type': 'DRAWER_ALERT_OPEN'}, station_id='station2')
+        EventStream.put({'type': 'DRAWER_ALERT_CLOSE'}, station_id='station1')
+
+        chunks = [c for c in itertools.islice(rv.response, 3)
+                  if c.startswith(b'data')]
+        rv.close()
+        self.assertEqual(chunks, [
+            b'data: "{}"\n\n',
+            b'data: {"type": "DRAWER_ALERT_CLOSE"}\n\n'])
+
+    def test_put_routing(self):
+        pos = EventQueue(topics={'tef', 'drawer'}, station_id='station1')
+        dashboard = EventQueue(topics={'data'})
+        other_pos = EventQueue(station_id='station2')
+        with mock.patch.object(EventStream, '_streams', [pos, dashboard, other_pos]):
+            EventStream.put({'type': 'TEF_DISPLAY_MESSAGE'}, station_id='station1')
+            EventStream.put({'type': 'DRAWER_ALERT_OPEN'}, station_id='station2')
+            EventStream.put({'type': 'SERVER_UPDATE_DATA'})
+
+        self.assertEqual([pos.get().type], ['TEF_DISPLAY_MESSAGE'])
+        self.assertEqual([dashboard.get().type], ['SERVER_UPDATE_DATA'])
+        self.assertEqual([other_pos.get().type, other_pos.get().type],
+                         ['DRAWER_ALERT_OPEN', 'SERVER_UPDATE_DATA'])
+        for queue in [pos, dashboard, other_pos]:
+            self.assertEqual(len(queue), 0)
+
+    def test_queue(self):
+        queue = EventQueue(maxsize=3)
+        queue.put(EventStream._encode({'type': 'SERVER_UPDATE_DATA_DELTA'}))
+        queue.put(EventStream._encode({'type': 'DRAWER_ALERT_OPEN'}))
+        queue.put(EventStream._encode({'type': 'SERVER_UPDATE_DATA'}))
+        # The full data update supersedes the queued delta
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.dropped, 1)
+
+        queue.put(EventStream._encode({'type': 'DRAWER_ALERT_CLOSE'}))
+        queue.put(EventStream._encode({'type': 'TEF_DISPLAY_MESSAGE'}))
+        # The queue is full, the oldest event should be dropped
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.get().type, 'SERVER_UPDATE_DATA')
+        queue.get()
+        queue.get()
+        self.assertIsNone(queue.get(timeout=0.01))
+
 
 class TestImageResource(_TestFlask):
 
@@ -378,3 +1228,240 @@ class TestImageResource(_TestFlask):
                 rv = self.client.get('/image/' + sellable.id, headers={'stoq-session': s})
                 self.assertEqual(rv.status_code, 200)
                 self.assertEqual(rv.data, b'foobar')
+
+    def test_get_cache(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+
+            sellable = self.create_sellable()
+            img = self.create_image()
+            img.image = b'foobar'
+            img.sellable_id = sellable.id
+            # The images are copied to the disk before the cache is enabled
+            restful._image_store.sync(self.store)
+
+            rv = self.client.get('/image/' + sellable.id)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data, b'foobar')
+            self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+            etag = rv.headers['ETag']
+
+            rv = self.client.get('/image/' + sellable.id,
+                                 headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.data, b'')
+
+            # The cached image should be used until it gets invalidated
+            img.image = b'barbaz'
+            rv = self.client.get('/image/' + sellable.id,
+                                 headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+
+            with mock.patch.object(ImageResource, '_make_thumbnails'):
+                ImageResource.invalidate(self.store, [img.te_id])
+            rv = self.client.get('/image/' + sellable.id,
+                                 headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data, b'barbaz')
+            self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_get_many_images(self):
+        with self.fake_store():
+            sellable = self.create_sellable()
+            images = []
+            for data in [b'foo', b'bar', None]:
+                img = self.create_image()
+                img.image = data
+                img.sellable_id = sellable.id
+                images.append(img)
+            self.store.flush()
+            first = min((img for img in images if img.image is not None),
+                        key=lambda img: img.id)
+
+            # The same image should be served from the database and the disk
+            rv = self.client.get('/image/' + sellable.id)
+            self.assertEqual(rv.data, first.image)
+            etag = rv.headers['ETag']
+
+            restful._image_store.sync(self.store)
+            _image_cache.invalidate()
+            with mock.patch.object(_data_cache, 'enabled', True):
+                rv = self.client.get('/image/' + sellable.id)
+            self.assertEqual(rv.data, first.image)
+            self.assertEqual(rv.headers['ETag'], etag)
+
+    def test_get_range(self):
+        with self.fake_store() as es:
+            es.enter_context(
+                mock.patch.object(_data_cache, 'enabled', True))
+
+            sellable = self.create_sellable()
+            img = self.create_image()
+            img.image = b'foobar'
+            img.sellable_id = sellable.id
+            restful._image_store.sync(self.store)
+
+            rv = self.client.get('/image/' + sellable.id, headers={'Range': 'bytes=1-3'})
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(rv.data, b'oob')
+            self.assertEqual(rv.headers['Content-Range'], 'bytes 1-3/6')
+            etag = rv.headers['ETag']
+
+            rv = self.client.get('/image/' + sellable.id,
+                                 headers={'Range': 'bytes=3-', 'If-Range': etag})
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(rv.data, b'bar')
+
+            # The whole image should be sent if it changed
+            rv = self.client.get('/image/' + sellable.id,
+                                 headers={'Range': 'bytes=3-', 'If-Range': '"xxx"'})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data, b'foobar')
+
+            rv = self.client.get('/image/' + sellable.id, headers={'Range': 'bytes=10-20'})
+            self.assertEqual(rv.status_code, 416)
+            self.assertEqual(rv.headers['Content-Range'], 'bytes */6')
+
+    def test_get_busy(self):
+        # A full low priority lane should not affect the other lanes
+        lanes = self.client.application.config['LANES']
+        lanes['low'] = Lane('low', concurrency=0, max_queue=0)
+
+        rv = self.client.get('/image/' + str(uuid.uuid4()))
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '5')
+
+        rv = self.client.get('/ping')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(lanes['normal'].acquire())
+
+        # Preflights should not be rejected with the actual request
+        rv = self.client.options('/image/' + str(uuid.uuid4()),
+                                 headers={'Access-Control-Request-Method': 'GET'})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_get_lanes(self):
+        values = {'normallaneconcurrency': '0', 'lowlaneconcurrency': '2'}
+        config = mock.Mock()
+        config.get.side_effect = lambda section, key: values.get(key)
+        with mock.patch('stoqserver.lib.restful.get_config', return_value=config):
+            lanes = _get_lanes()
+
+        self.assertIsNone(lanes['high'].concurrency)
+        self.assertIsNone(lanes['normal'].concurrency)
+        self.assertEqual(lanes['low'].concurrency, 2)
+        self.assertEqual(lanes['low'].max_queue, 16)
+
+    @unittest.skipUnless(thumbnails.has_pil, 'PIL is not available')
+    def test_get_thumbnail(self):
+        from PIL import Image
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        output = io.BytesIO()
+        Image.new('RGB', (1000, 500)).save(output, 'PNG')
+        with self.fake_store() as es:
+            es.enter_context(mock.patch('stoqserver.lib.restful._thumbnail_store',
+                                        thumbnails.ThumbnailStore(directory)))
+            sellable = self.create_sellable()
+            img = self.create_image()
+            img.image = output.getvalue()
+            img.sellable_id = sellable.id
+
+            rv = self.client.get('/image/%s?w=100' % (sellable.id, ))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers['Content-Type'], 'image/jpeg')
+            self.assertEqual(Image.open(io.BytesIO(rv.data)).size, (128, 64))
+            self.assertTrue(rv.headers['ETag'].endswith('-128"'))
+
+            # Thumbnails bigger than the image are the image itself
+            rv = self.client.get('/image/%s?w=2000' % (sellable.id, ))
+            self.assertEqual(rv.headers['Content-Type'], 'image/png')
+            self.assertEqual(rv.data, img.image)
+
+            # Images smaller than the thumbnail are only read once
+            output = io.BytesIO()
+            Image.new('RGB', (100, 50)).save(output, 'PNG')
+            img.image = output.getvalue()
+            _image_cache.invalidate()
+            with mock.patch.object(thumbnails, 'make_thumbnail',
+                                   wraps=thumbnails.make_thumbnail) as make_thumbnail:
+                for i in range(2):
+                    rv = self.client.get('/image/%s?w=100' % (sellable.id, ))
+                    self.assertEqual(rv.headers['Content-Type'], 'image/png')
+                    self.assertEqual(rv.data, img.image)
+            self.assertEqual(make_thumbnail.call_count, 1)
+
+
+class TestImageBatchResource(_TestFlask):
+
+    resource_class = ImageBatchResource
+
+    def _get_parts(self, rv):
+        self.assertEqual(rv.status_code, 200)
+        mimetype, boundary = rv.headers['Content-Type'].split('; boundary=')
+        self.assertEqual(mimetype, 'multipart/mixed')
+
+        parts = []
+        chunks = rv.data.split(('--%s' % (boundary, )).encode())
+        self.assertEqual(chunks[0], b'')
+        self.assertEqual(chunks[-1], b'--\r\n')
+        for chunk in chunks[1:-1]:
+            head, data = chunk[2:-2].split(b'\r\n\r\n', 1)
+            headers = dict(line.split(': ', 1) for line in head.decode().split('\r\n'))
+            self.assertEqual(int(headers['Content-Length']), len(data))
+            content_id = headers['Content-ID']
+            self.assertEqual(content_id[0] + content_id[-1], '<>')
+            parts.append((content_id[1:-1], headers['Content-Type'], data))
+        return parts
+
+    def test_get(self):
+        with self.fake_store():
+            category = self.create_sellable_category()
+            s1 = self.create_sellable()
+            s1.category = category
+            img = self.create_image()
+            img.image = b'foobar'
+            img.sellable_id = s1.id
+            s2 = self.create_sellable()
+
+            rv = self.client.get('/images?ids=%s,%s' % (s2.id, s1.id))
+            parts = self._get_parts(rv)
+            # The sellables without images get a transparent pixel
+            self.assertEqual([(i, t) for i, t, data in parts],
+                             [(s2.id, 'image/jpeg'), (s1.id, 'image/png')])
+            self.assertEqual(parts[1][2], b'foobar')
+
+            # The etags should be the same of the single image resource
+            etag = self.client.get('/image/' + s1.id).headers['ETag']
+            self.assertIn('ETag: %s' % (etag, ), rv.data.decode('latin-1'))
+
+            rv = self.client.get('/images?category=' + category.id)
+            self.assertEqual(self._get_parts(rv), [(s1.id, 'image/png', b'foobar')])
+
+            rv = self.client.get('/images?ids=foo')
+            self.assertEqual(rv.status_code, 400)
+
+            with mock.patch.object(ImageBatchResource, 'MAX_IMAGES', 1):
+                rv = self.client.get('/images?ids=%s,%s' % (s2.id, s1.id))
+            self.assertEqual(rv.status_code, 400)
+
+    def test_get_thumbnails(self):
+        with self.fake_store():
+            s1 = self.create_sellable()
+            img = self.create_image()
+            img.image = b'foobar'
+            img.sellable_id = s1.id
+
+            thumbnail = ('thumbnail', b'thumbnail', 'image/jpeg')
+            with mock.patch.object(ImageResource, 'get_thumbnail',
+                                   return_value=thumbnail) as get_thumbnail:
+                rv = self.client.get('/images?w=64&ids=' + s1.id,
+                                     buffered=False)
+                # The thumbnails are made before the response is streamed
+                self.assertEqual(get_thumbnail.call_count, 1)
+                self.assertEqual(get_thumbnail.call_args[0][1:], (b'foobar', 64))
+                self.assertEqual(self._get_parts(rv),
+                                 [(s1.id, 'image/jpeg', b'thumbnail')])
+                self.assertIn('ETag: "thumbnail"', rv.data.decode())
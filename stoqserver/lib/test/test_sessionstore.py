@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from stoqserver.lib.sessionstore import SessionStore
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'session.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _get_store(self):
+        store = SessionStore(self.filename, 60 * 60)
+        self.addCleanup(store.close)
+        return store
+
+    def test_add(self):
+        store = self._get_store()
+        self.assertIsNone(store.get('foo'))
+
+        with mock.patch('stoqserver.lib.sessionstore.time.time') as now:
+            now.return_value = 1000
+            store.add('foo', 'user1')
+            self.assertEqual(store.get('foo'), {'user_id': 'user1', 'date': 1000})
+
+            # Sessions can keep the date they were last used somewhere else,
+            # unless they expired already
+            store.add('bar', 'user2', date=500)
+            self.assertEqual(store.get('bar'), {'user_id': 'user2', 'date': 500})
+            store.add('baz', 'user3', date=1000 - 60 * 60 - 1)
+            self.assertIsNone(store.get('baz'))
+
+        store.remove('foo')
+        self.assertIsNone(store.get('foo'))
+
+    def test_journal(self):
+        store = self._get_store()
+        store.add('foo', 'user1')
+        store.add('bar', 'user2')
+        store.add('baz', 'user3')
+        store.remove('bar')
+        store.close()
+
+        store = self._get_store()
+        self.assertEqual(store.get('foo')['user_id'], 'user1')
+        self.assertIsNone(store.get('bar'))
+        self.assertEqual(store.get('baz')['user_id'], 'user3')
+
+        # An incomplete entry should not prevent the other ones from loading
+        store.close()
+        with open(self.filename, 'a') as f:
+            f.write('{"op": "set", "id": "xxx", ')
+
+        store = self._get_store()
+        self.assertEqual(store.get('foo')['user_id'], 'user1')
+        self.assertIsNone(store.get('xxx'))
+
+    def test_expiration(self):
+        store = self._get_store()
+        with mock.patch('stoqserver.lib.sessionstore.time.time') as now:
+            now.return_value = 1000
+            store.add('foo', 'user1')
+            store.add('bar', 'user2')
+
+            # Refreshing bar should keep it alive even if the refresh
+            # was not journaled
+            now.return_value = 1000 + 59 * 60
+            store.touch('bar')
+
+            now.return_value = 1000 + 61 * 60
+            self.assertIsNone(store.get('foo'))
+            self.assertEqual(store.get('bar')['user_id'], 'user2')
+
+            now.return_value = 1000 + 59 * 60 + 61 * 60
+            self.assertIsNone(store.get('bar'))
+
+    def test_compact(self):
+        store = self._get_store()
+        for i in range(SessionStore.COMPACT_THRESHOLD + 10):
+            store.add('foo', 'user1')
+
+        with open(self.filename) as f:
+            self.assertLessEqual(len(f.readlines()), 10)
+
+        store.close()
+        store = self._get_store()
+        self.assertEqual(store.get('foo')['user_id'], 'user1')
+
+    def test_replication(self):
+        entries = []
+        store = self._get_store()
+        store.add('foo', 'user1')
+        store.close()
+
+        # The replica loads the sessions but should never write the journal
+        replica = SessionStore(self.filename, 60 * 60, readonly=True,
+                               callback=entries.append)
+        self.addCleanup(replica.close)
+        self.assertEqual(replica.get('foo')['user_id'], 'user1')
+        replica.add('bar', 'user2')
+        replica.remove('foo')
+        self.assertEqual([(e['op'], e['id']) for e in entries],
+                         [('set', 'bar'), ('remove', 'foo')])
+
+        store = SessionStore(self.filename, 60 * 60, callback=self.fail)
+        self.addCleanup(store.close)
+        self.assertIsNone(store.get('bar'))
+        for entry in entries:
+            store.apply(entry)
+        self.assertEqual(store.get('bar')['user_id'], 'user2')
+        self.assertIsNone(store.get('foo'))
+
+        # The applied entries should be journaled
+        store.close()
+        store = self._get_store()
+        self.assertEqual(store.get('bar')['user_id'], 'user2')
+        self.assertIsNone(store.get('foo'))
+
+    def test_refresh(self):
+        store = self._get_store()
+        replica = SessionStore(self.filename, 60 * 60, readonly=True)
+        self.addCleanup(replica.close)
+
+        # The replica didn't receive the session, but it is in the journal
+        store.add('foo', 'user1')
+        self.assertIsNone(replica.get('foo'))
+        replica.refresh()
+        self.assertEqual(replica.get('foo')['user_id'], 'user1')
+
+        # An entry still being written should be read on the next refresh
+        store.remove('foo')
+        with open(self.filename, 'a') as f:
+            f.write('{"op": "set", "id": "bar", ')
+            f.flush()
+            replica.refresh()
+            self.assertIsNone(replica.get('foo'))
+            self.assertIsNone(replica.get('bar'))
+            f.write('"user_id": "user2", "date": %d}\n' % (time.time(), ))
+        replica.refresh()
+        self.assertEqual(replica.get('bar')['user_id'], 'user2')
+
+        # The compacted journal should be read from its start
+        store.close()
+        store = self._get_store()
+        store.add('baz', 'user3')
+        replica.refresh()
+        self.assertEqual(replica.get('bar')['user_id'], 'user2')
+        self.assertEqual(replica.get('baz')['user_id'], 'user3')
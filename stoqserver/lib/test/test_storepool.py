@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import threading
+import unittest
+
+import mock
+
+from stoqserver.lib.storepool import PoolTimeout, StorePool
+
+
+class _FakeStore(object):
+
+    def __init__(self):
+        self.retval = True
+        self.broken = False
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def execute(self, statement):
+        if self.broken:
+            raise Exception('connection lost')
+
+    def commit(self, close=False):
+        self.commits += 1
+
+    def rollback(self, close=True):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorePool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = StorePool(_FakeStore, max_size=2)
+        store1 = pool.acquire()
+        store2 = pool.acquire()
+        self.assertIsNot(store1, store2)
+        self.assertEqual(pool.size, 2)
+
+        pool.release(store1)
+        self.assertEqual(store1.rollbacks, 1)
+        self.assertIs(pool.acquire(), store1)
+        self.assertEqual(pool.size, 2)
+
+    def test_timeout(self):
+        pool = StorePool(_FakeStore, max_size=1, timeout=0.01)
+        store = pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+
+        # A store released by another thread should wake up the waiter
+        t = threading.Timer(0.05, pool.release, args=(store, ))
+        t.start()
+        self.addCleanup(t.join)
+        self.assertIs(pool.acquire(timeout=5), store)
+
+    def test_factory_error(self):
+        factory = mock.Mock(side_effect=Exception('database is down'))
+        pool = StorePool(factory, max_size=1, timeout=0.01)
+        with self.assertRaises(Exception):
+            pool.acquire()
+
+        # The failed store should not count
+        self.assertEqual(pool.size, 0)
+        factory.side_effect = None
+        factory.return_value = _FakeStore()
+        self.assertIs(pool.acquire(), factory.return_value)
+
+    def test_health_check(self):
+        pool = StorePool(_FakeStore, check_interval=10)
+        with mock.patch('stoqserver.lib.storepool.time.monotonic') as now:
+            now.return_value = store_time = 1000000
+            store = pool.acquire()
+            pool.release(store)
+
+            # Recently released stores are not checked
+            store.broken = True
+            self.assertIs(pool.acquire(), store)
+            pool.release(store)
+
+            # A broken store should be replaced
+            now.return_value = store_time + 11
+            new_store = pool.acquire()
+        self.assertIsNot(new_store, store)
+        self.assertTrue(store.closed)
+        self.assertEqual(pool.size, 1)
+
+    def test_max_lifetime(self):
+        pool = StorePool(_FakeStore, max_lifetime=60)
+        store = pool.acquire()
+        with mock.patch('stoqserver.lib.storepool.time.monotonic') as now:
+            now.return_value = 10000000
+            pool.release(store)
+        self.assertTrue(store.closed)
+        self.assertEqual(pool.size, 0)
+        self.assertIsNot(pool.acquire(), store)
+
+    def test_store(self):
+        pool = StorePool(_FakeStore)
+        with pool.store() as store:
+            pass
+        self.assertEqual(store.commits, 1)
+
+        with pool.store() as store:
+            store.retval = False
+        self.assertEqual(store.commits, 1)
+
+        # The store should be released even with errors
+        with self.assertRaises(ValueError):
+            with pool.store() as store:
+                raise ValueError
+        self.assertEqual(store.commits, 1)
+        self.assertIs(pool.acquire(), store)
+        self.assertTrue(store.retval)
+
+    def test_close(self):
+        pool = StorePool(_FakeStore)
+        store1 = pool.acquire()
+        store2 = pool.acquire()
+        pool.release(store1)
+        pool.close()
+        self.assertTrue(store1.closed)
+
+        # Stores in use are closed when released
+        self.assertFalse(store2.closed)
+        pool.release(store2)
+        self.assertTrue(store2.closed)
+        self.assertEqual(pool.size, 0)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from stoqserver.lib import thumbnails
+
+if thumbnails.has_pil:
+    from PIL import Image
+
+
+def _make_image(width, height, mode='RGB', format='PNG'):
+    output = io.BytesIO()
+    Image.new(mode, (width, height)).save(output, format)
+    return output.getvalue()
+
+
+@unittest.skipUnless(thumbnails.has_pil, 'PIL is not available')
+class TestThumbnails(unittest.TestCase):
+
+    def test_get_size(self):
+        self.assertEqual(thumbnails.get_size(10), 64)
+        self.assertEqual(thumbnails.get_size(128), 128)
+        self.assertEqual(thumbnails.get_size(129), 256)
+        self.assertIsNone(thumbnails.get_size(4000))
+
+    def test_make_thumbnail(self):
+        data, mimetype = thumbnails.make_thumbnail(_make_image(1000, 500), 128)
+        self.assertEqual(mimetype, 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (128, 64))
+
+        # The transparency should be kept
+        data, mimetype = thumbnails.make_thumbnail(
+            _make_image(1000, 500, mode='RGBA'), 128)
+        self.assertEqual(mimetype, 'image/png')
+        self.assertEqual(Image.open(io.BytesIO(data)).mode, 'RGBA')
+
+        # Small and broken images have no thumbnails
+        self.assertIsNone(thumbnails.make_thumbnail(_make_image(100, 100), 128))
+        self.assertIsNone(thumbnails.make_thumbnail(b'foobar', 128))
+
+    def test_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = thumbnails.ThumbnailStore(directory)
+
+        image = _make_image(1000, 500)
+        thumbnail = store.get('abc', image, 128)
+        self.assertEqual(os.listdir(directory), ['abc-128.jpg'])
+
+        # The thumbnail should be read from the disk from now on
+        self.assertEqual(store.get('abc', b'', 128), thumbnail)
+
+        store.make_all('abc', image)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['abc-128.jpg', 'abc-256.jpg', 'abc-512.jpg', 'abc-64.jpg'])
+
+        # Small images are marked to be used as they are, for all the sizes
+        # they are not bigger than
+        store.make_all('def', _make_image(100, 50))
+        self.assertEqual(sorted(f for f in os.listdir(directory) if f.startswith('def')),
+                         ['def-128.orig', 'def-256.orig', 'def-512.orig', 'def-64.jpg'])
+        with mock.patch.object(thumbnails, 'make_thumbnail') as make_thumbnail:
+            self.assertIsNone(store.get('def', b'', 128))
+        self.assertEqual(make_thumbnail.call_count, 0)
+
+        with mock.patch('os.listdir') as listdir:
+            store.remove('abc')
+        self.assertEqual(listdir.call_count, 0)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['def-128.orig', 'def-256.orig', 'def-512.orig', 'def-64.jpg'])
+        store.prune({'abc'})
+        self.assertEqual(os.listdir(directory), [])
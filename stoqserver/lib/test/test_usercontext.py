@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import threading
+import unittest
+
+import kiwi.component
+import mock
+from kiwi.component import get_utility, provide_utility, remove_utility
+from stoqlib.database.interfaces import ICurrentUser, ICurrentBranch
+
+from stoqserver.lib import usercontext
+
+
+class TestUserContext(unittest.TestCase):
+
+    def setUp(self):
+        handler = kiwi.component.utilities
+        self.addCleanup(setattr, kiwi.component, 'utilities', handler)
+        self.user = get_utility(ICurrentUser, None)
+        self.branch = get_utility(ICurrentBranch, None)
+        usercontext.install()
+        usercontext.install()
+        self.assertIs(kiwi.component.utilities._handler, handler)
+
+    def _run_in_thread(self, func):
+        results = []
+        t = threading.Thread(target=lambda: results.append(func()))
+        t.start()
+        t.join()
+        return results[0]
+
+    def test_current_user(self):
+        with usercontext.current_user('user1'):
+            self.assertEqual(get_utility(ICurrentUser), 'user1')
+            # Other threads should not see the user
+            self.assertEqual(
+                self._run_in_thread(lambda: get_utility(ICurrentUser, None)),
+                self.user)
+
+            with usercontext.current_user('user2'):
+                self.assertEqual(get_utility(ICurrentUser), 'user2')
+            self.assertEqual(get_utility(ICurrentUser), 'user1')
+
+        self.assertEqual(get_utility(ICurrentUser, None), self.user)
+
+    def test_lazy_current_user(self):
+        loader = mock.Mock(return_value='user1')
+        with usercontext.lazy_current_user(loader):
+            self.assertEqual(loader.call_count, 0)
+            # An inner block should not load the outer user either
+            with usercontext.current_user('user2'):
+                self.assertEqual(get_utility(ICurrentUser), 'user2')
+            self.assertEqual(loader.call_count, 0)
+
+            self.assertEqual(get_utility(ICurrentUser), 'user1')
+            self.assertEqual(get_utility(ICurrentUser), 'user1')
+            self.assertEqual(loader.call_count, 1)
+
+        self.assertEqual(get_utility(ICurrentUser, None), self.user)
+
+    def test_threads(self):
+        barrier = threading.Barrier(2)
+
+        def run(user):
+            with usercontext.current_user(user):
+                # Make sure both threads have provided their users
+                barrier.wait()
+                return get_utility(ICurrentUser)
+
+        results = {}
+        threads = [threading.Thread(target=lambda u=u: results.update({u: run(u)}))
+                   for u in ['user1', 'user2']]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {'user1': 'user1', 'user2': 'user2'})
+
+    def test_shared_utilities(self):
+        # Utilities other than ICurrentUser are still global
+        self._run_in_thread(
+            lambda: provide_utility(ICurrentBranch, 'branch', replace=True))
+        try:
+            self.assertEqual(get_utility(ICurrentBranch), 'branch')
+        finally:
+            if self.branch is None:
+                remove_utility(ICurrentBranch)
+            else:
+                provide_utility(ICurrentBranch, self.branch, replace=True)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import multiprocessing
+import queue
+import time
+import unittest
+
+from stoqserver.lib.workerchannel import WorkerChannel
+
+
+def _run_worker(channel, worker_id):
+    def handler(message):
+        # Reply to the leader with what was broadcasted
+        channel.send((worker_id, message))
+
+    channel.start(worker_id, handler)
+    channel.send((worker_id, 'started'))
+    # Wait for the broadcast
+    time.sleep(5)
+
+
+class TestWorkerChannel(unittest.TestCase):
+
+    def test_channel(self):
+        ctx = multiprocessing.get_context('fork')
+        channel = WorkerChannel(3)
+        processes = [ctx.Process(target=_run_worker, args=(channel, i))
+                     for i in [1, 2]]
+        for p in processes:
+            p.daemon = True
+            p.start()
+            self.addCleanup(p.terminate)
+
+        messages = queue.Queue()
+        channel.start(WorkerChannel.LEADER, messages.put)
+        self.assertTrue(channel.is_leader)
+
+        received = {messages.get(timeout=5), messages.get(timeout=5)}
+        self.assertEqual(received, {(1, 'started'), (2, 'started')})
+
+        channel.broadcast('foo')
+        received = {messages.get(timeout=5), messages.get(timeout=5)}
+        self.assertEqual(received, {(1, 'foo'), (2, 'foo')})
+
+    def test_next_id(self):
+        channel = WorkerChannel(2)
+        self.assertEqual(channel.next_id(), 1)
+        self.assertEqual(channel.next_id(), 2)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+"""Smaller variants of the product images
+
+The POS shows the images as small tiles, so sending the originals wastes
+a lot of bandwidth. Thumbnails are made with PIL (when it is available)
+and kept on disk by the hash of their original image, so they never need
+to be invalidated: a changed image simply has another hash.
+"""
+
+import io
+import logging
+import os
+import tempfile
+
+try:
+    from PIL import Image
+    has_pil = True
+except ImportError:
+    has_pil = False
+
+log = logging.getLogger(__name__)
+
+#: The widths the thumbnails can have. Other widths are rounded up to one
+#: of those, so there are only a few variants of each image
+SIZES = (64, 128, 256, 512)
+JPEG_QUALITY = 85
+
+_extensions = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+}
+
+
+def get_size(width):
+    """Get the size of the thumbnail to use for the requested *width*
+
+    :returns: one of :data:`SIZES`, or ``None`` if the width is bigger than
+        all of them and the original image should be used
+    """
+    for size in SIZES:
+        if width <= size:
+            return size
+    return None
+
+
+def make_thumbnail(data, size):
+    """Make a thumbnail of the image in *data* that is *size* pixels wide
+
+    Images with transparency are saved as PNG and the other ones as JPEG.
+
+    :returns: a tuple with the data and the mimetype of the thumbnail, or
+        ``None`` if the image is not bigger than the thumbnail or could
+        not be read
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        if width <= size:
+            return None
+
+        has_alpha = (image.mode in ['RGBA', 'LA'] or
+                     (image.mode == 'P' and 'transparency' in image.info))
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image = image.resize((size, max(1, round(height * size / width))),
+                             Image.LANCZOS)
+    except (IOError, ValueError):
+        log.warning("Could not make a thumbnail of an image", exc_info=True)
+        return None
+
+    output = io.BytesIO()
+    if has_alpha:
+        image.save(output, 'PNG', optimize=True)
+        return output.getvalue(), 'image/png'
+    image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return output.getvalue(), 'image/jpeg'
+
+
+class ThumbnailStore(object):
+    """The thumbnails made so far, kept in a directory
+
+    The thumbnails are stored by the hash of their original image and their
+    size, so they can be shared by all the processes of the server. When an
+    image has no thumbnail of a size (e.g. it is already smaller than that),
+    an empty marker file is stored instead, so it is not read again.
+    """
+
+    #: The extension of the marker files
+    ORIGINAL = '.orig'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, digest, data, size):
+        """Get the thumbnail of an image, making it if needed
+
+        :param digest: the hash of the original image
+        :param data: the original image
+        :param size: the size of the thumbnail, one of :data:`SIZES`
+        :returns: like :func:`make_thumbnail`
+        """
+        prefix = self._get_prefix(digest, size)
+        if os.path.exists(prefix + self.ORIGINAL):
+            return None
+        for mimetype, extension in _extensions.items():
+            try:
+                with open(prefix + extension, 'rb') as f:
+                    return f.read(), mimetype
+            except FileNotFoundError:
+                pass
+
+        thumbnail = make_thumbnail(data, size)
+        if thumbnail is None:
+            self._write(prefix + self.ORIGINAL, b'')
+            return None
+
+        self._write(prefix + _extensions[thumbnail[1]], thumbnail[0])
+        return thumbnail
+
+    def make_all(self, digest, data):
+        """Make the thumbnails of all the :data:`SIZES` of an image"""
+        for i, size in enumerate(SIZES):
+            if self.get(digest, data, size) is None:
+                # The image is not bigger than the bigger sizes either
+                for bigger in SIZES[i + 1:]:
+                    self._write(self._get_prefix(digest, bigger) + self.ORIGINAL, b'')
+                break
+
+    def remove(self, digest):
+        """Remove the thumbnails of an image"""
+        # The names are known, so there's no need to list the directory
+        extensions = list(_extensions.values()) + [self.ORIGINAL]
+        for size in SIZES:
+            prefix = '%s-%d' % (digest, size)
+            for extension in extensions:
+                self._unlink(prefix + extension)
+
+    def prune(self, digests):
+        """Remove the thumbnails of the images not in *digests*"""
+        for filename in os.listdir(self.directory):
+            digest, _, rest = filename.partition('-')
+            if rest and digest not in digests:
+                self._unlink(filename)
+
+    #
+    #  Private
+    #
+
+    def _get_prefix(self, digest, size):
+        return os.path.join(self.directory, '%s-%d' % (digest, size))
+
+    def _write(self, filename, data):
+        # Another process could be reading or making it at the same time,
+        # so write it to a temporary file first
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass
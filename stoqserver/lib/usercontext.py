@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+"""The current user of each request
+
+stoqlib finds the current user (e.g. the responsible for a stock change)
+with ``get_utility(ICurrentUser)``, and utilities are global to the process.
+Since the flask server handles each request in a thread, providing the user
+of one request would change the user of all the other ones running at
+the same time.
+
+After :func:`install` is called, :class:`ICurrentUser` is provided per
+thread, while all the other utilities are still shared by the process.
+The user can also be provided lazily with :func:`lazy_current_user`, so it
+is only loaded if something asks for it.
+"""
+
+import contextlib
+import threading
+
+import kiwi.component
+from kiwi.component import AlreadyImplementedError, provide_utility
+from stoqlib.database.interfaces import ICurrentUser
+
+
+class _Lazy(object):
+    """A utility that will be loaded by *loader* when first requested"""
+
+    def __init__(self, loader):
+        self.loader = loader
+
+
+class _ThreadLocalUtilities(object):
+    """A utility handler that provides some interfaces per thread
+
+    The other interfaces, and the ones not provided in the current thread,
+    are delegated to the original handler.
+    """
+
+    def __init__(self, handler, ifaces):
+        self._handler = handler
+        self._ifaces = frozenset(ifaces)
+        self._local = threading.local()
+
+    def __getattr__(self, attr):
+        return getattr(self._handler, attr)
+
+    def _get_utilities(self):
+        try:
+            return self._local.utilities
+        except AttributeError:
+            self._local.utilities = {}
+            return self._local.utilities
+
+    def provide(self, iface, obj, replace=False):
+        if iface not in self._ifaces:
+            return self._handler.provide(iface, obj, replace)
+
+        utilities = self._get_utilities()
+        if not replace and iface in utilities:
+            raise AlreadyImplementedError("%s is already implemented" % iface)
+        utilities[iface] = obj
+
+    def get(self, iface, default):
+        utilities = self._get_utilities()
+        if iface in self._ifaces and iface in utilities:
+            obj = utilities[iface]
+            if isinstance(obj, _Lazy):
+                obj = utilities[iface] = obj.loader()
+            return obj
+        return self._handler.get(iface, default)
+
+    def remove(self, iface):
+        utilities = self._get_utilities()
+        if iface in self._ifaces and iface in utilities:
+            return utilities.pop(iface)
+        return self._handler.remove(iface)
+
+    def clean(self):
+        self._get_utilities().clear()
+        self._handler.clean()
+
+
+def install(ifaces=(ICurrentUser, )):
+    """Make the utilities for *ifaces* be provided per thread
+
+    Calling this more than once does nothing.
+    """
+    if isinstance(kiwi.component.utilities, _ThreadLocalUtilities):
+        return
+    kiwi.component.utilities = _ThreadLocalUtilities(
+        kiwi.component.utilities, ifaces)
+
+
+@contextlib.contextmanager
+def _provide_user(user):
+    handler = kiwi.component.utilities
+    if isinstance(handler, _ThreadLocalUtilities):
+        # Don't load the user of an outer lazy_current_user just to restore it
+        old_user = handler._get_utilities().get(ICurrentUser)
+    else:
+        old_user = handler.get(ICurrentUser, None)
+    provide_utility(ICurrentUser, user, replace=True)
+    try:
+        yield
+    finally:
+        if old_user is not None:
+            provide_utility(ICurrentUser, old_user, replace=True)
+        else:
+            handler.remove(ICurrentUser)
+
+
+@contextlib.contextmanager
+def current_user(user):
+    """Provide *user* as the current user while inside the block
+
+    If :func:`install` was called, this only affects the current thread.
+    The previous user is restored when leaving the block.
+    """
+    with _provide_user(user):
+        yield user
+
+
+@contextlib.contextmanager
+def lazy_current_user(loader):
+    """Like :func:`current_user`, but the user is only loaded when needed
+
+    The first time the current user is requested inside the block, it will
+    be the return value of *loader*. If :func:`install` was not called,
+    the user is loaded right away.
+    """
+    if not isinstance(kiwi.component.utilities, _ThreadLocalUtilities):
+        with current_user(loader()):
+            yield
+        return
+
+    with _provide_user(_Lazy(loader)):
+        yield
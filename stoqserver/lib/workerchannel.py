@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class WorkerChannel(object):
+    """Messages between the worker processes of a prefork server
+
+    One of the workers is the leader. It receives the messages the other
+    workers :meth:`.send` and can :meth:`.broadcast` messages to all of them.
+    Messages can be any picklable object and are passed to the handler given
+    to :meth:`.start` in a separated thread.
+
+    The channel must be created before forking the workers. Each worker
+    has its own pipes, so a worker that dies (and is forked again with the
+    same id) will not disturb the others.
+    """
+
+    LEADER = 0
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.worker_id = None
+
+        # (reader, writer) pairs. The leader has no pipe to itself
+        self._to_leader = [None] + [multiprocessing.Pipe(duplex=False)
+                                    for i in range(1, workers)]
+        self._from_leader = [None] + [multiprocessing.Pipe(duplex=False)
+                                      for i in range(1, workers)]
+        self._counter = multiprocessing.Value('q', 0)
+        self._send_lock = threading.Lock()
+
+    #
+    #  Public API
+    #
+
+    @property
+    def is_leader(self):
+        return self.worker_id == self.LEADER
+
+    def start(self, worker_id, handler):
+        """Start receiving messages in this worker
+
+        Must be called once, after the worker process was forked
+        """
+        assert self.worker_id is None
+        self.worker_id = worker_id
+        t = threading.Thread(target=self._receive, args=(handler, ))
+        t.daemon = True
+        t.start()
+
+    def send(self, message):
+        """Send a message to the leader"""
+        assert not self.is_leader
+        with self._send_lock:
+            self._to_leader[self.worker_id][1].send(message)
+
+    def broadcast(self, message):
+        """Send a message from the leader to all the other workers"""
+        assert self.is_leader
+        with self._send_lock:
+            for reader, writer in self._from_leader[1:]:
+                writer.send(message)
+
+    def next_id(self):
+        """Get the next number of a sequence shared by all the workers"""
+        with self._counter.get_lock():
+            self._counter.value += 1
+            return self._counter.value
+
+    #
+    #  Private
+    #
+
+    def _receive(self, handler):
+        if self.is_leader:
+            readers = [reader for reader, writer in self._to_leader[1:]]
+        else:
+            readers = [self._from_leader[self.worker_id][0]]
+
+        while True:
+            for reader in multiprocessing.connection.wait(readers):
+                message = reader.recv()
+                try:
+                    handler(message)
+                except Exception:
+                    log.exception("Error handling message %r", message)
@@ -107,6 +107,9 @@ class XMLRPCServer(object):
     def install_plugin(self, plugin_name):
         return self._run_action('install_plugin', plugin_name)
 
+    def profile_task(self, task_name, seconds=10):
+        return self._run_action('profile_task', task_name, seconds)
+
     #
     #  Private
     #
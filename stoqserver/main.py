@@ -297,7 +297,14 @@ class StoqServerCmdHandler(object):
         if platform.system() != 'Windows':
             signal.signal(signal.SIGQUIT, _exit)
 
-        start_flask_server(options.debug)
+        start_flask_server(options.debug, workers=options.workers)
+
+    def opt_flask(self, parser, group):
+        group.add_option('', '--workers',
+                         action='store',
+                         type='int',
+                         default=1,
+                         dest='workers')
 
     def cmd_backup_database(self, options, *args):
         """Backup the Stoq database"""
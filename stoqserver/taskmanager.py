@@ -42,6 +42,7 @@ from stoqlib.lib.pluginmanager import PluginError, get_plugin_manager
 from stoqlib.lib.webservice import WebService
 from stoqlib.net.socketutils import get_random_port
 
+from stoqserver.lib import profiler
 from stoqserver.tasks import (backup_status, restore_database, backup_database,
                               start_plugins_update_scheduler,
                               start_xmlrpc_server, start_server,
@@ -162,6 +163,7 @@ class Task(multiprocessing.Process):
         if not _is_windows:
             os.setpgrp()
             self._ppid = os.getppid()
+            profiler.install_signal_handler()
             t = threading.Thread(target=self._check_parent_running)
             t.daemon = True
             t.start()
@@ -278,6 +280,15 @@ class TaskManager(threading.Thread):
 
             return task.status == Task.STATUS_RUNNING
 
+    def get_pid(self, task_name):
+        """Get the pid of the task named *task_name* if it is running."""
+        with self._lock:
+            task = self._tasks.get(task_name, None)
+            if task is None or task.status != Task.STATUS_RUNNING:
+                return None
+
+            return task.pid
+
     def stop_tasks(self, exclude=None):
         """Stop the currently running tasks.
 
@@ -583,6 +594,26 @@ class Worker(object):
 
             return pipe.recv()
 
+    def action_profile_task(self, task_name, seconds):
+        # An empty name means the main process
+        if not task_name:
+            try:
+                return True, profiler.profile(seconds)
+            except profiler.ProfilerError as err:
+                return False, str(err)
+
+        if _is_windows:
+            return False, "Profiling tasks is not supported on windows"
+
+        pid = self._manager.get_pid(task_name)
+        if pid is None:
+            return False, "Task %s not found" % (task_name, )
+
+        try:
+            return True, profiler.profile_process(pid, seconds)
+        except profiler.ProfilerError as err:
+            return False, str(err)
+
     #
     #  Private
     #
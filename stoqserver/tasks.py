@@ -25,11 +25,13 @@
 import collections
 import datetime
 import logging
+import multiprocessing
 import os
 import platform
 import random
 import re
 import signal
+import socket
 import sys
 import tempfile
 import time
@@ -159,9 +161,9 @@ def start_xmlrpc_server(pipe_conn):
     run_xmlrpcserver(pipe_conn, port)
 
 
-def start_flask_server(debug=False):
+def start_flask_server(debug=False, workers=1):
     # We need to delay importing from restfull so that the plugin infrastructure gets setup correcly
-    from stoqserver.lib.restful import run_flaskserver
+    from stoqserver.lib.restful import get_exclusive_devices, run_flaskserver
 
     _setup_signal_termination()
     logger.info("Starting the flask server")
@@ -169,8 +171,68 @@ def start_flask_server(debug=False):
     config = get_config()
     # XXX: Is flaskport a good name for this?
     port = int(config.get('General', 'flaskport') or SERVER_FLASK_PORT)
+    # The asyncio event server is only started when a port is configured
+    events_port = config.get('General', 'eventsport')
+    events_port = int(events_port) if events_port else None
+
+    if workers > 1:
+        # The requests using them could reach any of the workers
+        devices = get_exclusive_devices()
+        if devices:
+            raise TaskException(
+                "The flask server can't run with multiple workers when using "
+                "the {}. Run it with a single worker instead".format(', '.join(devices)))
+        _start_flask_workers(workers, port, debug, events_port)
+    else:
+        run_flaskserver(port, debug, events_port=events_port)
+
+
+def _start_flask_worker(worker_id, channel, fd, port, debug, events_port):
+    from stoqserver.lib.restful import run_flaskworker
+
+    _setup_signal_termination()
+    run_flaskworker(worker_id, channel, fd, port, debug=debug,
+                    events_port=events_port)
+
+
+def _start_flask_workers(workers, port, debug, events_port):
+    # The tasks import this module
+    from stoqserver.lib.workerchannel import WorkerChannel
+    from stoqserver.taskmanager import Task
+
+    # All the workers will accept connections from this socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(128)
+
+    channel = WorkerChannel(workers)
+    error_queue = multiprocessing.Queue()
+    tasks = []
+    for i in range(workers):
+        task = Task('flask-worker-%d' % (i, ), _start_flask_worker,
+                    i, channel, sock.fileno(), port, debug, events_port)
+        task.start(error_queue)
+        tasks.append(task)
 
-    run_flaskserver(port, debug)
+    def _sigterm_handler(_signal, _stack_frame):
+        for task in tasks:
+            if task.is_alive():
+                os.kill(task.pid, signal.SIGTERM)
+        os._exit(0)
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+
+    logger.info("Started %d flask workers on port %d", workers, port)
+    while True:
+        for i, task in enumerate(tasks):
+            if task.is_alive():
+                continue
+
+            logger.warning("Flask worker %d died with code %s. Restarting it",
+                           i, task.exitcode)
+            tasks[i] = task.clone()
+            tasks[i].start(error_queue)
+        time.sleep(1)
 
 
 def start_server():
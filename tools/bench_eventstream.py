@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2018 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Measure the cost of sending an event to many EventStream clients
+
+A catalog event similar to SERVER_UPDATE_DATA is sent to a growing number
+of subscribers, comparing encoding it for each one of them (what the
+stream threads used to do) with :meth:`EventStream.put`, which encodes it
+only once. The time and the memory allocated (measured with tracemalloc)
+are printed for each number of subscribers.
+
+Usage: tools/bench_eventstream.py [--products N] [--subscribers 1,10,50]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stoqserver.lib.restful import EventQueue, EventStream  # nopep8
+
+
+def _make_event(products):
+    return {
+        'type': 'SERVER_UPDATE_DATA',
+        'data': {
+            'categories': [{
+                'id': 'category-%d' % (i // 100, ),
+                'description': 'Category %d' % (i // 100, ),
+                'products': [{
+                    'id': '%08d-0000-0000-0000-000000000000' % (j, ),
+                    'description': 'Product %d with a reasonably long name' % (j, ),
+                    'price': '%d.99' % (j % 1000, ),
+                    'order': j,
+                    'category_prices': {},
+                    'color': '#ff0000',
+                    'requires_kitchen_production': False,
+                    'availability': {'branch': j % 100},
+                } for j in range(i, min(i + 100, products))],
+            } for i in range(0, products, 100)],
+        },
+    }
+
+
+def _measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def _encode_per_subscriber(data, subscribers):
+    return [("data: " + json.dumps(data) + "\n\n").encode()
+            for i in range(subscribers)]
+
+
+def _encode_once(data, subscribers):
+    streams = [EventQueue() for i in range(subscribers)]
+    old_streams = EventStream._streams
+    EventStream._streams = streams
+    try:
+        EventStream.put(data)
+    finally:
+        EventStream._streams = old_streams
+    return streams
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--products', type=int, default=25000)
+    parser.add_argument('--subscribers', default='1,10,50')
+    options = parser.parse_args(args)
+
+    data = _make_event(options.products)
+    print("%d products, %.1fMB frame" % (
+        options.products, len(json.dumps(data)) / 1024 / 1024))
+    print("%12s %24s %24s" % ('subscribers', 'per subscriber', 'once'))
+    for subscribers in [int(s) for s in options.subscribers.split(',')]:
+        per_time, per_memory = _measure(
+            lambda: _encode_per_subscriber(data, subscribers))
+        once_time, once_memory = _measure(
+            lambda: _encode_once(data, subscribers))
+        print("%12d %11.2fs / %7.1fMB %11.2fs / %7.1fMB" % (
+            subscribers, per_time, per_memory / 1024 / 1024,
+            once_time, once_memory / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])